@@ -0,0 +1,252 @@
+"""Microbenchmarks of the per-request CPU work of the Dataset Registry.
+
+The context broker is replaced by an in-memory stub, so only the work done by this process is
+measured: signature check, form stripping and parsing, Dataset/Distribution construction and
+serialisation, and the whole inject_dataset path for catalogues of increasing size.
+
+    python benchmarks/bench_hot_path.py                          # run and print the results
+    python benchmarks/bench_hot_path.py --save baseline.json     # keep them as a baseline
+    python benchmarks/bench_hot_path.py --compare baseline.json  # fail on regressions
+
+Allocations are measured with tracemalloc on separate runs, so they do not distort the timings.
+"""
+import argparse
+import copy
+import gc
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import requests
+from ngsildclient import Entity
+from ngsildclient.api.exceptions import NgsiResourceNotFoundError, ProblemDetails
+
+from injector_ngsildclient import NgsildBrokerDataInjector, RESOURCE_TYPES, SDMDCAT
+from dataset_registry_module import is_valid_signature, strip_form
+from form_schema import parse_form
+
+
+FORM_KEY = "benchmark-form-key"
+CATALOG_ID = "SALTED_Project"
+
+
+class StubResponse(object):
+    status_code = 204
+
+    def raise_for_status(self):
+        pass
+
+
+class StubSession(requests.Session):
+    # Partial updates are accepted without leaving the process
+    def post(self, url, **kwargs):
+        return StubResponse()
+
+    def patch(self, url, **kwargs):
+        return StubResponse()
+
+
+class StubEndpoint(object):
+    def __init__(self, url):
+        self.url = url
+
+
+class StubCSourceRegs(object):
+    def __init__(self):
+        self.store = {}
+
+    def get(self, csource_id):
+        if csource_id not in self.store:
+            raise NgsiResourceNotFoundError(ProblemDetails("", "", 404, "", csource_id))
+        return copy.deepcopy(self.store[csource_id])
+
+    def register(self, csource):
+        self.store[csource["id"] if isinstance(csource, dict) else csource.id] = csource
+
+    def delete(self, csource_id):
+        self.store.pop(csource_id, None)
+
+
+class StubClient(object):
+    """In-memory stand-in for ngsildclient.Client."""
+
+    def __init__(self):
+        self.url = "http://stub:1026"
+        self.session = StubSession()
+        self.entities = StubEndpoint(self.url + "/ngsi-ld/v1/entities")
+        self.csourceregs = StubCSourceRegs()
+        self.store = {}
+
+    def raise_for_status(self, r):
+        pass
+
+    def get(self, entity_id, ctx=None):
+        if entity_id not in self.store:
+            raise NgsiResourceNotFoundError(ProblemDetails("", "", 404, "", entity_id))
+        return Entity.from_dict(copy.deepcopy(self.store[entity_id]))
+
+    def create(self, entity):
+        self.store[entity.id] = copy.deepcopy(entity.to_dict())
+
+    def upsert(self, *entities, update=False):
+        if len(entities) == 1 and not isinstance(entities[0], Entity):
+            entities = entities[0]
+        for entity in entities:
+            self.store[entity.id] = entity.to_dict()
+        return True
+
+
+def make_form(n: int) -> dict:
+    # Realistic CKAN form submission as delivered by WPForms
+    return {
+        "DatasetType": "https://smartdatamodels.org/dataModel.Environment/Type{}".format(n),
+        "DatasetTypeDescription": "  Air quality observations of the municipality sensors, type {}  ".format(n),
+        "DatasetCreator": "University of Cantabria, Santander City Council",
+        "DatasetProvider": "Provider {}".format(n % 10),
+        "DatasetTypeTopic": "Environment 2abc||Transport 3abc||Energy 5abc",
+        "DatasetLanguage": "English 0abc",
+        "DatasetAccessRights": "Public 1abc",
+        "DatasetKeywords": "air quality, pollution, NO2, O3, PM10, sensors",
+        "DatasetLocation": "Spain 25abc||Europe 29abc",
+        "ScorpioSatelliteURL": "https://satellite-{}.example.org:9090".format(n % 10),
+        "DatasetIDPattern": "Type{}:.*".format(n),
+    }
+
+
+def sign(body: str) -> tuple:
+    timestamp = str(int(time.time()))
+    signature = hmac.new(FORM_KEY.encode("utf-8"), (timestamp + "." + body).encode("utf-8"), hashlib.sha256).hexdigest()
+    return timestamp, signature
+
+
+def make_broker(n_datasets: int) -> tuple:
+    broker = NgsildBrokerDataInjector("http://stub:1026", client=StubClient(), cache={"enabled": False})
+    catalog = broker.inject_catalog(CATALOG_ID)
+    # Catalogue already holding n_datasets datasets
+    catalog.rel(str(SDMDCAT["dataset"]), ["urn:ngsi-ld:Dataset:{}:Other:D{}".format(CATALOG_ID, i) for i in range(n_datasets)])
+    return broker, catalog
+
+
+def bench(name: str, func, repeat: int, results: dict) -> None:
+    func()  # warm-up
+
+    gc.disable()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.enable()
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    blocks = sys.getallocatedblocks()
+    func()
+    blocks = sys.getallocatedblocks() - blocks
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results[name] = {
+        "mean_us": round(statistics.mean(times) * 1e6, 2),
+        "p50_us": round(statistics.median(times) * 1e6, 2),
+        "peak_kib": round((peak - before) / 1024, 2),
+        "retained_blocks": blocks,
+    }
+    print("{:<40} {:>12.2f} {:>12.2f} {:>12.2f} {:>10}".format(
+        name, results[name]["mean_us"], results[name]["p50_us"], results[name]["peak_kib"], blocks,
+    ))
+
+
+def run(repeat: int, sizes: list) -> dict:
+    results = {}
+    print("{:<40} {:>12} {:>12} {:>12} {:>10}".format("phase", "mean (us)", "p50 (us)", "peak (KiB)", "blocks"))
+
+    form = make_form(0)
+    body = json.dumps(form)
+    timestamp, signature = sign(body)
+    bench("is_valid_signature", lambda: is_valid_signature(timestamp, body, signature, FORM_KEY), repeat, results)
+    bench("strip_form", lambda: strip_form(form), repeat, results)
+
+    stripped = strip_form(form)
+    bench("parse_form", lambda: parse_form(stripped), repeat, results)
+
+    broker, catalog = make_broker(0)
+    record = parse_form(stripped)
+    bench("form_validate_dataset", lambda: broker.form_validate_dataset(record), repeat, results)
+    bench("form_validate_csource", lambda: broker.form_validate_csource(record), repeat, results)
+
+    dataset_form = broker.form_validate_dataset(record)
+    bench("create_new_dataset (new)", lambda: broker.merge_dataset(catalog, dataset_form, None), repeat, results)
+    current, distributions = broker.merge_dataset(catalog, dataset_form, None)
+    bench("create_new_dataset (merge)", lambda: broker.merge_dataset(catalog, dataset_form, current), repeat, results)
+    bench(
+        "create_new_distribution",
+        lambda: broker.create_new_distribution(catalog, current, RESOURCE_TYPES[0]),
+        repeat, results,
+    )
+    bench("entity serialisation", lambda: [e.to_json() for e in [current] + distributions], repeat, results)
+
+    for size in sizes:
+        broker, catalog = make_broker(size)
+        forms = [parse_form(strip_form(make_form(n))) for n in range(repeat + 1)]
+        counter = iter(range(len(forms)))
+        # Every call registers a new dataset in the catalogue
+        bench(
+            "inject_dataset (catalogue of {})".format(size),
+            lambda: broker.inject_dataset(catalog, forms[next(counter) % len(forms)]),
+            repeat - 1, results,
+        )
+        bench(
+            "inject_dataset resubmission ({})".format(size),
+            lambda: broker.inject_dataset(catalog, forms[0]),
+            repeat, results,
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("mean_us", "peak_kib"):
+            old, new = baseline[name][metric], result[metric]
+            if old and new > old * (1 + threshold):
+                regressions.append("{} {}: {} -> {} (+{:.0%})".format(name, metric, old, new, new / old - 1))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the request hot path.")
+    parser.add_argument("--repeat", type=int, default=200, help="iterations per phase")
+    parser.add_argument("--sizes", default="0,1000,5000", help="catalogue sizes (number of datasets)")
+    parser.add_argument("--save", help="write the results as a baseline JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="tolerated slowdown (default 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, [int(size) for size in args.sizes.split(",") if size])
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
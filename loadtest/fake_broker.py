@@ -0,0 +1,262 @@
+"""Local stand-in for the Federator context broker, for load tests of the Dataset Registry.
+
+It keeps entities and context source registrations in memory and implements the NGSI-LD
+endpoints used by NgsildBrokerDataInjector and the reconciliation: entity query/retrieval/
+creation/deletion, attribute append and instance deletion, batch upsert and csourceRegistrations.
+Latency and errors can be injected, and every request is counted by operation (GET /stats,
+POST /stats/reset).
+
+    python loadtest/fake_broker.py --port 1026 --latency-ms 20 --jitter-ms 10 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+BASE = "/ngsi-ld/v1"
+
+# (method, path pattern, operation name)
+ROUTES = [
+    ("GET", re.compile(BASE + r"/entities/?$"), "query_entities"),
+    ("POST", re.compile(BASE + r"/entities/?$"), "create_entity"),
+    ("GET", re.compile(BASE + r"/entities/(?P<id>[^/]+)$"), "get_entity"),
+    ("DELETE", re.compile(BASE + r"/entities/(?P<id>[^/]+)$"), "delete_entity"),
+    ("POST", re.compile(BASE + r"/entities/(?P<id>[^/]+)/attrs/?$"), "append_attrs"),
+    ("PATCH", re.compile(BASE + r"/entities/(?P<id>[^/]+)/attrs/?$"), "update_attrs"),
+    ("DELETE", re.compile(BASE + r"/entities/(?P<id>[^/]+)/attrs/(?P<attr>[^/]+)$"), "delete_attr"),
+    ("POST", re.compile(BASE + r"/entityOperations/upsert/?$"), "batch_upsert"),
+    ("GET", re.compile(BASE + r"/csourceRegistrations/?$"), "query_csources"),
+    ("GET", re.compile(BASE + r"/csourceRegistrations/(?P<id>[^/]+)$"), "get_csource"),
+    ("POST", re.compile(BASE + r"/csourceRegistrations/?$"), "register_csource"),
+    ("PATCH", re.compile(BASE + r"/csourceRegistrations/(?P<id>[^/]+)$"), "patch_csource"),
+    ("DELETE", re.compile(BASE + r"/csourceRegistrations/(?P<id>[^/]+)$"), "delete_csource"),
+]
+
+
+class FakeBroker(object):
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.entities = {}
+        self.csources = {}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def delay(self) -> None:
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    # Operations return (status, body)
+
+    def query_entities(self, query, body):
+        entities = list(self.entities.values())
+        if "type" in query:
+            entities = [e for e in entities if e["type"] in query["type"][0].split(",")]
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["20"])[0])
+        return 200, entities[offset:offset + limit], {"NGSILD-Results-Count": str(len(entities))}
+
+    def create_entity(self, query, body):
+        if body["id"] in self.entities:
+            return 409, problem("AlreadyExists", body["id"])
+        self.entities[body["id"]] = body
+        return 201, None
+
+    def get_entity(self, query, body, id):
+        if id not in self.entities:
+            return 404, problem("ResourceNotFound", id)
+        return 200, self.entities[id]
+
+    def delete_entity(self, query, body, id):
+        if self.entities.pop(id, None) is None:
+            return 404, problem("ResourceNotFound", id)
+        return 204, None
+
+    def append_attrs(self, query, body, id):
+        if id not in self.entities:
+            return 404, problem("ResourceNotFound", id)
+        body.pop("@context", None)
+        entity = self.entities[id]
+        for name, attr in body.items():
+            entity[name] = merge_instances(entity.get(name, None), attr)
+        return 204, None
+
+    update_attrs = append_attrs
+
+    def delete_attr(self, query, body, id, attr):
+        # All the instances, or the one of datasetId
+        entity = self.entities.get(id, None)
+        if entity is None or attr not in entity:
+            return 404, problem("ResourceNotFound", id + "/" + attr)
+        if "datasetId" not in query:
+            del entity[attr]
+            return 204, None
+        dataset_id = query["datasetId"][0]
+        instances = entity[attr] if isinstance(entity[attr], list) else [entity[attr]]
+        kept = [instance for instance in instances if instance.get("datasetId", None) != dataset_id]
+        if len(kept) == len(instances):
+            return 404, problem("ResourceNotFound", id + "/" + attr + "?datasetId=" + dataset_id)
+        if kept:
+            entity[attr] = kept[0] if len(kept) == 1 else kept
+        else:
+            del entity[attr]
+        return 204, None
+
+    def batch_upsert(self, query, body):
+        update = "update" in query.get("options", [""])[0]
+        for entity in body:
+            if update and entity["id"] in self.entities:
+                current = self.entities[entity["id"]]
+                for name, attr in entity.items():
+                    current[name] = merge_instances(current.get(name, None), attr) if name not in ("id", "type") else attr
+            else:
+                self.entities[entity["id"]] = entity
+        return 204, None
+
+    def query_csources(self, query, body):
+        csources = list(self.csources.values())
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["20"])[0])
+        return 200, csources[offset:offset + limit], {"NGSILD-Results-Count": str(len(csources))}
+
+    def get_csource(self, query, body, id):
+        if id not in self.csources:
+            return 404, problem("ResourceNotFound", id)
+        return 200, self.csources[id]
+
+    def register_csource(self, query, body):
+        if body["id"] in self.csources:
+            return 409, problem("AlreadyExists", body["id"])
+        self.csources[body["id"]] = body
+        return 201, None
+
+    def patch_csource(self, query, body, id):
+        if id not in self.csources:
+            return 404, problem("ResourceNotFound", id)
+        body.pop("@context", None)
+        self.csources[id].update(body)
+        return 204, None
+
+    def delete_csource(self, query, body, id):
+        if self.csources.pop(id, None) is None:
+            return 404, problem("ResourceNotFound", id)
+        return 204, None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": dict(self.counts),
+                "total": sum(self.counts.values()),
+                "entities": len(self.entities),
+                "csources": len(self.csources),
+            }
+
+
+def merge_instances(current, attr):
+    # Instances of a multi-attribute are replaced per datasetId (None: the default one), the others are kept
+    if current is None or not isinstance(current, (dict, list)):
+        return attr
+    instances = {
+        instance.get("datasetId", None): instance
+        for instance in (current if isinstance(current, list) else [current])
+    }
+    for instance in attr if isinstance(attr, list) else [attr]:
+        instances[instance.get("datasetId", None)] = instance
+    instances = list(instances.values())
+    return instances[0] if len(instances) == 1 else instances
+
+
+def problem(type_: str, detail: str) -> dict:
+    return {"type": "https://uri.etsi.org/ngsi-ld/errors/" + type_, "title": type_, "detail": detail}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    broker: FakeBroker = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body=None, headers={}) -> None:
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_method(self, method: str) -> None:
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        if url.path == "/stats":
+            if method == "POST":
+                with self.broker.lock:
+                    self.broker.counts.clear()
+            return self.reply(200, self.broker.stats())
+
+        for route_method, pattern, operation in ROUTES:
+            match = pattern.match(url.path)
+            if route_method != method or match is None:
+                continue
+
+            with self.broker.lock:
+                self.broker.counts[operation] += 1
+            self.broker.delay()
+            if random.random() < self.broker.error_rate:
+                return self.reply(500, problem("InternalError", "Injected error"))
+
+            kwargs = {key: unquote(value) for key, value in match.groupdict().items()}
+            with self.broker.lock:
+                result = getattr(self.broker, operation)(parse_qs(url.query), body, **kwargs)
+            return self.reply(*result)
+
+        self.reply(404, problem("ResourceNotFound", url.path))
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PATCH(self):
+        self.handle_method("PATCH")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+
+def serve(host="127.0.0.1", port=1026, **kwargs) -> ThreadingHTTPServer:
+    handler = type("FakeBrokerHandler", (Handler,), {"broker": FakeBroker(**kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Fake NGSI-LD context broker for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1026)
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="random variation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    args = parser.parse_args(argv)
+
+    server = serve(args.host, args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    print("Fake NGSI-LD broker listening on http://{}:{}".format(args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Open-loop load generator for the /injector webhook of the Dataset Registry.
+
+Requests are sent at a fixed target rate (or with Poisson arrivals) regardless of how fast the
+service answers, and latency is measured from the time each request was scheduled, so a slow
+service cannot hide its queueing delay. Every request carries a valid x-wpforms-webhook-signature.
+
+    python loadtest/fake_broker.py --latency-ms 20 &
+    python loadtest/load_generator.py http://localhost:5000/injector --form-key <form_key> \\
+        --rate 50 --duration 60 --broker-stats http://localhost:1026/stats
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def make_form(n_types: int, n_providers: int, unique: bool) -> dict:
+    type_n = random.randrange(n_types)
+    provider_n = random.randrange(n_providers)
+    form = {
+        "DatasetType": "https://smartdatamodels.org/dataModel.LoadTest/Type{}".format(type_n),
+        "DatasetTypeDescription": "Load test dataset type {}".format(type_n),
+        "DatasetCreator": "Load test creator {}".format(provider_n),
+        "DatasetProvider": "LoadTestProvider{}".format(provider_n),
+        "DatasetTypeTopic": "Environment 2abc||Transport 3abc",
+        "DatasetLanguage": "English 0abc",
+        "DatasetAccessRights": "Public 1abc",
+        "DatasetKeywords": "load, test, type{}".format(type_n),
+        "DatasetLocation": "Spain 25abc",
+        "ScorpioSatelliteURL": "https://satellite-{}.example.org".format(provider_n),
+        "DatasetIDPattern": "Type{}:.*".format(type_n),
+    }
+    if unique:
+        # Avoid the duplicate delivery short-circuit
+        form["LoadTestNonce"] = uuid.uuid4().hex
+    return form
+
+
+def sign(body: str, key: str) -> str:
+    timestamp = str(int(time.time()))
+    signature = hmac.new(key.encode("utf-8"), (timestamp + "." + body).encode("utf-8"), hashlib.sha256).hexdigest()
+    return "t={},v={}".format(timestamp, signature)
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def broker_requests(url: str) -> int:
+    return requests.get(url, timeout=5).json()["total"] if url else None
+
+
+class LoadGenerator(object):
+    def __init__(self, url, form_key, rate, duration, concurrency, n_types, n_providers, unique, poisson, timeout) -> None:
+        self.url = url
+        self.form_key = form_key
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.n_types = n_types
+        self.n_providers = n_providers
+        self.unique = unique
+        self.poisson = poisson
+        self.timeout = timeout
+        self.latencies = []
+        self.statuses = Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send(self, scheduled: float) -> None:
+        body = json.dumps(make_form(self.n_types, self.n_providers, self.unique))
+        headers = {"Content-Type": "application/json", "x-wpforms-webhook-signature": sign(body, self.form_key)}
+        try:
+            status = self.session().post(self.url, data=body, headers=headers, timeout=self.timeout).status_code
+        except requests.RequestException as err:
+            status = type(err).__name__
+        latency = time.perf_counter() - scheduled
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+
+    def run(self) -> dict:
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        start = time.perf_counter()
+        scheduled = start
+        sent = 0
+        while scheduled < start + self.duration:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(self.send, scheduled)
+            sent += 1
+            interval = random.expovariate(self.rate) if self.poisson else 1 / self.rate
+            scheduled += interval
+        executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - start
+
+        ok = sum(count for status, count in self.statuses.items() if status in (200, 201, 202))
+        return {
+            "sent": sent,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(ok / elapsed, 2),
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+            "latency_ms": {
+                name: round(percentile(self.latencies, p) * 1000, 2) if self.latencies else None
+                for name, p in (("p50", 50), ("p99", 99), ("p999", 99.9), ("max", 100))
+            },
+            "successful": ok,
+        }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the /injector webhook.")
+    parser.add_argument("url", help="URL of the /injector endpoint")
+    parser.add_argument("--form-key", required=True, help="form_key used to sign the requests")
+    parser.add_argument("--rate", type=float, default=10, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=256, help="maximum requests in flight")
+    parser.add_argument("--types", type=int, default=50, help="distinct dataset types submitted")
+    parser.add_argument("--providers", type=int, default=10, help="distinct dataset providers")
+    parser.add_argument("--duplicates", action="store_true", help="allow identical bodies (duplicate deliveries)")
+    parser.add_argument("--poisson", action="store_true", help="Poisson arrivals instead of a fixed interval")
+    parser.add_argument("--timeout", type=float, default=60, help="request timeout in seconds")
+    parser.add_argument("--broker-stats", help="stats URL of the fake broker, to count broker round trips")
+    args = parser.parse_args(argv)
+
+    generator = LoadGenerator(
+        args.url, args.form_key, args.rate, args.duration, args.concurrency,
+        args.types, args.providers, not args.duplicates, args.poisson, args.timeout,
+    )
+
+    before = broker_requests(args.broker_stats)
+    report = generator.run()
+    if args.broker_stats:
+        # Asynchronous modes may still be writing, give them a moment
+        time.sleep(1)
+        round_trips = broker_requests(args.broker_stats) - before
+        report["broker_round_trips"] = round_trips
+        report["broker_round_trips_per_submission"] = (
+            round(round_trips / report["successful"], 2) if report["successful"] else None
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
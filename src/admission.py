@@ -0,0 +1,186 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+
+
+# Submissions per second of each provider, and how many it may send at once after a pause
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 10
+# Submissions written to the broker at the same time, by all the providers: one of the 4 waitress
+# threads is left to the other endpoints
+DEFAULT_MAX_IN_FLIGHT = 3
+# Seconds a submission refused because of max_in_flight is told to wait
+DEFAULT_RETRY_AFTER = 1
+# Seconds between checks of a coroutine waiting for a slot
+POLL_INTERVAL = 0.05
+# Providers whose bucket is kept, the least recently seen ones start over with a full bucket
+DEFAULT_MAX_PROVIDERS = 10000
+
+
+class RateLimitedError(Exception):
+    def __init__(self, provider: str, retry_after: int) -> None:
+        super().__init__("Too many submissions of {}, retry after {}s".format(provider, retry_after))
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class SaturatedError(Exception):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Too many submissions in progress, retry after {}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "updated", "admitted", "limited")
+
+    def __init__(self, rate: float, burst: int, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+        self.admitted = 0
+        self.limited = 0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        # 0 when a token is taken, otherwise the seconds until the next one
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.admitted += 1
+            return 0
+        self.limited += 1
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionControl(object):
+    """Admission of the webhook submissions: a token bucket per provider and a cap on the broker work in flight.
+
+    A provider gets `rate` submissions per second, up to `burst` at once (`providers` overrides them by
+    name). At most `max_in_flight` submissions are written to the broker at the same time. A webhook
+    submission over either limit is refused straight away, with the seconds to wait before retrying,
+    instead of waiting for a thread; the queue and outbox workers wait for a slot instead.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, providers={}, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 retry_after=DEFAULT_RETRY_AFTER, max_providers=DEFAULT_MAX_PROVIDERS) -> None:
+        self.limits = {None: (rate, burst)}
+        for provider, limits in providers.items():
+            self.limits[provider] = (limits.get("rate", rate), limits.get("burst", burst))
+        for provider, (provider_rate, provider_burst) in self.limits.items():
+            if provider_rate <= 0 or provider_burst < 1:
+                raise ValueError("admission: rate must be positive and burst at least 1 ({})".format(provider or "default"))
+        if max_in_flight < 1:
+            raise ValueError("admission.max_in_flight must be at least 1")
+
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.max_providers = max_providers
+        self.in_flight = 0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.saturated = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def admit(self, provider: str) -> None:
+        # Takes a token of the provider, raises RateLimitedError when it has none left
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(provider, None)
+            if bucket is None:
+                rate, burst = self.limits.get(provider, self.limits[None])
+                bucket = self._buckets[provider] = TokenBucket(rate, burst, now)
+                while len(self._buckets) > self.max_providers:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(provider)
+            wait = bucket.take(now)
+            if wait:
+                self.rate_limited += 1
+            else:
+                self.admitted += 1
+        if wait:
+            raise RateLimitedError(provider, max(math.ceil(wait), 1))
+
+    def refund(self, provider: str) -> None:
+        # Gives back the token of a submission refused after admit(), e.g. because of max_in_flight
+        with self._lock:
+            bucket = self._buckets.get(provider, None)
+            if bucket is not None:
+                bucket.tokens = min(bucket.burst, bucket.tokens + 1)
+                bucket.admitted -= 1
+            self.admitted -= 1
+
+    def _try_acquire(self) -> bool:
+        # Caller holds the lock
+        if self.in_flight >= self.max_in_flight:
+            return False
+        self.in_flight += 1
+        return True
+
+    def acquire(self, wait: bool = False) -> None:
+        # Raises SaturatedError when max_in_flight submissions are already running, or waits for one to finish
+        with self._released:
+            while not self._try_acquire():
+                if not wait:
+                    self.saturated += 1
+                    raise SaturatedError(self.retry_after)
+                self._released.wait()
+
+    def release(self) -> None:
+        with self._released:
+            self.in_flight -= 1
+            self._released.notify()
+
+    @contextmanager
+    def slot(self, wait: bool = False):
+        # Broker work of a submission: refused (webhook) or waited for (queue and outbox workers)
+        self.acquire(wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        # slot(wait=True) for coroutines, polled so that the event loop is not blocked
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    break
+            await asyncio.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            providers = {}
+            for provider, bucket in self._buckets.items():
+                bucket.refill(now)
+                providers[provider] = {
+                    "tokens": round(bucket.tokens, 3),
+                    "rate": bucket.rate,
+                    "burst": bucket.burst,
+                    "admitted": bucket.admitted,
+                    "limited": bucket.limited,
+                }
+            return {
+                "rate": self.limits[None][0],
+                "burst": self.limits[None][1],
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rate_limited": self.rate_limited,
+                "saturated": self.saturated,
+                "providers": providers,
+            }
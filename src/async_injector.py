@@ -0,0 +1,243 @@
+import asyncio
+import json
+
+import httpx
+from ngsildclient import Entity
+from ngsildclient.model.utils import NgsiEncoder
+from ngsildclient.api.helper.csourceregistration import CSourceRegistration, RegistrationInfo
+
+from injector_ngsildclient import (
+    NgsildBrokerDataInjector,
+    SDMDCAT,
+    ENDPOINT_CSOURCEREGS,
+    entity_info_to_dict,
+    catalog_member,
+    DISTRIBUTION_SOURCE_PROPERTIES,
+)
+from upsert_batcher import BatchUpsertError
+from http_pool import create_async_client
+from locks import AsyncKeyedLocks
+from tracing import phase
+
+import logging
+log = logging.getLogger(__name__)
+
+
+ENDPOINT_ENTITIES = "ngsi-ld/v1/entities"
+ENDPOINT_UPSERT = "ngsi-ld/v1/entityOperations/upsert"
+
+
+class AsyncNgsildBrokerDataInjector(object):
+    """asyncio counterpart of NgsildBrokerDataInjector, used by the asyncio server.
+
+    Form validation, entity construction, the entity cache and the catalogue index are shared with
+    the synchronous injector `broker`; only the context broker requests are asynchronous. The
+    csource and the dataset of a submission are injected concurrently.
+    """
+
+    def __init__(self, broker: NgsildBrokerDataInjector, pool={}) -> None:
+        self.broker = broker
+        self.context = broker.context
+        self.cache = broker.cache
+        self.hashes = broker.hashes
+        self.url = broker.ngsild_api.url
+        self.client = create_async_client(pool)
+        self.pool = self.client._transport
+        # Per dataset, csource and catalogue id locks of the coroutines
+        self.locks = AsyncKeyedLocks()
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def get_entity(self, entity_id: str) -> dict:
+        r = await self.client.get(
+            "{}/{}/{}".format(self.url, ENDPOINT_ENTITIES, entity_id),
+            headers={"Link": '<{}>; rel="http://www.w3.org/ns/json-ld#context"; type="application/ld+json"'.format(self.context)},
+        )
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return r.json()
+
+    async def upsert(self, entities: list, catalog: Entity = None, members: list = ()) -> None:
+        # catalog: only given when datasets (members: their ids) have to be appended to it
+        hashes = self.hashes.changed(entities)
+        entities = [entity for entity in entities if entity.id in hashes]
+        if entities:
+            r = await self.client.post(
+                "{}/{}/".format(self.url, ENDPOINT_UPSERT),
+                params={"options": "replace"},
+                content=json.dumps(entities, cls=NgsiEncoder),
+            )
+            r.raise_for_status()
+            if r.status_code == 207 and r.json().get("errors", []):
+                raise BatchUpsertError(r.json()["errors"])
+
+        if catalog is not None:
+            await self.append_catalog_datasets(catalog, members)
+        self.hashes.remember(hashes)
+
+    async def append_attrs(self, entity_id: str, attrs: dict) -> None:
+        payload = dict(attrs)
+        payload["@context"] = self.context
+        r = await self.client.post(
+            "{}/{}/{}/attrs".format(self.url, ENDPOINT_ENTITIES, entity_id),
+            content=json.dumps(payload),
+        )
+        r.raise_for_status()
+
+    async def get_dataset(self, dataset_id: str, cached: bool = True) -> Entity:
+        id = "urn:ngsi-ld:Dataset:" + dataset_id
+        dataset = self.cache.get(id) if cached else None
+        if dataset is not None:
+            return dataset
+
+        dataset = await self.get_entity(id)
+        if dataset is None:
+            return None
+        dataset = Entity.from_dict(dataset)
+        self.cache.put(id, dataset)
+        self.hashes.put([dataset])
+        return dataset
+
+    async def create_new_dataset(self, catalog: Entity, dataset_form: dict) -> tuple:
+        with phase("get_dataset"):
+            current_dataset = await self.get_dataset(self.broker.dataset_name(catalog, dataset_form))
+        with phase("merge_dataset"):
+            dataset, distributions = self.broker.merge_dataset(catalog, dataset_form, current_dataset)
+            delta = self.broker.dataset_delta(current_dataset, dataset) if current_dataset else None
+        if delta == {}:
+            dataset = current_dataset
+        return dataset, distributions, delta
+
+    async def update_dataset(self, dataset: Entity, distributions: list, delta: dict, catalog: Entity = None) -> None:
+        if delta:
+            if any(name in delta for name in DISTRIBUTION_SOURCE_PROPERTIES):
+                await self.upsert(distributions)
+            await self.append_attrs(dataset.id, delta)
+            self.hashes.put([dataset])
+        if catalog is not None:
+            await self.append_catalog_datasets(catalog, [dataset.id])
+
+    async def inject_dataset(self, catalog: Entity, form: dict) -> tuple:
+        dataset_form = self.broker.form_validate_dataset(form)
+
+        async with self.locks.hold("urn:ngsi-ld:Dataset:" + self.broker.dataset_name(catalog, dataset_form)):
+            dataset, distributions, delta = await self.create_new_dataset(catalog, dataset_form)
+
+            # Membership changes do not await, the threading lock of the catalogue is held briefly
+            new_member = self.broker.add_catalog_dataset(catalog, dataset.id)
+
+            try:
+                with phase("upsert"):
+                    if delta is None:
+                        await self.upsert(distributions + [dataset], catalog if new_member else None, [dataset.id])
+                    else:
+                        await self.update_dataset(dataset, distributions, delta, catalog if new_member else None)
+            except Exception:
+                if new_member:
+                    self.broker.remove_catalog_dataset(catalog, dataset.id)
+                raise
+            if delta is None or delta:
+                self.cache.put(dataset.id, dataset)
+
+        return dataset, distributions
+
+    async def append_catalog_datasets(self, catalog: Entity, dataset_ids: list) -> None:
+        # Only the new members are sent, each as its own instance of the dataset relationship
+        await self.append_attrs(catalog.id, {
+            str(SDMDCAT["dataset"]): [catalog_member(dataset_id) for dataset_id in dataset_ids],
+        })
+        # Membership is kept by catalog_index, a copy of the whole catalogue is not cached on every append
+        self.cache.invalidate(catalog.id)
+
+    async def get_csource(self, csource_id: str, cached: bool = True) -> CSourceRegistration:
+        csource = self.cache.get(csource_id) if cached else None
+        if csource is None:
+            r = await self.client.get("{}/{}/{}".format(self.url, ENDPOINT_CSOURCEREGS, csource_id))
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            csource = r.json()
+            self.cache.put(csource_id, csource)
+        return CSourceRegistration.from_dict(csource)
+
+    async def register_csource(self, csource_id: str, endpoint: str, entities: list) -> dict:
+        csource = self.broker.create_new_csource(csource_id, [entity_info_to_dict(e) for e in entities], endpoint)
+        payload = dict(csource)
+        payload["@context"] = [self.context]
+        r = await self.client.post("{}/{}".format(self.url, ENDPOINT_CSOURCEREGS), content=json.dumps(payload))
+        r.raise_for_status()
+
+        self.cache.put(csource_id, csource)
+        return csource
+
+    async def patch_csource(self, csource_id: str, endpoint: str, entities: list) -> dict:
+        entities = [entity_info_to_dict(e) for e in entities]
+        payload = {
+            "information": [{"entities": entities}],
+            "endpoint": endpoint,
+            "@context": [self.context],
+        }
+        r = await self.client.patch(
+            "{}/{}/{}".format(self.url, ENDPOINT_CSOURCEREGS, csource_id),
+            content=json.dumps(payload),
+        )
+        r.raise_for_status()
+
+        csource = self.broker.create_new_csource(csource_id, entities, endpoint)
+        self.cache.put(csource_id, csource)
+        return csource
+
+    async def update_csource(self, csource_id: str, endpoint: str, entities: list) -> dict:
+        try:
+            return await self.patch_csource(csource_id, endpoint, entities)
+        except httpx.HTTPStatusError as err:
+            if err.response.status_code not in (405, 501):
+                raise
+        log.warning("Context broker does not support cSourceRegistration PATCH")
+        await self.delete_csource(csource_id)
+        return await self.register_csource(csource_id, endpoint, entities)
+
+    async def delete_csource(self, csource_id: str) -> None:
+        self.cache.invalidate(csource_id)
+        r = await self.client.delete("{}/{}/{}".format(self.url, ENDPOINT_CSOURCEREGS, csource_id))
+        r.raise_for_status()
+
+    async def inject_csource(self, form) -> CSourceRegistration:
+        csource_form = self.broker.form_validate_csource(form)
+        entity_info = RegistrationInfo.EntityInfo(
+            type = csource_form["entity"]["type"],
+            id_pattern = csource_form["entity"]["idPattern"],
+        )
+
+        async with self.locks.hold(csource_form["id"]):
+            with phase("get_csource"):
+                csource = await self.get_csource(csource_form["id"])
+
+            if csource is None:
+                with phase("register_csource"):
+                    return CSourceRegistration.from_dict(
+                        await self.register_csource(csource_form["id"], csource_form["endpoint"], [entity_info])
+                    )
+
+            entities = csource.information[0].entities
+            if not any(csource_form["entity"]["type"] == e.type for e in entities):
+                with phase("update_csource"):
+                    csource = CSourceRegistration.from_dict(
+                        await self.update_csource(csource_form["id"], csource_form["endpoint"], entities + [entity_info])
+                    )
+        return csource
+
+    async def inject_form(self, catalog: Entity, form: dict) -> tuple:
+        # The csource registration and the dataset/distributions touch disjoint broker resources
+        async def inject_csource():
+            with phase("inject_csource"):
+                return await self.inject_csource(form)
+
+        async def inject_dataset():
+            with phase("inject_dataset"):
+                return await self.inject_dataset(catalog, form)
+
+        csource, (dataset, distributions) = await asyncio.gather(inject_csource(), inject_dataset())
+        return csource, dataset, distributions
@@ -0,0 +1,460 @@
+"""asyncio serving mode of the Dataset Registry (aiohttp server and asynchronous broker client).
+
+It reads the same config.json and exposes the same endpoints as dataset_registry_module.py, but
+every submission is a coroutine instead of a thread, and its csource and dataset are injected
+concurrently. Many slow broker calls can be in flight without a thread each.
+
+    python async_server.py
+"""
+import time
+# Cold start is measured from here, before the heavy imports
+STARTED = time.perf_counter()
+
+import asyncio
+import hmac
+import json
+import re
+from collections import deque
+from contextlib import nullcontext
+
+from aiohttp import web
+
+import dataset_registry_module as registry
+from config import load_config
+from dataset_registry_module import (
+    is_valid_signature,
+    strip_form,
+    parse_search,
+    dataset_urn,
+    catalog_urn,
+    create_outbox,
+    create_admission,
+    PORT,
+)
+from admission import RateLimitedError, SaturatedError
+from outbox import OutboxFullError
+from async_injector import AsyncNgsildBrokerDataInjector
+from form_schema import parse_form, FormValidationError
+from ingestion_queue import AsyncIngestionQueue, QueueFullError, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE
+from dedup import (
+    DeliveryDeduplicator,
+    DEFAULT_MAX_ENTRIES as DEFAULT_DEDUP_ENTRIES,
+    DEFAULT_WINDOW as DEFAULT_DEDUP_WINDOW,
+    DEFAULT_WAIT as DEFAULT_DEDUP_WAIT,
+)
+from metrics import REGISTRY, REQUESTS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT
+from tracing import TRACER, phase, DEFAULT_SAMPLE_RATE, DEFAULT_MAX_TRACES
+from reconcile import ReconciliationBusyError
+from dcat_export import FORMATS, serialise, etag, etag_matches
+from profiler import ProfilerBusyError, DEFAULT_MAX_SECONDS as DEFAULT_MAX_PROFILE_SECONDS
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Set up by main()
+async_broker: AsyncNgsildBrokerDataInjector = None
+ingestion_queue: AsyncIngestionQueue = None
+
+
+def to_response(response: tuple) -> web.Response:
+    # (body, status, headers) as returned by the Flask views and kept by the deduplicator
+    body, status, headers = response
+    return web.Response(body=body, status=status, headers=headers)
+
+
+def validate_signature(request, body: str) -> None:
+    header_signature = request.headers.get("x-wpforms-webhook-signature")
+    if header_signature is None:
+        raise web.HTTPUnauthorized(text="Missing signature")
+
+    header_signature = dict(re.findall(r"(\w+)=(\w+)", header_signature))
+    if not is_valid_signature(header_signature["t"], body, header_signature["v"], registry.form_key):
+        raise web.HTTPUnauthorized(text="Invalid signature")
+
+
+@web.middleware
+async def request_metrics(request, handler):
+    route = request.match_info.route.resource
+    endpoint = route.canonical if route is not None else "unmatched"
+    status = "500"
+    start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    try:
+        response = await handler(request)
+        status = str(response.status)
+        return response
+    except web.HTTPException as err:
+        status = str(err.status)
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        REQUESTS.inc(endpoint, status)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint)
+
+
+async def inject_form(form: dict) -> list:
+    with TRACER.trace("inject_form"):
+        # A catalogue not used yet is injected with the synchronous client, in its own thread
+        catalog = registry.catalogs.route_form(form, create=False)
+        if catalog is None:
+            catalog = await asyncio.to_thread(registry.catalogs.route_form, form)
+        csource, dataset, distributions = await async_broker.inject_form(catalog, form)
+    registry.index.put_dataset(catalog.id, dataset, distributions)
+
+    # Ids of the entities written
+    return [csource.id, dataset.id] + [distribution.id for distribution in distributions] + [catalog.id]
+
+
+async def form_to_ngsild(request):
+    if registry.catalog is None and registry.outbox is None:
+        return web.json_response(
+            {"description": "Service not ready, try again later."}, status=503, headers={"Retry-After": "5"},
+        )
+
+    with TRACER.trace("POST /injector"):
+        body = await request.text()
+        with phase("signature"):
+            validate_signature(request, body)
+
+        if request.content_type != "application/json":
+            raise web.HTTPUnsupportedMediaType(text="Content type is not supported.")
+        try:
+            form = strip_form(json.loads(body))
+        except ValueError:
+            raise web.HTTPBadRequest(text="Failed to decode JSON object")
+
+        try:
+            with phase("parse_form"):
+                record = parse_form(form)
+        except FormValidationError as err:
+            return web.json_response({"description": "Invalid form", "errors": err.errors}, status=400)
+
+        deduplicator = registry.deduplicator
+        if deduplicator is None:
+            return to_response(await handle_form(record, form))
+
+        key = deduplicator.key(body)
+        with phase("deduplication"):
+            # It may wait for a duplicate being processed, and reads the SQLite store
+            response = await asyncio.to_thread(deduplicator.begin, key)
+        if response is not None:
+            log.info("Duplicate delivery %s", key)
+            return to_response(response)
+
+        try:
+            response = await handle_form(record, form)
+        except BaseException:
+            deduplicator.cancel(key)
+            raise
+        await asyncio.to_thread(deduplicator.end, key, response)
+        return to_response(response)
+
+
+async def queued_form(form: dict) -> list:
+    # Job of the ingestion queue, waits for a slot under admission.max_in_flight
+    if registry.admission is None:
+        return await inject_form(form)
+    async with registry.admission.async_slot():
+        return await inject_form(form)
+
+
+async def handle_form(record: dict, form: dict) -> tuple:
+    admission = registry.admission
+    if admission is not None:
+        try:
+            admission.admit(record["DatasetProvider"])
+        except RateLimitedError as err:
+            log.info("%s", err)
+            raise web.HTTPTooManyRequests(
+                text="Too many submissions of this provider, try again later.",
+                headers={"Retry-After": str(err.retry_after)},
+            )
+
+    if registry.outbox is not None:
+        try:
+            with phase("outbox"):
+                # SQLite commit, off the event loop
+                entry = await asyncio.to_thread(registry.outbox.append, form)
+        except OutboxFullError:
+            if admission is not None:
+                admission.refund(record["DatasetProvider"])
+            raise web.HTTPServiceUnavailable(text="Too many pending submissions, try again later.", headers={"Retry-After": "5"})
+        return (
+            json.dumps(entry),
+            202,
+            {"Location": "/jobs/" + entry["id"], "Content-Type": "application/json"},
+        )
+
+    form = record
+    if ingestion_queue is None:
+        try:
+            with admission.slot() if admission is not None else nullcontext():
+                await inject_form(form)
+        except SaturatedError as err:
+            # Refused before any broker work, the provider keeps its token
+            admission.refund(record["DatasetProvider"])
+            raise web.HTTPServiceUnavailable(
+                text="Too many submissions in progress, try again later.",
+                headers={"Retry-After": str(err.retry_after)},
+            )
+        return ("", 201, {})
+
+    try:
+        job = ingestion_queue.submit(form)
+    except QueueFullError:
+        if admission is not None:
+            admission.refund(record["DatasetProvider"])
+        raise web.HTTPServiceUnavailable(text="Too many pending submissions, try again later.", headers={"Retry-After": "5"})
+    return (
+        json.dumps(job.to_dict()),
+        202,
+        {"Location": "/jobs/" + job.id, "Content-Type": "application/json"},
+    )
+
+
+async def job_status(request):
+    if registry.outbox is not None:
+        entry = await asyncio.to_thread(registry.outbox.get, request.match_info["job_id"])
+        if entry is None:
+            raise web.HTTPNotFound(text="Unknown job.")
+        return web.json_response(entry)
+
+    if ingestion_queue is None:
+        raise web.HTTPNotFound(text="Asynchronous ingestion is not enabled.")
+
+    job = ingestion_queue.get(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound(text="Unknown job.")
+    return web.json_response(job.to_dict())
+
+
+async def get_catalogue(request):
+    payload = registry.index.catalog(registry.catalog.id) if registry.catalog is not None else None
+    if payload is None:
+        raise web.HTTPServiceUnavailable(text="Service not ready, try again later.")
+    return web.json_response(payload)
+
+
+async def export_catalogue(request):
+    extension = request.match_info["extension"]
+    if extension not in FORMATS:
+        raise web.HTTPNotFound()
+    if registry.catalog is None:
+        raise web.HTTPServiceUnavailable(text="Service not ready, try again later.")
+    index = registry.index
+    current = etag(index.epoch, index.version)
+    if etag_matches(request.headers.get("If-None-Match", None), current):
+        return web.Response(status=304, headers={"ETag": current})
+
+    version, catalogs, datasets = index.snapshot(registry.catalog.id)
+    response = web.StreamResponse(headers={"ETag": etag(index.epoch, version), "Content-Type": FORMATS[extension]})
+    await response.prepare(request)
+    # Each chunk is sent before the next one is serialised
+    for chunk in serialise(extension, catalogs, datasets):
+        await response.write(chunk.encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def get_catalogues(request):
+    return web.json_response(registry.index.list_catalogs())
+
+
+async def get_catalogue_by_id(request):
+    payload = registry.index.catalog(catalog_urn(request.match_info["catalog_id"]))
+    if payload is None:
+        raise web.HTTPNotFound(text="Unknown catalogue.")
+    return web.json_response(payload)
+
+
+async def get_datasets(request):
+    try:
+        filters, offset, limit = parse_search({key: request.query.getall(key) for key in request.query.keys()})
+    except ValueError as err:
+        raise web.HTTPBadRequest(text=str(err))
+    catalog_id = request.query.get("catalog", None)
+    catalog_id = catalog_urn(catalog_id) if catalog_id else None
+    return web.json_response(registry.index.search(filters, catalog_id=catalog_id, offset=offset, limit=limit))
+
+
+async def get_dataset(request):
+    dataset = registry.index.dataset(dataset_urn(request.match_info["dataset_id"]))
+    if dataset is None:
+        raise web.HTTPNotFound(text="Unknown dataset.")
+    return web.json_response(dataset)
+
+
+async def stats(request):
+    return web.json_response({
+        "cache": async_broker.cache.stats() if async_broker is not None else None,
+        "pool": async_broker.pool.stats() if async_broker is not None else None,
+        "change_detection": async_broker.hashes.stats() if async_broker is not None else None,
+        "deduplication": registry.deduplicator.stats() if registry.deduplicator is not None else None,
+        "outbox": registry.outbox.stats() if registry.outbox is not None else None,
+        "index": registry.index.stats(),
+        "reconciliation": registry.reconciler.stats() if registry.reconciler is not None else None,
+        "admission": registry.admission.stats() if registry.admission is not None else None,
+    })
+
+
+async def ready(request):
+    status = registry.bootstrap.status() if registry.bootstrap is not None else {"ready": False}
+    status["startup"] = {phase: round(seconds, 3) for phase, seconds in registry.startup.items()}
+    return web.json_response(status, status=200 if registry.catalog is not None else 503)
+
+
+async def metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+def validate_debug_token(request) -> None:
+    if not registry.debug_token:
+        raise web.HTTPNotFound()
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + registry.debug_token):
+        raise web.HTTPUnauthorized(text="Invalid debug token")
+
+
+async def reconcile(request):
+    validate_debug_token(request)
+    if registry.reconciler is None:
+        raise web.HTTPServiceUnavailable(text="Service not ready, try again later.")
+    try:
+        # Full scan with the synchronous client, in its own thread
+        report = await asyncio.to_thread(registry.reconciler.run, request.query.get("repair", "false").lower() == "true")
+    except ReconciliationBusyError:
+        raise web.HTTPConflict(text="A reconciliation is already running.")
+    return web.json_response(report)
+
+
+async def debug_traces(request):
+    validate_debug_token(request)
+    limit = request.query.get("limit", None)
+    return web.json_response({
+        "sample_rate": TRACER.sample_rate,
+        "traces": TRACER.recent(int(limit) if limit else None),
+    })
+
+
+async def debug_trace(request):
+    validate_debug_token(request)
+    trace = TRACER.get(request.match_info["trace_id"])
+    if trace is None:
+        raise web.HTTPNotFound(text="Unknown trace.")
+    return web.json_response(trace)
+
+
+async def debug_profile(request):
+    validate_debug_token(request)
+    seconds = float(request.query.get("seconds", 10))
+    if seconds <= 0:
+        raise web.HTTPBadRequest(text="seconds must be positive")
+    try:
+        # The event loop keeps serving (and being sampled) meanwhile
+        profile = await asyncio.to_thread(registry.profiler.profile, seconds)
+    except ProfilerBusyError:
+        raise web.HTTPConflict(text="A profile is already running.")
+    return web.Response(text=profile, content_type="text/plain", charset="utf-8")
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[request_metrics])
+    app.router.add_post("/injector", form_to_ngsild)
+    app.router.add_get("/jobs/{job_id}", job_status)
+    app.router.add_get("/catalogue", get_catalogue)
+    app.router.add_get("/catalogue.{extension}", export_catalogue)
+    app.router.add_get("/catalogues", get_catalogues)
+    app.router.add_get("/catalogues/{catalog_id}", get_catalogue_by_id)
+    app.router.add_get("/datasets", get_datasets)
+    app.router.add_get("/datasets/{dataset_id}", get_dataset)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_post("/reconcile", reconcile)
+    app.router.add_get("/debug/traces", debug_traces)
+    app.router.add_get("/debug/traces/{trace_id}", debug_trace)
+    app.router.add_get("/debug/profile", debug_profile)
+    return app
+
+
+def main() -> None:
+    registry.STARTED = STARTED
+    registry.startup["imports"] = time.perf_counter() - STARTED
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    conf, dcat_entities = load_config()
+    registry.conf = conf
+
+    registry.form_key = conf.get("form_key", None)
+    if not registry.form_key:
+        raise ValueError("Form key not provided")
+
+    port = conf.get("port", PORT)
+
+    ingestion = conf.get("ingestion", {})
+
+    deduplication = conf.get("deduplication", {})
+
+    debug = conf.get("debug", {})
+    registry.debug_token = debug.get("token", "")
+    TRACER.sample_rate = debug.get("trace_sample_rate", DEFAULT_SAMPLE_RATE)
+    TRACER.traces = deque(maxlen=debug.get("max_traces", DEFAULT_MAX_TRACES))
+    registry.profiler.max_seconds = debug.get("max_profile_seconds", DEFAULT_MAX_PROFILE_SECONDS)
+
+    if conf["context_broker"].get("batching", None):
+        log.warning("Upsert batching is not used in asyncio mode")
+        conf["context_broker"].pop("batching")
+
+    def set_ready(broker, catalog):
+        global async_broker
+        async_broker = AsyncNgsildBrokerDataInjector(broker, pool=conf["context_broker"].get("pool", {}))
+        # /stats and /metrics report the connection pool actually used
+        broker.pool = async_broker.pool
+        registry.set_ready(broker, catalog)
+
+    # Replayed with the synchronous client, in its own thread
+    registry.outbox = create_outbox(conf)
+    registry.admission = create_admission(conf)
+
+    # Catalogue set up with the synchronous client in the background, while serving
+    registry.bootstrap = registry.start_bootstrap(conf, dcat_entities, on_ready=set_ready)
+
+    if deduplication.get("enabled", True):
+        registry.deduplicator = DeliveryDeduplicator(
+            max_entries=deduplication.get("max_entries", DEFAULT_DEDUP_ENTRIES),
+            window=deduplication.get("window", DEFAULT_DEDUP_WINDOW),
+            store=deduplication.get("store", None),
+            wait=deduplication.get("wait", DEFAULT_DEDUP_WAIT),
+        )
+
+    app = create_app()
+
+    async def start_ingestion(app):
+        global ingestion_queue
+        if registry.outbox is not None:
+            log.info("Submissions are acknowledged once written to the outbox %s", registry.outbox.path)
+        elif ingestion.get("asynchronous", False):
+            ingestion_queue = AsyncIngestionQueue(
+                queued_form,
+                workers=ingestion.get("workers", DEFAULT_WORKERS),
+                queue_size=ingestion.get("queue_size", DEFAULT_QUEUE_SIZE),
+            )
+            ingestion_queue.start()
+            log.info("Asynchronous ingestion enabled with %d workers", ingestion_queue.workers)
+
+    async def close_broker(app):
+        if async_broker is not None:
+            await async_broker.close()
+
+    async def log_serving(app):
+        registry.startup["serving"] = time.perf_counter() - STARTED
+        log.info("Imports took %.3fs, serving after %.3fs", registry.startup["imports"], registry.startup["serving"])
+
+    app.on_startup.append(start_ingestion)
+    app.on_startup.append(log_serving)
+    app.on_cleanup.append(close_broker)
+    web.run_app(app, host="0.0.0.0", port=port)
+
+
+if __name__ == "__main__":
+    main()
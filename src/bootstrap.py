@@ -0,0 +1,99 @@
+import os
+import random
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_INITIAL_DELAY = 1
+DEFAULT_MAX_DELAY = 60
+
+
+def exit_process(err: Exception) -> None:
+    # The bootstrap thread cannot stop the server itself, which would otherwise answer 503 forever
+    logging.shutdown()
+    os._exit(1)
+
+
+class CatalogBootstrap(object):
+    """Connects to the broker and injects the catalogue in a background thread, retrying with exponential
+    backoff while the broker is unreachable.
+
+    The service starts serving right away; `on_ready` is called with the broker injector and the
+    catalogue once both are available. If `on_ready` fails the service could never become ready, so
+    `on_failure(error)` is called, which by default exits the process to be restarted (docker restart policy).
+    """
+
+    def __init__(self, connect, catalog_name: str, on_ready=None, started: float = None,
+                 initial_delay=DEFAULT_INITIAL_DELAY, max_delay=DEFAULT_MAX_DELAY, on_failure=None) -> None:
+        # connect() --> NgsildBrokerDataInjector, the NGSI-LD client already fails when created without a broker
+        # started: time.perf_counter() of the process start, for the cold start time
+        self.connect = connect
+        self.broker = None
+        self.catalog_name = catalog_name
+        self.on_ready = on_ready
+        self.on_failure = on_failure or exit_process
+        self.started = started if started is not None else time.perf_counter()
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.catalog = None
+        self.attempts = 0
+        self.last_error = None
+        self.ready_seconds = None
+        self._ready = threading.Event()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name="catalog-bootstrap", daemon=True).start()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def _run(self) -> None:
+        delay = self.initial_delay
+        while True:
+            self.attempts += 1
+            try:
+                if self.broker is None:
+                    self.broker = self.connect()
+                catalog = self.broker.inject_catalog(self.catalog_name)
+                if catalog is None:
+                    raise RuntimeError("Catalog {} not injected".format(self.catalog_name))
+                break
+            except Exception as err:
+                self.last_error = repr(err)
+                # Jitter, so that restarted replicas do not retry in lockstep
+                wait = random.uniform(delay / 2, delay)
+                log.warning(
+                    "Catalog bootstrap attempt %d failed (%r), retrying in %.1fs", self.attempts, err, wait,
+                )
+            time.sleep(wait)
+            delay = min(delay * 2, self.max_delay)
+
+        self.catalog = catalog
+        self.last_error = None
+        self.ready_seconds = time.perf_counter() - self.started
+        log.info("Catalog created/available %s (ready %.3fs after start)", catalog.id, self.ready_seconds)
+        if self.on_ready is not None:
+            try:
+                self.on_ready(self.broker, catalog)
+            except Exception as err:
+                self.last_error = repr(err)
+                log.exception("Catalog bootstrap failed once the catalog was available")
+                self.on_failure(err)
+                return
+        self._ready.set()
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "catalog": self.catalog.id if self.catalog is not None else None,
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+            "ready_seconds": round(self.ready_seconds, 3) if self.ready_seconds is not None else None,
+        }
@@ -0,0 +1,277 @@
+"""Offline bulk import of historical form submissions into the context broker.
+
+Submissions are read from a JSONL (one form per line) or CSV (one form per row, WPForms field
+names as header) export. They are grouped by dataset and merged locally, so every dataset and
+csource is written once, and the resulting entities are upserted in chunks by parallel workers.
+
+    python bulk_import.py submissions.jsonl --checkpoint submissions.checkpoint
+
+Datasets and csources already written are recorded in the checkpoint file, so running the same
+command again after an interruption continues where the import stopped.
+
+Datasets the broker already has are read again and only their changed attributes are written, so the
+import can run next to the service. The service keeps its cached copy of a dataset for up to
+`context_broker.cache.ttl` seconds though, and a submission of an imported dataset in the meantime can
+undo what the import merged into it: stop the service during large imports of existing datasets.
+"""
+import argparse
+import csv
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ngsildclient.api.helper.csourceregistration import RegistrationInfo
+
+from config import load_config, create_broker, create_catalogs
+from injector_ngsildclient import RESOURCE_TYPES
+from form_schema import parse_form, FormValidationError
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_WORKERS = 4
+
+
+def read_submissions(filename: str):
+    with open(filename, newline="") as f:
+        if filename.lower().endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+
+        for form in rows:
+            # Same as the webhook: strip all fields
+            yield {key: value.strip() for key, value in form.items() if isinstance(value, str)}
+
+
+class Checkpoint(object):
+    """Append-only record of the csource and dataset ids already written."""
+
+    def __init__(self, filename: str = None) -> None:
+        self.filename = filename
+        self.done = set()
+        self._lock = threading.Lock()
+        if filename:
+            try:
+                with open(filename) as f:
+                    self.done.update(line.strip() for line in f if line.strip())
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.done
+
+    def add(self, keys: list) -> None:
+        with self._lock:
+            self.done.update(keys)
+            if self.filename:
+                with open(self.filename, "a") as f:
+                    f.writelines(key + "\n" for key in keys)
+
+
+class BulkImporter(object):
+    def __init__(self, broker, catalogs, chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS, checkpoint=None) -> None:
+        # catalogs: CatalogShards, each submission is written to the catalogue it is routed to
+        self.broker = broker
+        self.catalogs = catalogs
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.checkpoint = checkpoint or Checkpoint()
+        self._lock = threading.Lock()
+        self.stats = {"submissions": 0, "invalid": 0, "csources": 0, "datasets": 0, "skipped": 0, "unchanged": 0, "failed": 0}
+
+    def group(self, forms) -> tuple:
+        # dataset id --> (catalog, [dataset_form, ...]), csource id --> {"endpoint", "entities": {type: idPattern}}
+        datasets = OrderedDict()
+        csources = OrderedDict()
+        for form in forms:
+            self.stats["submissions"] += 1
+            try:
+                form = parse_form(form)
+                csource_form = self.broker.form_validate_csource(form)
+                dataset_form = self.broker.form_validate_dataset(form)
+            except FormValidationError as err:
+                self.stats["invalid"] += 1
+                log.warning("Skipping invalid submission %d: %r", self.stats["submissions"], err)
+                continue
+
+            csource = csources.setdefault(csource_form["id"], {"endpoint": None, "entities": OrderedDict()})
+            csource["endpoint"] = csource_form["endpoint"]
+            csource["entities"].setdefault(csource_form["entity"]["type"], csource_form["entity"]["idPattern"])
+
+            catalog = self.catalogs.route_form(form)
+            dataset_id = "urn:ngsi-ld:Dataset:" + self.broker.dataset_name(catalog, dataset_form)
+            datasets.setdefault(dataset_id, (catalog, []))[1].append(dataset_form)
+        return datasets, csources
+
+    def import_csource(self, csource_id: str, csource: dict) -> None:
+        entities = [
+            RegistrationInfo.EntityInfo(type=type_, id_pattern=id_pattern)
+            for type_, id_pattern in csource["entities"].items()
+        ]
+        current = self.broker.get_csource(csource_id)
+        if current is None:
+            self.broker.register_csource(csource_id, csource["endpoint"], entities)
+            return
+
+        registered = current.information[0].entities
+        new = [e for e in entities if not any(e.type == r.type for r in registered)]
+        if new:
+            self.broker.update_csource(csource_id, csource["endpoint"], registered + new)
+
+    def merge_dataset(self, catalog, dataset_forms: list) -> tuple:
+        # Fold all the submissions of a dataset, starting from what the broker has right now
+        # --> dataset, distributions, delta (None for new datasets)
+        current = self.broker.get_dataset(self.broker.dataset_name(catalog, dataset_forms[0]), cached=False)
+        dataset = current
+        for dataset_form in dataset_forms:
+            dataset, distributions = self.broker.merge_dataset(catalog, dataset_form, dataset)
+        delta = self.broker.dataset_delta(current, dataset) if current else None
+        return dataset, distributions, delta
+
+    def upsert_chunk(self, chunk: list) -> list:
+        # chunk: [(dataset id, (catalog, [dataset_form, ...])), ...] --> dataset ids written
+        # The running service does not share the locks of this process: new datasets are batch upserted,
+        # existing ones only get the attributes that changed, as the webhook does
+        merged = []
+        for dataset_id, (catalog, dataset_forms) in chunk:
+            merged.append((dataset_id, catalog) + self.merge_dataset(catalog, dataset_forms))
+
+        entities = [
+            entity for dataset_id, catalog, dataset, distributions, delta in merged if delta is None
+            for entity in distributions + [dataset]
+        ]
+        # Entities the broker already has (e.g. an import run again) are not written
+        hashes = self.broker.hashes.changed(entities)
+        entities = [entity for entity in entities if entity.id in hashes]
+        result = self.broker.ngsild_api.upsert(entities) if entities else None
+        failed = {error.get("entityId") for error in getattr(result, "errors", [])}
+        self.broker.hashes.remember({
+            entity_id: digest for entity_id, digest in hashes.items() if entity_id not in failed
+        })
+
+        written = OrderedDict()
+        for dataset_id, catalog, dataset, distributions, delta in merged:
+            if delta is None and any(entity.id in failed for entity in distributions + [dataset]):
+                log.error("Dataset %s could not be written", dataset_id)
+                continue
+            if delta:
+                try:
+                    self.broker.update_dataset(dataset, distributions, delta)
+                except Exception as err:
+                    log.error("Dataset %s could not be updated: %r", dataset_id, err)
+                    continue
+            if delta == {}:
+                # Nothing new, the broker (and the cache) already have the dataset
+                with self._lock:
+                    self.stats["unchanged"] += 1 + len(distributions)
+            else:
+                self.broker.cache.put(dataset_id, dataset)
+            written[dataset_id] = catalog
+
+        # Catalogue membership of the datasets written, before they are checkpointed
+        members = OrderedDict()
+        for dataset_id, catalog in written.items():
+            members.setdefault(catalog.id, (catalog, []))[1].append(dataset_id)
+        for catalog, dataset_ids in members.values():
+            new_members = [dataset_id for dataset_id in dataset_ids if self.broker.add_catalog_dataset(catalog, dataset_id)]
+            if new_members:
+                try:
+                    self.broker.append_catalog_datasets(catalog, new_members)
+                except Exception:
+                    for dataset_id in new_members:
+                        self.broker.remove_catalog_dataset(catalog, dataset_id)
+                    raise
+        return list(written)
+
+    def chunks(self, datasets: OrderedDict):
+        # A dataset is written along with a distribution per resource type
+        chunk, size = [], 0
+        for dataset_id, dataset in datasets.items():
+            chunk.append((dataset_id, dataset))
+            size += 1 + len(RESOURCE_TYPES)
+            if size >= self.chunk_size:
+                yield chunk
+                chunk, size = [], 0
+        if chunk:
+            yield chunk
+
+    def run(self, forms) -> dict:
+        start = time.monotonic()
+        unchanged = self.broker.hashes.skipped
+        datasets, csources = self.group(forms)
+
+        csources = OrderedDict((k, v) for k, v in csources.items() if k not in self.checkpoint)
+        pending = OrderedDict((k, v) for k, v in datasets.items() if k not in self.checkpoint)
+        self.stats["skipped"] = len(datasets) - len(pending)
+        log.info(
+            "%d submissions: %d datasets (%d already imported), %d csources to import",
+            self.stats["submissions"], len(datasets), self.stats["skipped"], len(csources),
+        )
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.import_csource, k, v): k for k, v in csources.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    self.checkpoint.add([futures[future]])
+                    self.stats["csources"] += 1
+                except Exception as err:
+                    self.stats["failed"] += 1
+                    log.error("CSource %s could not be written: %r", futures[future], err)
+
+            upserts = [executor.submit(self.upsert_chunk, chunk) for chunk in self.chunks(pending)]
+            for future in as_completed(upserts):
+                try:
+                    written = future.result()
+                except Exception as err:
+                    log.error("Chunk could not be written: %r", err)
+                    continue
+                self.checkpoint.add(written)
+                self.stats["datasets"] += len(written)
+                log.info(
+                    "Imported %d/%d datasets (%.1f datasets/s)",
+                    self.stats["datasets"], len(pending), self.stats["datasets"] / (time.monotonic() - start),
+                )
+        self.stats["failed"] += len(pending) - self.stats["datasets"]
+        # Entities not written because the broker already had them
+        self.stats["unchanged"] += self.broker.hashes.skipped - unchanged
+
+        self.stats["seconds"] = round(time.monotonic() - start, 3)
+        return self.stats
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk import of historical form submissions.")
+    parser.add_argument("submissions", help="JSONL or CSV export of the form submissions")
+    parser.add_argument("--config", default="config.json", help="configuration file (default: config.json)")
+    parser.add_argument("--checkpoint", default=None, help="file recording the progress, to resume interrupted imports")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="entities per batch upsert")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="parallel broker requests")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    conf, dcat_entities = load_config(args.config)
+    broker = create_broker(conf, dcat_entities)
+    catalog = broker.inject_catalog(dcat_entities["catalog"]["name"])
+
+    importer = BulkImporter(
+        broker,
+        create_catalogs(conf, broker, catalog),
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        checkpoint=Checkpoint(args.checkpoint),
+    )
+    stats = importer.run(read_submissions(args.submissions))
+    print(json.dumps(stats))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
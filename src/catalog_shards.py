@@ -0,0 +1,133 @@
+import re
+import threading
+
+from ngsildclient import Entity
+
+from injector_ngsildclient import NgsildBrokerDataInjector, SDMDCAT, relationship_objects, entity_name_type_from_id
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Catalogues created for unmapped values (dedicated), the values beyond it go to the parent
+DEFAULT_MAX_CATALOGS = 100
+# Characters of a catalogue name: it ends up in entity ids and broker URLs, and ":" separates the parts of the ids
+UNSAFE_CHARACTERS = re.compile(r"[^A-Za-z0-9_-]+")
+VALID_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def shard_name(value: str) -> str:
+    # Free text (e.g. a provider) as a catalogue name, other characters replaced by "-", None when nothing is left
+    name = UNSAFE_CHARACTERS.sub("-", value.strip()).strip("-") if value else None
+    return name or None
+
+
+def check_catalog_names(catalogs: dict) -> None:
+    # catalogs: field value --> catalogue name, raises ValueError
+    if not isinstance(catalogs, dict):
+        raise ValueError("sharding.catalogs must map field values to catalogue names")
+    for name in catalogs.values():
+        if not isinstance(name, str) or not VALID_NAME.match(name):
+            raise ValueError("sharding.catalogs: invalid catalogue name {!r}, only letters, digits, _ and - are allowed".format(name))
+
+
+def route_value(form: dict, field: str) -> str:
+    # Value of a parsed form field as a catalogue name: first of a list, name of a data model type
+    value = form.get(field, None)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return shard_name(getattr(value, "name", value))
+
+
+class CatalogShards(object):
+    """Catalogues of the registry, chosen per submission by the value of a form field (`route`).
+
+    `catalogs` maps field values to catalogue names; other values get a catalogue of their own named
+    after the value when `dedicated` (up to `max_catalogs`), the `parent` catalogue otherwise. Every catalogue is its own
+    entity with its own membership (broker.catalog_index) and lock (broker.locks, keyed by its id),
+    so submissions of different catalogues never contend. With `link`, the parent lists its shards
+    through its SDMDCAT.catalog relationship.
+
+    Catalogues are injected on first use; `on_created(catalog)` is called once for each of them.
+    """
+
+    def __init__(self, broker: NgsildBrokerDataInjector, parent: Entity, route: str = None, catalogs: dict = {},
+                 dedicated: bool = False, link: bool = True, on_created=None, max_catalogs=DEFAULT_MAX_CATALOGS) -> None:
+        self.broker = broker
+        self.parent = parent
+        self.route = route
+        check_catalog_names(catalogs)
+        self.mapping = {shard_name(value): name for value, name in catalogs.items()}
+        self.dedicated = dedicated
+        self.max_catalogs = max_catalogs
+        self.link = link
+        self.on_created = on_created
+        parent_name, parent_type = entity_name_type_from_id(parent.id)
+        # Catalogue name --> entity
+        self._catalogs = {parent_name: parent}
+        # Shards already listed by the parent
+        self._linked = set(relationship_objects(parent.to_dict().get(str(SDMDCAT["catalog"]), None)))
+        self._lock = threading.Lock()
+        self._creating = {}
+
+    def name(self, form: dict) -> str:
+        # Catalogue name of a parsed form
+        parent_name, parent_type = entity_name_type_from_id(self.parent.id)
+        value = route_value(form, self.route) if self.route else None
+        if value is None:
+            return parent_name
+        if value in self.mapping:
+            return self.mapping[value]
+        if not self.dedicated:
+            return parent_name
+        if value not in self._catalogs and len(self._catalogs) >= self.max_catalogs:
+            # Every new value would be a permanent catalogue of the broker
+            log.warning("%d catalogues already, %s is written to %s", len(self._catalogs), value, parent_name)
+            return parent_name
+        return value
+
+    def route_form(self, form: dict, create: bool = True) -> Entity:
+        # None when the catalogue is not available yet and create is False
+        name = self.name(form)
+        catalog = self._catalogs.get(name, None)
+        if catalog is None and create:
+            catalog = self.get(name)
+        return catalog
+
+    def get(self, name: str) -> Entity:
+        catalog = self._catalogs.get(name, None)
+        if catalog is not None:
+            return catalog
+
+        # Injected once, concurrent submissions of a new catalogue wait for it
+        with self._lock:
+            event = self._creating.get(name, None)
+            creator = event is None
+            if creator:
+                event = self._creating[name] = threading.Event()
+        if not creator:
+            event.wait()
+            return self.get(name)
+
+        try:
+            catalog = self.broker.inject_catalog(name)
+            if self.link and catalog.id not in self._linked:
+                self.broker.append_catalog_catalogs(self.parent, [catalog.id])
+                self._linked.add(catalog.id)
+            self._catalogs[name] = catalog
+            log.info("Catalog %s available", catalog.id)
+        finally:
+            with self._lock:
+                del self._creating[name]
+            event.set()
+
+        if self.on_created is not None:
+            self.on_created(catalog)
+        return catalog
+
+    def linked(self) -> list:
+        # Names of the shards listed by the parent, e.g. written before a restart
+        return [entity_name_type_from_id(catalog_id)[0] for catalog_id in sorted(self._linked)]
+
+    def all(self) -> list:
+        return list(self._catalogs.values())
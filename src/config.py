@@ -0,0 +1,82 @@
+"""Configuration (config.json) of the registry, shared by the service and the bulk import."""
+import json
+
+from injector_ngsildclient import NgsildBrokerDataInjector
+from catalog_shards import CatalogShards, check_catalog_names, DEFAULT_MAX_CATALOGS
+
+
+CATALOG_DESCRIPTION_KEYS = ["name", "title", "description", "publisher", "homepage", "rights", "license"]
+DATASET_DESCRIPTION_KEYS = [ ]
+DISTRIBUTION_DESCRIPTION_KEYS = ["base_url", "availability"]
+
+
+def load_config(filename: str = "config.json") -> tuple:
+    dcat_entities = {}
+    with open(filename) as f:
+        conf = json.load(f)
+
+        dcat_entities["catalog"] = conf.get("catalog", {})
+        missing = [key for key in CATALOG_DESCRIPTION_KEYS if key not in dcat_entities["catalog"].keys()]
+        if missing:
+            raise ValueError("Missing keys in catalog description:", missing)
+       
+        dcat_entities["dataset"] = conf.get("dataset", {})
+        missing = [key for key in DATASET_DESCRIPTION_KEYS if key not in dcat_entities["dataset"].keys()]
+        if missing:
+            raise ValueError("Missing keys in dataset description:", missing)
+
+        dcat_entities["distribution"] = conf.get("distribution", {})
+        missing = [key for key in DISTRIBUTION_DESCRIPTION_KEYS if key not in dcat_entities["distribution"].keys()]
+        if missing:
+            raise ValueError("Missing keys in distribution description:", missing)
+
+        context_broker = conf.get("context_broker", None)
+        if not context_broker:
+            raise ValueError("Context broker URL not provided")
+       
+        context_broker_url = context_broker.get("url", None)
+        if not context_broker_url:
+            raise ValueError("Context broker URL not provided")
+
+        # Checked before serving, the catalogues are only created once the broker is ready
+        sharding_settings(conf)
+
+    return conf, dcat_entities
+
+
+def create_broker(conf: dict, dcat_entities: dict) -> NgsildBrokerDataInjector:
+    context_broker = conf["context_broker"]
+    return NgsildBrokerDataInjector(
+        context_broker["url"], 
+        context=conf.get("context", None), 
+        dcat_entities=dcat_entities,
+        batching=context_broker.get("batching", None),
+        cache=context_broker.get("cache", {}),
+        pool=context_broker.get("pool", {}),
+        change_detection=context_broker.get("change_detection", {}),
+    )
+
+
+def sharding_settings(conf: dict) -> dict:
+    # Arguments of CatalogShards from the "sharding" section, raises ValueError
+    # Without it every submission goes to the configured catalogue
+    sharding = conf.get("sharding", {})
+    route = sharding.get("route", None) if sharding.get("enabled", False) else None
+    if sharding.get("enabled", False) and not route:
+        raise ValueError("sharding.route must name the form field that chooses the catalogue")
+    catalogs = sharding.get("catalogs", {})
+    check_catalog_names(catalogs)
+    max_catalogs = sharding.get("max_catalogs", DEFAULT_MAX_CATALOGS)
+    if not isinstance(max_catalogs, int) or max_catalogs < 1:
+        raise ValueError("sharding.max_catalogs must be a positive integer")
+    return {
+        "route": route,
+        "catalogs": catalogs,
+        "dedicated": sharding.get("dedicated", False),
+        "max_catalogs": max_catalogs,
+        "link": sharding.get("link", True),
+    }
+
+
+def create_catalogs(conf: dict, broker: NgsildBrokerDataInjector, catalog, on_created=None) -> CatalogShards:
+    return CatalogShards(broker, catalog, on_created=on_created, **sharding_settings(conf))
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from ngsildclient.model.utils import NgsiEncoder
+
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 3600
+
+
+def content_hash(payload: dict, volatile=()) -> str:
+    # Canonical JSON (sorted keys, no whitespace) of the entity, without its volatile attributes nor its context
+    content = {name: value for name, value in payload.items() if name not in volatile and name != "@context"}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, separators=(",", ":"), cls=NgsiEncoder).encode("utf-8")
+    ).hexdigest()
+
+
+class ContentHashes(object):
+    """Content hash of the entities last written to (or read from) the context broker, keyed by entity id.
+
+    The `volatile` attributes, bumped by every submission, are left out of the hash, so an entity whose
+    hash has not changed does not have to be written again. Hashes are kept in a bounded LRU and trusted
+    for `ttl` seconds, which bounds how long a change made to the broker by someone else goes unnoticed.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, volatile=(), enabled=True) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.volatile = set(volatile)
+        self.enabled = enabled
+        self.changed_entities = 0
+        self.skipped = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hash(self, entity) -> str:
+        return content_hash(entity.to_dict(), self.volatile)
+
+    def changed(self, entities: list) -> dict:
+        # Entity id --> hash of the entities that differ from what the broker has, the others are counted as skipped
+        if not self.enabled:
+            return OrderedDict((entity.id, None) for entity in entities)
+
+        hashes = OrderedDict((entity.id, self.hash(entity)) for entity in entities)
+        now = time.monotonic()
+        with self._lock:
+            for entity_id, digest in list(hashes.items()):
+                entry = self._entries.get(entity_id, None)
+                if entry is not None and entry[0] >= now and entry[1] == digest:
+                    self._entries.move_to_end(entity_id)
+                    del hashes[entity_id]
+            self.skipped += len(entities) - len(hashes)
+            self.changed_entities += len(hashes)
+        return hashes
+
+    def remember(self, hashes: dict) -> None:
+        # hashes: entity id --> hash, as returned by changed(), of the entities the broker now has
+        if not self.enabled:
+            return
+
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for entity_id, digest in hashes.items():
+                self._entries[entity_id] = (expires, digest)
+                self._entries.move_to_end(entity_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, entities: list) -> None:
+        # Entities as the broker has them, e.g. just read from it
+        if self.enabled:
+            self.remember(OrderedDict((entity.id, self.hash(entity)) for entity in entities))
+
+    def forget(self, entity_ids: list) -> None:
+        with self._lock:
+            for entity_id in entity_ids:
+                self._entries.pop(entity_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "changed": self.changed_entities,
+            "skipped": self.skipped,
+        }
@@ -1,25 +1,82 @@
+import time
+# Cold start is measured from here, before the heavy imports
+STARTED = time.perf_counter()
+
 import hmac
 import hashlib
-from flask import Flask, abort, request
+from flask import Flask, Response, abort, g, jsonify, request
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
 from waitress import serve
 
 import re
-from urllib.parse import urlparse
+import threading
 import json
+from collections import deque
+from contextlib import nullcontext
 
 from ngsildclient import Entity
+from requests import ConnectionError, Timeout
 
 from injector_ngsildclient import NgsildBrokerDataInjector
+from config import load_config, create_broker, create_catalogs
+from catalog_shards import CatalogShards
+from form_schema import parse_form, FormValidationError
+from ingestion_queue import IngestionQueue, QueueFullError, DEFAULT_WORKERS, DEFAULT_QUEUE_SIZE
+from dedup import (
+    DeliveryDeduplicator,
+    DEFAULT_MAX_ENTRIES as DEFAULT_DEDUP_ENTRIES,
+    DEFAULT_WINDOW as DEFAULT_DEDUP_WINDOW,
+    DEFAULT_WAIT as DEFAULT_DEDUP_WAIT,
+)
+from metrics import (
+    REGISTRY,
+    CallbackMetric,
+    REQUESTS,
+    REQUEST_SECONDS,
+    REQUESTS_IN_FLIGHT,
+)
+from tracing import TRACER, phase, DEFAULT_SAMPLE_RATE, DEFAULT_MAX_TRACES
+from bootstrap import CatalogBootstrap, DEFAULT_INITIAL_DELAY, DEFAULT_MAX_DELAY
+from profiler import SamplingProfiler, ProfilerBusyError, DEFAULT_MAX_SECONDS as DEFAULT_MAX_PROFILE_SECONDS
+from outbox import (
+    Outbox,
+    OutboxFullError,
+    DEFAULT_MAX_PENDING as DEFAULT_OUTBOX_MAX_PENDING,
+    DEFAULT_BATCH_SIZE as DEFAULT_OUTBOX_BATCH_SIZE,
+    DEFAULT_WORKERS as DEFAULT_OUTBOX_WORKERS,
+    DEFAULT_INITIAL_DELAY as DEFAULT_OUTBOX_INITIAL_DELAY,
+    DEFAULT_MAX_DELAY as DEFAULT_OUTBOX_MAX_DELAY,
+    DEFAULT_MAX_ATTEMPTS as DEFAULT_OUTBOX_MAX_ATTEMPTS,
+    DEFAULT_RETENTION as DEFAULT_OUTBOX_RETENTION,
+)
+from reconcile import (
+    Reconciler,
+    ReconciliationBusyError,
+    DEFAULT_PAGE_SIZE as DEFAULT_RECONCILIATION_PAGE_SIZE,
+    DEFAULT_INTERVAL as DEFAULT_RECONCILIATION_INTERVAL,
+)
+from admission import (
+    AdmissionControl,
+    RateLimitedError,
+    SaturatedError,
+    DEFAULT_RATE as DEFAULT_ADMISSION_RATE,
+    DEFAULT_BURST as DEFAULT_ADMISSION_BURST,
+    DEFAULT_MAX_IN_FLIGHT as DEFAULT_ADMISSION_MAX_IN_FLIGHT,
+    DEFAULT_RETRY_AFTER as DEFAULT_ADMISSION_RETRY_AFTER,
+    DEFAULT_MAX_PROVIDERS as DEFAULT_ADMISSION_MAX_PROVIDERS,
+)
+from dcat_export import FORMATS, serialise, etag, etag_matches
+from registry_index import RegistryIndex, FACETS, DEFAULT_LIMIT as DEFAULT_PAGE_LIMIT, MAX_LIMIT as MAX_PAGE_LIMIT
 
 import logging
 log = logging.getLogger(__name__)
 
 
-CATALOG_DESCRIPTION_KEYS = ["name", "title", "description", "publisher", "homepage", "rights", "license"]
-DATASET_DESCRIPTION_KEYS = [ ]
-DISTRIBUTION_DESCRIPTION_KEYS = ["base_url", "availability"]
-
 form_key = ""
+# config.json, read when run as a script
+conf = {}
+# Bearer token of the /debug endpoints, disabled when empty
+debug_token = ""
 
 def is_valid_signature(timestamp, body, signature, key) -> bool:
     h = hmac.new(
@@ -30,21 +87,30 @@ def is_valid_signature(timestamp, body, signature, key) -> bool:
     return h.hexdigest() == signature
 
 
-def validate_signature(request):
+def validate_signature(request) -> str:
     header_signature = request.headers.get("x-wpforms-webhook-signature")
     # request.headers.getlist("x-wpforms-webhook-signature")
     if header_signature is None:
         abort(401, description="Missing signature")
 
     header_signature = dict(re.findall(r"(\w+)=(\w+)", header_signature))
+    body = request.data.decode("utf-8")
     if not is_valid_signature(
         header_signature["t"],
-        request.data.decode("utf-8"),
+        body,
         header_signature["v"],
         form_key,
     ):
         abort(401, description="Invalid signature")
 
+    # Signed body
+    return body
+
+
+def strip_form(form: dict) -> dict:
+    # Strip all fields
+    return {key: value.strip() if isinstance(value, str) else value for key, value in form.items()}
+
 
 PORT = 5000
 app = Flask(__name__)
@@ -52,72 +118,602 @@ app = Flask(__name__)
 broker = None
 # To be initalized on first request
 catalog: Entity = None
+# Catalogues the submissions are routed to, the configured one by default
+catalogs: CatalogShards = None
+# Only set when the asynchronous ingestion mode is enabled
+ingestion_queue: IngestionQueue = None
+# Only set when duplicate deliveries are detected
+deduplicator: DeliveryDeduplicator = None
+# Only set when submissions are acknowledged once written to the local outbox
+outbox: Outbox = None
+# Background injection of the catalogue
+bootstrap: CatalogBootstrap = None
+# Cold start phase --> seconds since STARTED
+startup = {}
+# Entities written (or loaded at start up), served by the read endpoints
+index = RegistryIndex()
+# Comparison of the broker with the registry, set once the broker is ready
+reconciler: Reconciler = None
+# Only set when the submissions of each provider are rate limited
+admission: AdmissionControl = None
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    REQUESTS.inc(endpoint, str(response.status_code))
+    REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_start, endpoint)
+    g.metrics_recorded = True
+    return response
+
+
+@app.teardown_request
+def end_request_metrics(exc):
+    if "metrics_start" not in g:
+        return
+    REQUESTS_IN_FLIGHT.dec()
+    if not g.get("metrics_recorded", False):
+        # Unhandled exception, answered with 500
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUESTS.inc(endpoint, "500")
+        REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_start, endpoint)
+
+
+def inject_form(form: dict) -> list:
+    # TODO: In case there is an error, any modification has to be reversed
+    # Span of the request trace, or a trace of its own in the asynchronous workers
+    with TRACER.trace("inject_form"):
+        with phase("route_catalog"):
+            form_catalog = catalogs.route_form(form)
+        with phase("inject_csource"):
+            csource = broker.inject_csource(form)
+        with phase("inject_dataset"):
+            dataset, distributions = broker.inject_dataset(form_catalog, form)
+        index.put_dataset(form_catalog.id, dataset, distributions)
+
+    # Ids of the entities written
+    return [csource.id, dataset.id] + [distribution.id for distribution in distributions] + [form_catalog.id]
 
 
 @app.route("/injector", methods=["POST"])
+@TRACER.traced("POST /injector")
 def form_to_ngsild():
     log.info(request)
 
-    validate_signature(request)
+    if catalog is None and outbox is None:
+        # Catalogue bootstrap still retrying, the webhook delivery will be retried
+        return (
+            json.dumps({"description": "Service not ready, try again later."}),
+            503,
+            {"Retry-After": "5", "Content-Type": "application/json"},
+        )
+
+    with phase("signature"):
+        body = validate_signature(request)
 
     if request.is_json:
-        form = request.json
+        form = strip_form(request.json)
     else:
         abort(415, description="Content type is not supported.")
 
-    # Strip all fields
-    form = {key: value.strip() for key, value in form.items()}
+    # Malformed submissions are rejected before any broker call
+    try:
+        with phase("parse_form"):
+            record = parse_form(form)
+    except FormValidationError as err:
+        return (
+            json.dumps({"description": "Invalid form", "errors": err.errors}),
+            400,
+            {"Content-Type": "application/json"},
+        )
 
-    # TODO: In case there is an error, any modification has to be reversed
-    broker.inject_csource(form)
-    broker.inject_dataset(catalog, form)
-    return ("", 201)
+    if deduplicator is None:
+        return handle_form(record, form)
 
+    # Repeated deliveries get the original response without touching the broker
+    key = deduplicator.key(body)
+    with phase("deduplication"):
+        response = deduplicator.begin(key)
+    if response is not None:
+        log.info("Duplicate delivery %s", key)
+        return response
 
+    try:
+        response = handle_form(record, form)
+    except BaseException:
+        deduplicator.cancel(key)
+        raise
+    deduplicator.end(key, response)
+    return response
 
-if __name__ == "__main__":
-    dcat_entities = {}
-    with open("config.json") as f:
-        conf = json.load(f)
-
-        form_key = conf.get("form_key", None)
-        if not form_key:
-            raise ValueError("Form key not provided")
-
-        dcat_entities["catalog"] = conf.get("catalog", {})
-        missing = [key for key in CATALOG_DESCRIPTION_KEYS if key not in dcat_entities["catalog"].keys()]
-        if missing:
-            raise ValueError("Missing keys in catalog description:", missing)
-       
-        dcat_entities["dataset"] = conf.get("dataset", {})
-        missing = [key for key in DATASET_DESCRIPTION_KEYS if key not in dcat_entities["dataset"].keys()]
-        if missing:
-            raise ValueError("Missing keys in dataset description:", missing)
-
-        dcat_entities["distribution"] = conf.get("distribution", {})
-        missing = [key for key in DISTRIBUTION_DESCRIPTION_KEYS if key not in dcat_entities["distribution"].keys()]
-        if missing:
-            raise ValueError("Missing keys in distribution description:", missing)
-
-        context_broker = conf.get("context_broker", None)
-        if not context_broker:
-            raise ValueError("Context broker URL not provided")
-       
-        context_broker_url = context_broker.get("url", None)
-        if not context_broker_url:
-            raise ValueError("Context broker URL not provided")
-
-        port = conf.get("port", PORT)
-
-        context = conf.get("context", None)
-
-    broker = NgsildBrokerDataInjector(
-        context_broker_url, 
-        context=context, 
-        dcat_entities=dcat_entities
+
+def handle_form(record: dict, form: dict) -> tuple:
+    # record: parsed form, form: the submitted (stripped) one
+    if admission is not None:
+        try:
+            admission.admit(record["DatasetProvider"])
+        except RateLimitedError as err:
+            log.info("%s", err)
+            # Raised, so that the deduplicator does not answer the retry with it
+            raise TooManyRequests(description="Too many submissions of this provider, try again later.", retry_after=err.retry_after)
+
+    if outbox is not None:
+        try:
+            with phase("outbox"):
+                entry = outbox.append(form)
+        except OutboxFullError:
+            if admission is not None:
+                admission.refund(record["DatasetProvider"])
+            raise ServiceUnavailable(description="Too many pending submissions, try again later.", retry_after=5)
+        return (
+            json.dumps(entry),
+            202,
+            {"Location": "/jobs/" + entry["id"], "Content-Type": "application/json"},
+        )
+
+    form = record
+    if ingestion_queue is None:
+        try:
+            with admission.slot() if admission is not None else nullcontext():
+                inject_form(form)
+        except SaturatedError as err:
+            # Refused before any broker work, the provider keeps its token
+            admission.refund(record["DatasetProvider"])
+            raise ServiceUnavailable(description="Too many submissions in progress, try again later.", retry_after=err.retry_after)
+        return ("", 201, {})
+
+    try:
+        job = ingestion_queue.submit(form)
+    except QueueFullError:
+        if admission is not None:
+            admission.refund(record["DatasetProvider"])
+        raise ServiceUnavailable(description="Too many pending submissions, try again later.", retry_after=5)
+    return (
+        json.dumps(job.to_dict()),
+        202,
+        {"Location": "/jobs/" + job.id, "Content-Type": "application/json"},
+    )
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    if outbox is not None:
+        entry = outbox.get(job_id)
+        if entry is None:
+            abort(404, description="Unknown job.")
+        return jsonify(entry)
+
+    if ingestion_queue is None:
+        abort(404, description="Asynchronous ingestion is not enabled.")
+
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        abort(404, description="Unknown job.")
+    return jsonify(job.to_dict())
+
+
+def parse_search(args: dict) -> tuple:
+    # args: query parameter --> values, raises ValueError --> (filters, offset, limit)
+    filters = {facet: args[facet] for facet in FACETS if args.get(facet, None)}
+    offset = int(args.get("offset", [0])[0])
+    limit = int(args.get("limit", [DEFAULT_PAGE_LIMIT])[0])
+    if offset < 0 or not 0 < limit <= MAX_PAGE_LIMIT:
+        raise ValueError("offset must be >= 0 and limit between 1 and {}".format(MAX_PAGE_LIMIT))
+    return filters, offset, limit
+
+
+def dataset_urn(dataset_id: str) -> str:
+    return dataset_id if dataset_id.startswith("urn:ngsi-ld:") else "urn:ngsi-ld:Dataset:" + dataset_id
+
+
+def catalog_urn(catalog_id: str) -> str:
+    return catalog_id if catalog_id.startswith("urn:ngsi-ld:") else "urn:ngsi-ld:Catalogue:" + catalog_id
+
+
+@app.route("/catalogue", methods=["GET"])
+def get_catalogue():
+    payload = index.catalog(catalog.id) if catalog is not None else None
+    if payload is None:
+        abort(503, description="Service not ready, try again later.")
+    return jsonify(payload)
+
+
+@app.route("/catalogue.<extension>", methods=["GET"])
+def export_catalogue(extension):
+    # DCAT-AP document of the catalogue, its shards and their datasets: .ttl, .nt or .jsonld
+    if extension not in FORMATS:
+        abort(404)
+    if catalog is None:
+        abort(503, description="Service not ready, try again later.")
+    # Unchanged since the client's copy: nothing is serialised
+    current = etag(index.epoch, index.version)
+    if etag_matches(request.headers.get("If-None-Match", None), current):
+        return "", 304, {"ETag": current}
+
+    version, catalogs, datasets = index.snapshot(catalog.id)
+    return Response(
+        serialise(extension, catalogs, datasets), 200, {"ETag": etag(index.epoch, version)}, content_type=FORMATS[extension],
     )
-    
-    catalog = broker.inject_catalog(dcat_entities["catalog"]["name"])
-    log.info("Catalog created/available %s", catalog.to_json())
 
+
+@app.route("/catalogues", methods=["GET"])
+def get_catalogues():
+    return jsonify(index.list_catalogs())
+
+
+@app.route("/catalogues/<catalog_id>", methods=["GET"])
+def get_catalogue_by_id(catalog_id):
+    payload = index.catalog(catalog_urn(catalog_id))
+    if payload is None:
+        abort(404, description="Unknown catalogue.")
+    return jsonify(payload)
+
+
+@app.route("/datasets", methods=["GET"])
+def get_datasets():
+    # e.g. /datasets?theme=ENVI&theme=TRAN&language=ENG&catalog=<name>&offset=20&limit=20
+    try:
+        filters, offset, limit = parse_search(request.args.to_dict(flat=False))
+    except ValueError as err:
+        abort(400, description=str(err))
+    catalog_id = request.args.get("catalog", None)
+    catalog_id = catalog_urn(catalog_id) if catalog_id else None
+    return jsonify(index.search(filters, catalog_id=catalog_id, offset=offset, limit=limit))
+
+
+@app.route("/datasets/<dataset_id>", methods=["GET"])
+def get_dataset(dataset_id):
+    dataset = index.dataset(dataset_urn(dataset_id))
+    if dataset is None:
+        abort(404, description="Unknown dataset.")
+    return jsonify(dataset)
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "cache": broker.cache.stats() if broker is not None else None,
+        "pool": broker.pool.stats() if broker is not None else None,
+        "change_detection": broker.hashes.stats() if broker is not None else None,
+        "deduplication": deduplicator.stats() if deduplicator is not None else None,
+        "outbox": outbox.stats() if outbox is not None else None,
+        "index": index.stats(),
+        "reconciliation": reconciler.stats() if reconciler is not None else None,
+        "admission": admission.stats() if admission is not None else None,
+    })
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    status = bootstrap.status() if bootstrap is not None else {"ready": False}
+    status["startup"] = {phase: round(seconds, 3) for phase, seconds in startup.items()}
+    return jsonify(status), 200 if catalog is not None else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+profiler = SamplingProfiler()
+
+
+def validate_debug_token(request) -> None:
+    if not debug_token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + debug_token):
+        abort(401, description="Invalid debug token")
+
+
+@app.route("/reconcile", methods=["POST"])
+def reconcile():
+    # e.g. POST /reconcile?repair=true, the report of a full scan of the broker
+    validate_debug_token(request)
+    if reconciler is None:
+        abort(503, description="Service not ready, try again later.")
+    try:
+        report = reconciler.run(request.args.get("repair", "false").lower() == "true")
+    except ReconciliationBusyError:
+        abort(409, description="A reconciliation is already running.")
+    return jsonify(report)
+
+
+@app.route("/debug/traces", methods=["GET"])
+def debug_traces():
+    validate_debug_token(request)
+    return jsonify({
+        "sample_rate": TRACER.sample_rate,
+        "traces": TRACER.recent(request.args.get("limit", None, type=int)),
+    })
+
+
+@app.route("/debug/traces/<trace_id>", methods=["GET"])
+def debug_trace(trace_id):
+    validate_debug_token(request)
+    trace = TRACER.get(trace_id)
+    if trace is None:
+        abort(404, description="Unknown trace.")
+    return jsonify(trace)
+
+
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    validate_debug_token(request)
+    seconds = request.args.get("seconds", 10, type=float)
+    if seconds <= 0:
+        abort(400, description="seconds must be positive")
+    try:
+        profile = profiler.profile(seconds)
+    except ProfilerBusyError:
+        abort(409, description="A profile is already running.")
+    # Collapsed stacks, e.g. flamegraph.pl profile.txt > profile.svg
+    return profile, 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+
+def stat(component: str, key: str):
+    # Value of /stats at render time, None (not exported) when the component is disabled
+    def read():
+        source = {
+            "cache": broker and broker.cache,
+            "pool": broker and broker.pool,
+            "change_detection": broker and broker.hashes,
+            "deduplication": deduplicator,
+            "outbox": outbox,
+            "reconciliation": reconciler,
+            "admission": admission,
+        }[component]
+        return source.stats()[key] if source is not None else None
+    return read
+
+
+def last_reconciliation(key: str):
+    # Value of the last reconciliation, None before the first run
+    def read():
+        last_run = reconciler.stats()["last_run"] if reconciler is not None else None
+        return last_run[key] if last_run is not None else None
+    return read
+
+
+REGISTRY.register(CallbackMetric(
+    "registry_catalog_datasets", "Datasets in each catalogue", "gauge",
+    lambda: {(catalog_id,): len(datasets) for catalog_id, datasets in list(broker.catalog_index.items())} if broker else None,
+    ("catalog",),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_startup_seconds", "Seconds from the process start to each cold start phase", "gauge",
+    lambda: {(phase,): seconds for phase, seconds in list(startup.items())}, ("phase",),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_index_datasets", "Datasets in the local registry index", "gauge", lambda: index.stats()["datasets"],
+))
+REGISTRY.register(CallbackMetric("registry_cache_hits_total", "Entity cache hits", "counter", stat("cache", "hits")))
+REGISTRY.register(CallbackMetric("registry_cache_misses_total", "Entity cache misses", "counter", stat("cache", "misses")))
+REGISTRY.register(CallbackMetric("registry_cache_entries", "Entities in the cache", "gauge", stat("cache", "entries")))
+REGISTRY.register(CallbackMetric(
+    "registry_unchanged_entities_total", "Entity writes skipped because the broker already had their content", "counter",
+    stat("change_detection", "skipped"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_changed_entities_total", "Entities whose content changed and that were written to the broker", "counter",
+    stat("change_detection", "changed"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_broker_connections", "Connections opened to the context broker", "counter", stat("pool", "connections"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_outbox_pending", "Submissions in the outbox not yet written to the context broker", "gauge",
+    stat("outbox", "pending"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_reconciliation_runs_total", "Reconciliations of the registry with the broker", "counter",
+    stat("reconciliation", "runs"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_reconciliation_drift", "Drift found by the last reconciliation, by kind", "gauge",
+    lambda: {(kind,): count for kind, count in (last_reconciliation("drift")() or {}).items()},
+    ("kind",),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_reconciliation_entities_per_second", "Broker entities scanned per second by the last reconciliation",
+    "gauge", last_reconciliation("entities_per_second"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_duplicate_deliveries_total", "Repeated webhook deliveries answered without touching the broker", "counter",
+    stat("deduplication", "duplicates"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_admission_in_flight", "Submissions being written to the broker", "gauge", stat("admission", "in_flight"),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_admission_rejected_total", "Submissions refused by the admission control, by reason", "counter",
+    lambda: {
+        ("rate_limited",): admission.rate_limited,
+        ("saturated",): admission.saturated,
+    } if admission is not None else None,
+    ("reason",),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_admission_tokens", "Tokens left in the bucket of each provider", "gauge",
+    lambda: {
+        (provider,): bucket["tokens"] for provider, bucket in admission.stats()["providers"].items()
+    } if admission is not None else None,
+    ("provider",),
+))
+REGISTRY.register(CallbackMetric(
+    "registry_admission_rate_limited_total", "Submissions of each provider refused with 429", "counter",
+    lambda: {
+        (provider,): bucket["limited"] for provider, bucket in admission.stats()["providers"].items()
+    } if admission is not None else None,
+    ("provider",),
+))
+
+
+def set_ready(ready_broker: NgsildBrokerDataInjector, ready_catalog: Entity) -> None:
+    global broker, catalog, catalogs, reconciler
+    index.put_catalog(ready_catalog)
+    broker = ready_broker
+    catalogs = create_catalogs(conf, ready_broker, ready_catalog, on_created=catalog_created)
+    reconciler = create_reconciler(conf, ready_broker, catalogs)
+    catalog = ready_catalog
+    startup["ready"] = time.perf_counter() - STARTED
+    threading.Thread(target=load_index, args=(ready_broker, catalogs), name="index-load", daemon=True).start()
+    if outbox is not None:
+        # Replays what was acknowledged meanwhile or before a restart
+        outbox.start()
+
+
+def catalog_created(shard: Entity) -> None:
+    # First submission routed to a catalogue since the start
+    index.put_catalog(shard, catalogs.parent.id)
+    if index.loaded:
+        threading.Thread(target=load_index, args=(broker, catalogs, [shard]), name="index-load", daemon=True).start()
+
+
+def load_index(broker: NgsildBrokerDataInjector, catalogs: CatalogShards, shards: list = None) -> None:
+    # Datasets written before the start, the read endpoints serve what is loaded meanwhile
+    try:
+        if shards is None:
+            # Shards written before a restart, each one loaded with its parent
+            for name in catalogs.linked():
+                catalogs.get(name)
+            shards = catalogs.all()
+        members = {}
+        for shard in shards:
+            with broker.locks.hold(shard.id):
+                members[shard.id] = set(broker.get_catalog_datasets(shard))
+        index.load(broker.ngsild_api, members, broker.context or None, hashes=broker.hashes)
+    except Exception as err:
+        log.warning("Registry index could not be loaded from the broker: %r", err)
+
+
+def create_reconciler(conf: dict, broker: NgsildBrokerDataInjector, catalogs: CatalogShards) -> Reconciler:
+    # Run on demand (POST /reconcile), and in the background every reconciliation.interval seconds
+    settings = conf.get("reconciliation", {})
+    reconciler = Reconciler(
+        broker, catalogs, index=index, page_size=settings.get("page_size", DEFAULT_RECONCILIATION_PAGE_SIZE),
+    )
+    interval = settings.get("interval", DEFAULT_RECONCILIATION_INTERVAL)
+    if interval:
+        reconciler.schedule(interval, repair=settings.get("repair", False))
+    return reconciler
+
+
+def queued_form(form: dict) -> list:
+    # Job of the ingestion queue, waits for a slot under admission.max_in_flight
+    with admission.slot(wait=True) if admission is not None else nullcontext():
+        return inject_form(form)
+
+
+def replay_form(form: dict) -> list:
+    # Outbox entry, written as if it had just been submitted (same locks, deltas, index updates and max_in_flight)
+    return queued_form(parse_form(form))
+
+
+def create_admission(conf: dict) -> AdmissionControl:
+    # None when disabled
+    settings = conf.get("admission", {})
+    if not settings.get("enabled", False):
+        return None
+    providers = settings.get("providers", {})
+    if not isinstance(providers, dict):
+        raise ValueError("admission.providers must map providers to their rate and burst")
+    return AdmissionControl(
+        rate=settings.get("rate", DEFAULT_ADMISSION_RATE),
+        burst=settings.get("burst", DEFAULT_ADMISSION_BURST),
+        providers=providers,
+        max_in_flight=settings.get("max_in_flight", DEFAULT_ADMISSION_MAX_IN_FLIGHT),
+        retry_after=settings.get("retry_after", DEFAULT_ADMISSION_RETRY_AFTER),
+        max_providers=settings.get("max_providers", DEFAULT_ADMISSION_MAX_PROVIDERS),
+    )
+
+
+def create_outbox(conf: dict) -> Outbox:
+    # None when disabled
+    settings = conf.get("outbox", {})
+    if not settings.get("enabled", False):
+        return None
+    return Outbox(
+        settings.get("path", "outbox.sqlite"),
+        replay_form,
+        batch_size=settings.get("batch_size", DEFAULT_OUTBOX_BATCH_SIZE),
+        workers=settings.get("workers", DEFAULT_OUTBOX_WORKERS),
+        initial_delay=settings.get("initial_delay", DEFAULT_OUTBOX_INITIAL_DELAY),
+        max_delay=settings.get("max_delay", DEFAULT_OUTBOX_MAX_DELAY),
+        max_attempts=settings.get("max_attempts", DEFAULT_OUTBOX_MAX_ATTEMPTS),
+        retention=settings.get("retention", DEFAULT_OUTBOX_RETENTION),
+        max_pending=settings.get("max_pending", DEFAULT_OUTBOX_MAX_PENDING),
+        synchronous=settings.get("synchronous", "FULL"),
+        # Broker unreachable, retried until it is back
+        transient=(ConnectionError, Timeout),
+    )
+
+
+def start_bootstrap(conf: dict, dcat_entities: dict, on_ready=set_ready) -> CatalogBootstrap:
+    retry = conf["context_broker"].get("retry", {})
+    catalog_bootstrap = CatalogBootstrap(
+        lambda: create_broker(conf, dcat_entities),
+        dcat_entities["catalog"]["name"],
+        on_ready=on_ready,
+        started=STARTED,
+        initial_delay=retry.get("initial_delay", DEFAULT_INITIAL_DELAY),
+        max_delay=retry.get("max_delay", DEFAULT_MAX_DELAY),
+    )
+    catalog_bootstrap.start()
+    return catalog_bootstrap
+
+
+if __name__ == "__main__":
+    startup["imports"] = time.perf_counter() - STARTED
+
+    conf, dcat_entities = load_config()
+
+    form_key = conf.get("form_key", None)
+    if not form_key:
+        raise ValueError("Form key not provided")
+
+    port = conf.get("port", PORT)
+
+    ingestion = conf.get("ingestion", {})
+
+    deduplication = conf.get("deduplication", {})
+
+    debug = conf.get("debug", {})
+    debug_token = debug.get("token", "")
+    TRACER.sample_rate = debug.get("trace_sample_rate", DEFAULT_SAMPLE_RATE)
+    TRACER.traces = deque(maxlen=debug.get("max_traces", DEFAULT_MAX_TRACES))
+    profiler.max_seconds = debug.get("max_profile_seconds", DEFAULT_MAX_PROFILE_SECONDS)
+
+    outbox = create_outbox(conf)
+    admission = create_admission(conf)
+
+    # Serve (/ready, /metrics...) while the catalogue is injected, even if the broker is down
+    bootstrap = start_bootstrap(conf, dcat_entities)
+
+    if outbox is not None:
+        log.info("Submissions are acknowledged once written to the outbox %s", outbox.path)
+    elif ingestion.get("asynchronous", False):
+        ingestion_queue = IngestionQueue(
+            queued_form,
+            workers=ingestion.get("workers", DEFAULT_WORKERS),
+            queue_size=ingestion.get("queue_size", DEFAULT_QUEUE_SIZE),
+        )
+        ingestion_queue.start()
+        log.info("Asynchronous ingestion enabled with %d workers", ingestion_queue.workers)
+
+    if deduplication.get("enabled", True):
+        deduplicator = DeliveryDeduplicator(
+            max_entries=deduplication.get("max_entries", DEFAULT_DEDUP_ENTRIES),
+            window=deduplication.get("window", DEFAULT_DEDUP_WINDOW),
+            store=deduplication.get("store", None),
+            wait=deduplication.get("wait", DEFAULT_DEDUP_WAIT),
+        )
+
+    startup["serving"] = time.perf_counter() - STARTED
+    log.info("Imports took %.3fs, serving after %.3fs", startup["imports"], startup["serving"])
     serve(app, host="0.0.0.0", port=port)
@@ -0,0 +1,227 @@
+"""DCAT-AP serialisation of the registry (Turtle, N-Triples and JSON-LD), without rdflib.
+
+Entities are turned into triples and written one at a time, so a document is streamed while it is
+serialised instead of being built as a graph first. NGSI-LD attributes map to their DCAT-AP
+predicates (PREDICATES); other attributes named by an IRI keep it as their predicate.
+"""
+import json
+import re
+
+from injector_ngsildclient import Namespace, DCAT, DCTERMS, SDM, SDMDCAT
+
+
+RDF = Namespace("http://www.w3.org/1999/02/22-rdf-syntax-ns#")
+XSD = Namespace("http://www.w3.org/2001/XMLSchema#")
+FOAF = Namespace("http://xmlns.com/foaf/0.1/")
+OWL = Namespace("http://www.w3.org/2002/07/owl#")
+DCATAP = Namespace("http://data.europa.eu/r5r/")
+
+PREFIXES = {"rdf": RDF, "xsd": XSD, "dcat": DCAT, "dcterms": DCTERMS, "foaf": FOAF, "owl": OWL, "dcatap": DCATAP}
+
+# Extension --> media type
+FORMATS = {
+    "ttl": "text/turtle; charset=utf-8",
+    "nt": "application/n-triples; charset=utf-8",
+    "jsonld": "application/ld+json",
+}
+
+# NGSI-LD entity type --> DCAT-AP class
+CLASSES = {
+    str(SDMDCAT["Catalogue"]): DCAT["Catalog"],
+    str(SDMDCAT["Dataset"]): DCAT["Dataset"],
+    str(SDMDCAT["Distribution"]): DCAT["Distribution"],
+}
+
+# NGSI-LD attribute --> DCAT-AP predicate
+PREDICATES = {
+    "title": DCTERMS["title"],
+    "description": DCTERMS["description"],
+    "format": DCTERMS["format"],
+    str(SDMDCAT["publisher"]): DCTERMS["publisher"],
+    str(SDMDCAT["homepage"]): FOAF["homepage"],
+    str(SDMDCAT["rights"]): DCTERMS["rights"],
+    str(SDMDCAT["license"]): DCTERMS["license"],
+    str(SDMDCAT["dataset"]): DCAT["dataset"],
+    str(SDMDCAT["catalog"]): DCAT["catalog"],
+    str(SDMDCAT["creator"]): DCTERMS["creator"],
+    str(SDMDCAT["theme"]): DCAT["theme"],
+    str(SDMDCAT["language"]): DCTERMS["language"],
+    str(SDMDCAT["keyword"]): DCAT["keyword"],
+    str(SDMDCAT["spatial"]): DCTERMS["spatial"],
+    str(SDMDCAT["accessRights"]): DCTERMS["accessRights"],
+    str(SDMDCAT["Type"]): DCTERMS["type"],
+    str(SDMDCAT["versionInfo"]): OWL["versionInfo"],
+    str(SDM["dateCreated"]): DCTERMS["issued"],
+    str(SDM["dateModified"]): DCTERMS["modified"],
+    str(SDMDCAT["temporal"]): DCTERMS["temporal"],
+    str(SDMDCAT["landingPage"]): DCAT["landingPage"],
+    str(SDMDCAT["distribution"]): DCAT["distribution"],
+    str(SDMDCAT["mediaType"]): DCAT["mediaType"],
+    str(SDMDCAT["downloadURL"]): DCAT["downloadURL"],
+    str(SDMDCAT["accessUrl"]): DCAT["accessURL"],
+    str(SDMDCAT["availability"]): DCATAP["availability"],
+}
+
+# Predicates whose URL values are resources, not text
+IRI_PREDICATES = {
+    FOAF["homepage"], DCTERMS["license"], DCTERMS["type"], DCAT["landingPage"], DCAT["downloadURL"], DCAT["accessURL"],
+}
+DATETIME_PREDICATES = {DCTERMS["issued"], DCTERMS["modified"]}
+
+ABSOLUTE_IRI = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:")
+LOCAL_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_-]*$")
+# Not allowed in an IRIREF
+IRI_ESCAPES = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+LITERAL_ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+
+class IRI(str):
+    pass
+
+
+class Literal(object):
+    __slots__ = ("value", "datatype")
+
+    def __init__(self, value, datatype: str = None) -> None:
+        self.value = value
+        self.datatype = datatype
+
+
+def literal(value, predicate: str):
+    if isinstance(value, bool):
+        return Literal("true" if value else "false", XSD["boolean"])
+    if isinstance(value, int):
+        return Literal(str(value), XSD["integer"])
+    if isinstance(value, float):
+        return Literal(repr(value), XSD["double"])
+    if isinstance(value, (dict, list)):
+        # Structured values (e.g. GeoProperty) as JSON text
+        return Literal(json.dumps(value, sort_keys=True))
+    value = str(value)
+    if predicate in IRI_PREDICATES and ABSOLUTE_IRI.match(value):
+        return IRI(value)
+    return Literal(value, XSD["dateTime"] if predicate in DATETIME_PREDICATES else None)
+
+
+def entity_triples(payload: dict):
+    # NGSI-LD payload --> (subject, predicate, IRI or Literal), predicates in attribute order
+    subject = payload["id"]
+    yield subject, RDF["type"], IRI(CLASSES.get(payload["type"], payload["type"]))
+    for name, attr in payload.items():
+        if name in ("id", "type", "@context"):
+            continue
+        predicate = PREDICATES.get(name, name if ABSOLUTE_IRI.match(name) else None)
+        if predicate is None:
+            continue
+        for instance in attr if isinstance(attr, list) else [attr]:
+            if not isinstance(instance, dict):
+                continue
+            if instance.get("type", None) == "Relationship":
+                objects = instance.get("object", [])
+                for object_id in objects if isinstance(objects, list) else [objects]:
+                    yield subject, predicate, IRI(object_id)
+            else:
+                values = instance.get("value", None)
+                for value in values if isinstance(values, list) else [values]:
+                    if value is not None:
+                        yield subject, predicate, literal(value, predicate)
+
+
+def iri_ref(iri: str) -> str:
+    return "<" + IRI_ESCAPES.sub(lambda match: "%{:02X}".format(ord(match.group())), iri) + ">"
+
+
+def quoted(value: str) -> str:
+    return '"' + "".join(LITERAL_ESCAPES.get(char, char) for char in value) + '"'
+
+
+def ntriples_term(term) -> str:
+    if isinstance(term, IRI):
+        return iri_ref(term)
+    if term.datatype is not None:
+        return quoted(term.value) + "^^" + iri_ref(term.datatype)
+    return quoted(term.value)
+
+
+def turtle_name(iri: str) -> str:
+    # Prefixed name when the local part allows it
+    for prefix, namespace in PREFIXES.items():
+        if iri.startswith(namespace) and LOCAL_NAME.match(iri[len(namespace):]):
+            return prefix + ":" + iri[len(namespace):]
+    return iri_ref(iri)
+
+
+def turtle_term(term) -> str:
+    if isinstance(term, IRI):
+        return turtle_name(term)
+    if term.datatype is not None:
+        return quoted(term.value) + "^^" + turtle_name(term.datatype)
+    return quoted(term.value)
+
+
+def ntriples(payload: dict) -> str:
+    return "".join(
+        "{} {} {} .\n".format(iri_ref(subject), iri_ref(predicate), ntriples_term(term))
+        for subject, predicate, term in entity_triples(payload)
+    )
+
+
+def turtle(payload: dict) -> str:
+    # One block per subject, the objects of a predicate grouped
+    predicates = {}
+    for subject, predicate, term in entity_triples(payload):
+        predicates.setdefault(predicate, []).append(turtle_term(term))
+    lines = [
+        "    {} {}".format("a" if predicate == RDF["type"] else turtle_name(predicate), ", ".join(objects))
+        for predicate, objects in predicates.items()
+    ]
+    return iri_ref(payload["id"]) + "\n" + " ;\n".join(lines) + " .\n\n"
+
+
+def jsonld_node(payload: dict) -> str:
+    # Expanded JSON-LD node object
+    node = {"@id": payload["id"]}
+    for subject, predicate, term in entity_triples(payload):
+        if predicate == RDF["type"]:
+            node["@type"] = [term]
+        elif isinstance(term, IRI):
+            node.setdefault(predicate, []).append({"@id": term})
+        elif term.datatype is not None:
+            node.setdefault(predicate, []).append({"@value": term.value, "@type": term.datatype})
+        else:
+            node.setdefault(predicate, []).append({"@value": term.value})
+    return json.dumps(node, ensure_ascii=False)
+
+
+def serialise(extension: str, catalogs: list, datasets: list):
+    # Chunks of the document, one per catalogue and per dataset (with its distributions)
+    # datasets: [(dataset payload, [distribution payload, ...]), ...], as RegistryIndex.snapshot()
+    entities = [[catalog] for catalog in catalogs] + [[dataset] + distributions for dataset, distributions in datasets]
+    if extension == "nt":
+        for payloads in entities:
+            yield "".join(ntriples(payload) for payload in payloads)
+    elif extension == "ttl":
+        yield "".join("@prefix {}: <{}> .\n".format(prefix, namespace) for prefix, namespace in PREFIXES.items()) + "\n"
+        for payloads in entities:
+            yield "".join(turtle(payload) for payload in payloads)
+    elif extension == "jsonld":
+        separator = "[\n"
+        for payloads in entities:
+            for payload in payloads:
+                yield separator + jsonld_node(payload)
+                separator = ",\n"
+        yield "[]\n" if separator == "[\n" else "\n]\n"
+    else:
+        raise ValueError("Unknown format " + extension)
+
+
+def etag(epoch: str, version: int) -> str:
+    return '"{}-{}"'.format(epoch, version)
+
+
+def etag_matches(if_none_match: str, tag: str) -> bool:
+    # If-None-Match: "*" or a list of (possibly weak) entity tags
+    if not if_none_match:
+        return False
+    tags = [value.strip() for value in if_none_match.split(",")]
+    return "*" in tags or tag in [value[2:] if value.startswith("W/") else value for value in tags]
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_WINDOW = 3600
+# Maximum time a duplicate waits for the original delivery still being processed
+DEFAULT_WAIT = 60
+
+
+class DeliveryDeduplicator(object):
+    """Remembers the response given to each webhook delivery, keyed by the hash of its signed body.
+
+    A repeated delivery within `window` seconds gets the original response back. Entries are kept
+    in a bounded in-memory LRU and, if `store` is given, in a SQLite file so that they survive restarts.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, window=DEFAULT_WINDOW, store=None, wait=DEFAULT_WAIT) -> None:
+        self.max_entries = max_entries
+        self.window = window
+        self.wait = wait
+        self.duplicates = 0
+        self.busy = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        self._db = None
+        if store:
+            self._db = sqlite3.connect(store, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries (key TEXT PRIMARY KEY, response TEXT, created REAL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key(body: str) -> str:
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+    def begin(self, key: str):
+        # Returns the original response of a duplicate, a 503 response if the original is still being
+        # processed after `wait` seconds, None if the delivery has to be processed
+        while True:
+            with self._lock:
+                response = self._lookup(key)
+                if response is not None:
+                    self.duplicates += 1
+                    return response
+
+                event = self._in_flight.get(key, None)
+                if event is None:
+                    self._in_flight[key] = threading.Event()
+                    return None
+
+            # Same delivery being processed by another thread, wait for its response
+            if not event.wait(self.wait):
+                # Never processed twice at the same time, the sender retries later
+                with self._lock:
+                    self.busy += 1
+                return (
+                    json.dumps({"description": "Delivery still being processed, try again later."}),
+                    503,
+                    {"Retry-After": str(max(int(self.wait), 1)), "Content-Type": "application/json"},
+                )
+
+    def cancel(self, key: str) -> None:
+        # The delivery failed, a retry has to be processed again
+        with self._lock:
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def end(self, key: str, response: tuple) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            if self._db is not None:
+                try:
+                    now = time.time()
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?)", (key, json.dumps(response), now)
+                    )
+                    self._db.execute("DELETE FROM deliveries WHERE created < ?", (now - self.window,))
+                    self._db.commit()
+                except sqlite3.Error:
+                    log.exception("Unable to store delivery %s", key)
+
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key, None)
+        if entry is None and self._db is not None:
+            row = self._db.execute("SELECT created, response FROM deliveries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = (row[0], tuple(json.loads(row[1])))
+                self._entries[key] = entry
+
+        if entry is None:
+            return None
+        if entry[0] < time.time() - self.window:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "window": self.window,
+            "persistent": self._db is not None,
+            "duplicates": self.duplicates,
+            "busy": self.busy,
+        }
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 300
+
+
+class EntityCache(object):
+    """Bounded LRU cache with a TTL for the entities written/read by this process, keyed by entity id.
+
+    Values are copied on the way in and out so that callers can freely modify what they get.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, enabled=True) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value = entry[1]
+        return deepcopy(value)
+
+    def put(self, key: str, value) -> None:
+        if not self.enabled:
+            return
+
+        value = deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
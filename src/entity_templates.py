@@ -0,0 +1,42 @@
+from ngsildclient import Entity
+from ngsildclient.model.attr.rel import AttrRelValue
+
+
+def prop(value) -> dict:
+    # Same payload as Entity.prop(name, value) for plain values (str, list)
+    return {"type": "Property", "value": value}
+
+
+def rel(objects) -> AttrRelValue:
+    # Same attribute as Entity.rel(name, objects) for entity ids, the plain payload of a
+    # multi-object relationship is not understood by entity[name]
+    return AttrRelValue({"type": "Relationship", "object": objects})
+
+
+class EntityTemplate(object):
+    """NGSI-LD entity payload compiled once per entity type and configuration.
+
+    The constant attributes are built up front; an entity is a copy of the template with its id
+    and variable attributes filled in. Attributes keep the template order, so the entity serialises
+    exactly as if it were built attribute by attribute with Entity.prop().
+    """
+
+    def __init__(self, entity_type: str, type_name: str, context, attrs: dict) -> None:
+        # type_name: short type of the ids (urn:ngsi-ld:<type_name>:<id>), entity_type: long name
+        # attrs: attribute name --> constant payload, or None for the variable attributes
+        self.base_id = "urn:ngsi-ld:" + type_name + ":"
+        self.payload = {"id": None, "type": entity_type, "@context": context}
+        self.payload.update(attrs)
+        self.constants = [name for name, attr in attrs.items() if attr is not None]
+        self.variables = [name for name, attr in attrs.items() if attr is None]
+
+    def fill(self, id: str, values: dict) -> Entity:
+        # values: variable attribute name --> payload
+        payload = self.payload.copy()
+        payload["id"] = self.base_id + id
+        # Constant attributes are copied, entities may be modified afterwards
+        for name in self.constants:
+            payload[name] = payload[name].copy()
+        for name in self.variables:
+            payload[name] = values[name]
+        return Entity(payload)
@@ -0,0 +1,128 @@
+import re
+from collections import namedtuple
+
+from validators import is_valid_url, THEMES, LANGUAGES, ACCESS_RIGHTS, LOCATIONS
+
+
+# SmartDataModels / FIWARE / SALTED data model types
+DATA_MODEL_TYPE_PATTERN = re.compile(
+    r'https:\/\/smartdatamodels\.org\/dataModel.(.*)'
+    r'|https:\/\/uri\.fiware\.org\/ns\/data\-models#(.*)'
+    r'|https:\/\/uri\.salted-project\.eu\/dataModel.(.*)'
+)
+
+# WPForms choices end with their number followed by three characters (last word of the label)
+CHOICE_PATTERN = re.compile(r"(?:^|\s)(\d+)\S{3}$")
+
+MULTIPLE_CHOICE_SEPARATOR = "||"
+
+DataModelType = namedtuple("DataModelType", ["uri", "name"])
+
+
+class FormValidationError(ValueError):
+    def __init__(self, errors: dict) -> None:
+        # errors: field name --> message
+        super().__init__("Invalid form: {}".format(errors))
+        self.errors = errors
+
+
+class FormRecord(dict):
+    """Form already parsed by the schema: WPForms field name --> typed value."""
+    pass
+
+
+def parse_text(value: str) -> str:
+    if not value:
+        raise ValueError("Empty value")
+    return value
+
+
+def parse_list(value: str) -> list:
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    if not items:
+        raise ValueError("Empty list")
+    return items
+
+
+def parse_url(value: str) -> str:
+    if not is_valid_url(value):
+        raise ValueError("Not a valid URL")
+    return value
+
+
+def parse_data_model_type(value: str) -> DataModelType:
+    match = DATA_MODEL_TYPE_PATTERN.search(value)
+    if match is None:
+        raise ValueError("Not a SmartDataModels, FIWARE or SALTED data model type")
+    name = next(group for group in match.groups() if group is not None)
+    if not name:
+        raise ValueError("Missing data model name")
+    if "/" not in name:
+        name = "Fiware" + "/" + name
+    return DataModelType(value, name)
+
+
+class Choice(object):
+    # Lookup table: choice number --> code
+    def __init__(self, codes: list, first: int = 0, multiple: bool = False) -> None:
+        self.table = {number: code for number, code in enumerate(codes, first)}
+        self.multiple = multiple
+
+    def parse_one(self, value: str) -> str:
+        match = CHOICE_PATTERN.search(value)
+        if match is None:
+            raise ValueError("Unrecognised choice '{}'".format(value))
+        code = self.table.get(int(match.group(1)), None)
+        if code is None:
+            raise ValueError("Unknown choice '{}'".format(value))
+        return code
+
+    def __call__(self, value: str):
+        if self.multiple:
+            return [self.parse_one(item) for item in value.split(MULTIPLE_CHOICE_SEPARATOR)]
+        return self.parse_one(value)
+
+
+class FormSchema(object):
+    def __init__(self, fields: dict) -> None:
+        # fields: WPForms field name --> parser
+        self.fields = list(fields.items())
+
+    def parse(self, form: dict) -> FormRecord:
+        if isinstance(form, FormRecord):
+            return form
+
+        record = FormRecord()
+        errors = {}
+        for name, parse in self.fields:
+            value = form.get(name, None)
+            if not isinstance(value, str):
+                errors[name] = "Missing field"
+                continue
+            try:
+                record[name] = parse(value)
+            except ValueError as err:
+                errors[name] = str(err)
+        if errors:
+            raise FormValidationError(errors)
+        return record
+
+
+# CKAN form (https://salted-project.eu/ckan-type-form/)
+FORM_SCHEMA = FormSchema({
+    "DatasetType": parse_data_model_type,
+    "DatasetTypeDescription": parse_text,
+    "DatasetCreator": parse_list,
+    "DatasetProvider": parse_text,
+    "DatasetTypeTopic": Choice(THEMES, multiple=True),
+    "DatasetLanguage": Choice(LANGUAGES),
+    "DatasetAccessRights": Choice(ACCESS_RIGHTS, first=1),
+    "DatasetKeywords": parse_list,
+    "DatasetLocation": Choice(LOCATIONS, multiple=True),
+    "ScorpioSatelliteURL": parse_url,
+    "DatasetIDPattern": parse_text,
+})
+
+
+def parse_form(form: dict) -> FormRecord:
+    return FORM_SCHEMA.parse(form)
@@ -0,0 +1,179 @@
+import importlib.util
+import re
+import time
+from functools import lru_cache
+from urllib.parse import urlparse
+
+from requests.adapters import HTTPAdapter
+
+from metrics import BROKER_REQUESTS, BROKER_SECONDS, BROKER_IN_FLIGHT
+from tracing import TRACER
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+
+# (method, NGSI-LD path pattern, operation name) used to label the broker metrics
+BROKER_OPERATIONS = [
+    ("GET", re.compile(r"/ngsi-ld/v1/entities/?$"), "query_entities"),
+    ("POST", re.compile(r"/ngsi-ld/v1/entities/?$"), "create_entity"),
+    ("GET", re.compile(r"/ngsi-ld/v1/entities/[^/]+$"), "get_entity"),
+    ("DELETE", re.compile(r"/ngsi-ld/v1/entities/[^/]+$"), "delete_entity"),
+    ("POST", re.compile(r"/ngsi-ld/v1/entities/[^/]+/attrs/?$"), "append_attrs"),
+    ("PATCH", re.compile(r"/ngsi-ld/v1/entities/[^/]+/attrs/?$"), "update_attrs"),
+    ("POST", re.compile(r"/ngsi-ld/v1/entityOperations/upsert/?$"), "batch_upsert"),
+    ("GET", re.compile(r"/ngsi-ld/v1/csourceRegistrations/[^/]+$"), "get_csource"),
+    ("POST", re.compile(r"/ngsi-ld/v1/csourceRegistrations/?$"), "register_csource"),
+    ("PATCH", re.compile(r"/ngsi-ld/v1/csourceRegistrations/[^/]+$"), "patch_csource"),
+    ("DELETE", re.compile(r"/ngsi-ld/v1/csourceRegistrations/[^/]+$"), "delete_csource"),
+]
+
+
+def broker_operation(method: str, url: str) -> str:
+    path = urlparse(url).path
+    for operation_method, pattern, operation in BROKER_OPERATIONS:
+        if method == operation_method and pattern.search(path):
+            return operation
+    return "other"
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """requests adapter with a bounded keep-alive connection pool and default timeouts.
+
+    Mounted on the session of the NGSI-LD client, it is shared by all the worker threads.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT) -> None:
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    def send(self, request, **kwargs):
+        # requests has no session-wide timeout, never wait forever for the broker
+        if kwargs.get("timeout", None) is None:
+            kwargs["timeout"] = self.timeout
+        if not self.keep_alive:
+            request.headers["Connection"] = "close"
+
+        operation = broker_operation(request.method, request.url)
+        status = "error"
+        start = time.perf_counter()
+        BROKER_IN_FLIGHT.inc()
+        try:
+            with TRACER.span("broker " + operation):
+                response = super().send(request, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            BROKER_IN_FLIGHT.dec()
+            BROKER_SECONDS.observe(time.perf_counter() - start, operation)
+            BROKER_REQUESTS.inc(operation, status)
+
+    def stats(self) -> dict:
+        connections = 0
+        requests = 0
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key, None)
+            if pool is not None:
+                connections += pool.num_connections
+                requests += pool.num_requests
+        return {
+            "pool_size": self.pool_size,
+            "keep_alive": self.keep_alive,
+            "connections": connections,
+            "requests": requests,
+            # Share of the requests sent through an already open connection
+            "reuse_ratio": round(1 - connections / requests, 3) if requests else None,
+        }
+
+
+def mount_pool(session, pool: dict) -> PooledHTTPAdapter:
+    if pool.get("http2", False):
+        log.warning("HTTP/2 is not supported by the synchronous NGSI-LD client, using HTTP/1.1 keep-alive")
+
+    adapter = PooledHTTPAdapter(
+        pool_size=pool.get("size", DEFAULT_POOL_SIZE),
+        keep_alive=pool.get("keep_alive", True),
+        connect_timeout=pool.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+        read_timeout=pool.get("read_timeout", DEFAULT_READ_TIMEOUT),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return adapter
+
+
+@lru_cache(maxsize=None)
+def async_transport_class():
+    # httpx is only needed by the asyncio mode, the synchronous server runs without it
+    import httpx
+
+    class PooledAsyncTransport(httpx.AsyncHTTPTransport):
+        """httpx transport of the asynchronous NGSI-LD client, with the same metrics and spans as PooledHTTPAdapter."""
+
+        def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True, http2=False) -> None:
+            self.pool_size = pool_size
+            self.keep_alive = keep_alive
+            self.http2 = http2
+            self.requests = 0
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size if keep_alive else 0)
+            super().__init__(limits=limits, http2=http2)
+
+        async def handle_async_request(self, request):
+            operation = broker_operation(request.method, str(request.url))
+            status = "error"
+            start = time.perf_counter()
+            self.requests += 1
+            BROKER_IN_FLIGHT.inc()
+            try:
+                with TRACER.span("broker " + operation):
+                    response = await super().handle_async_request(request)
+                status = str(response.status_code)
+                return response
+            finally:
+                BROKER_IN_FLIGHT.dec()
+                BROKER_SECONDS.observe(time.perf_counter() - start, operation)
+                BROKER_REQUESTS.inc(operation, status)
+
+        def stats(self) -> dict:
+            connections = len(self._pool.connections)
+            return {
+                "pool_size": self.pool_size,
+                "keep_alive": self.keep_alive,
+                "http2": self.http2,
+                # Currently open, HTTP/2 connections carry many requests at once
+                "connections": connections,
+                "requests": self.requests,
+            }
+
+    return PooledAsyncTransport
+
+
+def create_async_client(pool: dict):
+    # --> httpx.AsyncClient
+    import httpx
+
+    http2 = pool.get("http2", False)
+    if http2 and importlib.util.find_spec("h2") is None:
+        # HTTP/2 needs the h2 package (pip install httpx[http2])
+        log.warning("HTTP/2 support is not installed, using HTTP/1.1 keep-alive")
+        http2 = False
+
+    return httpx.AsyncClient(
+        transport=async_transport_class()(
+            pool_size=pool.get("size", DEFAULT_POOL_SIZE),
+            keep_alive=pool.get("keep_alive", True),
+            http2=http2,
+        ),
+        timeout=httpx.Timeout(
+            pool.get("read_timeout", DEFAULT_READ_TIMEOUT),
+            connect=pool.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+        ),
+        headers={"Accept": "application/ld+json", "Content-Type": "application/ld+json"},
+    )
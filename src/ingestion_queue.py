@@ -0,0 +1,150 @@
+import asyncio
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import logging
+log = logging.getLogger(__name__)
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 100
+# Number of job records kept in memory so that their status can be queried
+DEFAULT_MAX_JOBS = 10000
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat().split("+")[0]
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, form: dict) -> None:
+        self.id = uuid.uuid4().hex
+        self.form = form
+        self.status = JOB_QUEUED
+        self.entities = []
+        self.error = None
+        self.created = now()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "entities": self.entities,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class IngestionQueue(object):
+    """Bounded in-process queue of form submissions drained by a pool of worker threads.
+
+    `handler` is called with the form of each job and must return the ids of the entities written.
+    """
+
+    def __init__(self, handler, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, max_jobs=DEFAULT_MAX_JOBS) -> None:
+        self.handler = handler
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="ingestion-worker-{}".format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, form: dict) -> Job:
+        job = Job(form)
+        with self._lock:
+            try:
+                self._queue.put_nowait(job)
+            except (queue.Full, asyncio.QueueFull):
+                raise QueueFullError("Ingestion queue is full")
+            self._jobs[job.id] = job
+            self._evict()
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self._lock:
+            return self._jobs.get(job_id, None)
+
+    def _evict(self) -> None:
+        # Forget the oldest finished jobs, pending ones are always kept
+        if len(self._jobs) <= self.max_jobs:
+            return
+        for job_id in list(self._jobs.keys()):
+            if len(self._jobs) <= self.max_jobs:
+                break
+            if self._jobs[job_id].status in (JOB_DONE, JOB_FAILED):
+                del self._jobs[job_id]
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            job.status = JOB_RUNNING
+            job.started = now()
+            try:
+                job.entities = self.handler(job.form)
+                job.status = JOB_DONE
+            except Exception as err:
+                log.exception("Job %s failed", job.id)
+                job.error = str(err)
+                job.status = JOB_FAILED
+            finally:
+                job.finished = now()
+                # The form is no longer needed
+                job.form = None
+                self._queue.task_done()
+
+
+class AsyncIngestionQueue(IngestionQueue):
+    """asyncio variant of IngestionQueue: jobs are drained by worker tasks and `handler` is a coroutine function.
+
+    It has to be started from the event loop that serves the requests.
+    """
+
+    def __init__(self, handler, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, max_jobs=DEFAULT_MAX_JOBS) -> None:
+        super().__init__(handler, workers, queue_size, max_jobs)
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        for i in range(self.workers):
+            self._tasks.append(loop.create_task(self._work(), name="ingestion-worker-{}".format(i)))
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = JOB_RUNNING
+            job.started = now()
+            try:
+                job.entities = await self.handler(job.form)
+                job.status = JOB_DONE
+            except Exception as err:
+                log.exception("Job %s failed", job.id)
+                job.error = str(err)
+                job.status = JOB_FAILED
+            finally:
+                job.finished = now()
+                job.form = None
+                self._queue.task_done()
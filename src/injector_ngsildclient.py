@@ -1,19 +1,14 @@
 from datetime import datetime, timezone
 # import pytz
+import json
 import re
 from urllib.parse import quote_plus, urljoin, urlparse
 
-from validators import (
-    is_valid_url,
-    is_valid_hostname,
-    is_valid_ip,
-    is_valid_port,
-    get_theme,
-    get_access_rights,
-    get_language,
-    get_location,
-    ACCESS_RIGHTS
-)
+from validators import ACCESS_RIGHTS
+from form_schema import parse_form
+from tracing import phase
+
+from requests import HTTPError
 
 from ngsildclient import Entity, Client
 from ngsildclient.api.exceptions import (
@@ -27,12 +22,29 @@ from ngsildclient.api.helper.csourceregistration import (
     RegistrationInfo,
 )
 
-from rdflib import Namespace
-from rdflib.namespace import DCAT, DCTERMS
+class Namespace(str):
+    """URI prefix, Namespace("https://example.org/")["term"] --> "https://example.org/term".
+
+    Same use as rdflib's Namespace, without importing rdflib at startup.
+    """
+
+    def __getitem__(self, term: str) -> str:
+        return str.__add__(self, term)
+
+
+DCAT = Namespace("http://www.w3.org/ns/dcat#")
+DCTERMS = Namespace("http://purl.org/dc/terms/")
 SDM = Namespace("https://smartdatamodels.org/")
 SDMDCAT = Namespace("https://smartdatamodels.org/dataModel.DCAT-AP/")
 NGSILD = Namespace("https://uri.etsi.org/ngsi-ld/")
 
+from upsert_batcher import UpsertBatcher, BatchUpsertError, DEFAULT_WINDOW_MS, DEFAULT_MAX_ENTITIES
+from entity_cache import EntityCache, DEFAULT_MAX_ENTRIES, DEFAULT_TTL
+from content_hash import ContentHashes, DEFAULT_MAX_ENTRIES as DEFAULT_MAX_HASHES, DEFAULT_TTL as DEFAULT_HASH_TTL
+from locks import KeyedLocks
+from http_pool import mount_pool
+from entity_templates import EntityTemplate, prop, rel
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -69,6 +81,51 @@ RESOURCE_TYPES = [
     # {"name": "N3", "ext": "n3", "mimetype": "text/n3"},
 ]
 
+# Multi-valued dataset properties (--> dataset form field), new submissions of a dataset add values to them
+DATASET_MERGED_PROPERTIES = {
+    "description": "description",
+    str(SDMDCAT["creator"]): "creator",
+    str(SDM["dataProvider"]): "dataProvider",
+    str(SDMDCAT["language"]): "language",
+    str(SDMDCAT["keyword"]): "keyword",
+    str(SDMDCAT["theme"]): "theme",
+    str(SDMDCAT["spatial"]): "spatial",
+}
+
+# Dataset properties set from the dataset type or from the configuration (catalogue publisher and
+# license), rewritten when they differ, e.g. after a change of config.json
+DATASET_DERIVED_PROPERTIES = [
+    str(SDMDCAT["Type"]),
+    "title",
+    str(SDMDCAT["publisher"]),
+    str(SDMDCAT["license"]),
+]
+
+# Dataset properties the distributions are built from
+DISTRIBUTION_SOURCE_PROPERTIES = [
+    str(SDMDCAT["accessRights"]),
+    str(SDMDCAT["Type"]),
+    "title",
+]
+
+# Dataset properties that change on every submission, only written along with an actual change
+DATASET_VOLATILE_PROPERTIES = [
+    str(SDM["dateModified"]),
+    str(SDMDCAT["temporal"]),
+]
+
+# Properties that describe the catalogue itself (i.e. everything but its datasets)
+CATALOG_DESCRIPTIVE_PROPERTIES = [
+    "title",
+    "description",
+    str(SDMDCAT["publisher"]),
+    str(SDMDCAT["homepage"]),
+    str(SDMDCAT["rights"]),
+    str(SDMDCAT["license"]),
+]
+
+ENDPOINT_CSOURCEREGS = "ngsi-ld/v1/csourceRegistrations"
+
 # We are going to work with long names
 # DEFAULT_CONTEXT = "https://raw.githubusercontent.com/SALTED-Project/contexts/main/wrapped_contexts/dcat-ap-context.jsonld"
 DEFAULT_CONTEXT = "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context-v1.7.jsonld"
@@ -81,13 +138,45 @@ def multi_urljoin(*parts):
     )
 
 
-def create_list(item_a, item_b):
-    a_list = item_a if isinstance(item_a, list) else [item_a]
-    b_list = item_b if isinstance(item_b, list) else [item_b]
-    final_list = list(set(a_list + b_list))
+def entity_info_to_dict(entity_info: RegistrationInfo.EntityInfo) -> dict:
+    info = {"type": entity_info.type}
+    if getattr(entity_info, "id", None):
+        info["id"] = entity_info.id
+    if getattr(entity_info, "id_pattern", None):
+        info["idPattern"] = entity_info.id_pattern
+    return info
+
+
+def as_list(item) -> list:
+    return item if isinstance(item, list) else [item]
+
+
+def merge_list(item_a, item_b) -> list:
+    # Values of item_a, then the values of item_b not already there, in their original order
+    a_list = as_list(item_a)
+    seen = set(a_list)
+    final_list = list(a_list)
+    for value in as_list(item_b):
+        if value not in seen:
+            seen.add(value)
+            final_list.append(value)
     return final_list
 
 
+def catalog_member(member_id: str) -> dict:
+    # Instance of the SDMDCAT.dataset (or SDMDCAT.catalog) multi-attribute, one per member (datasetId),
+    # so appending a member to a catalogue neither sends nor replaces the other ones
+    return {"type": "Relationship", "object": member_id, "datasetId": member_id}
+
+
+def relationship_objects(attr) -> list:
+    # attr: relationship payload, a single instance or a list of instances
+    objects = []
+    for instance in as_list(attr) if attr is not None else []:
+        objects.extend(as_list(instance.get("object", [])))
+    return objects
+
+
 def create_string(string_chain, substring):
     if substring not in string_chain:
         string_chain = string_chain + "," + substring
@@ -113,23 +202,69 @@ class NgsildBrokerDataInjector(object):
     ngsild_api = None
     context = ""
 
-    def __init__(self, broker_url, dcat_entities={}, context=DEFAULT_CONTEXT) -> None:
+    def __init__(self, broker_url, dcat_entities={}, context=DEFAULT_CONTEXT, batching=None, cache={}, pool={}, change_detection={}, client=None) -> None:
         self.broker_url = broker_url
         self.context = context
        
         # TODO: Modify ngsildclient library to support url
         urlparsed = urlparse(broker_url)
-        self.ngsild_api = Client(
-            hostname=urlparsed.hostname, port=urlparsed.port, secure=True
+        secure = urlparsed.scheme != "http"
+        # client: already built NGSI-LD client (e.g. a stub for benchmarks)
+        self.ngsild_api = client or Client(
+            hostname=urlparsed.hostname,
+            port=urlparsed.port or (443 if secure else 80),
+            secure=secure,
         )
 
+        # Keep-alive connection pool shared by all the threads using the client
+        self.pool = mount_pool(self.ngsild_api.session, pool)
+
         if not context:
             context=DEFAULT_CONTEXT
     
         DEFAULT_CATALOG.update(dcat_entities.get("catalog", {}))
         DEFAULT_DATASET.update(dcat_entities.get("dataset", {}))
         DEFAULT_DISTRIBUTION.update(dcat_entities.get("distribution", {}))
-    
+
+        # Entity payloads compiled once for this configuration, distributions per resource type
+        self.catalog_template = self.compile_catalog_template()
+        self.new_dataset_template = self.compile_dataset_template(merged=False)
+        self.merged_dataset_template = self.compile_dataset_template(merged=True)
+        self.distribution_templates = {
+            resource_type["name"]: self.compile_distribution_template(resource_type) for resource_type in RESOURCE_TYPES
+        }
+
+        # Optional batching stage shared by all the submissions
+        self.batcher = None
+        if batching:
+            self.batcher = UpsertBatcher(
+                self.ngsild_api,
+                self.append_catalog_datasets,
+                window_ms=batching.get("window_ms", DEFAULT_WINDOW_MS),
+                max_entities=batching.get("max_entities", DEFAULT_MAX_ENTITIES),
+            )
+            self.batcher.start()
+
+        # Per dataset, csource and catalogue id locks
+        self.locks = KeyedLocks()
+
+        # Catalogue id --> set of dataset ids, mirrors the SDMDCAT.dataset relationship of each catalogue
+        self.catalog_index = {}
+
+        # Write-through cache of the Catalogue, Dataset and CSourceRegistration entities
+        self.cache = EntityCache(
+            max_entries=cache.get("max_entries", DEFAULT_MAX_ENTRIES),
+            ttl=cache.get("ttl", DEFAULT_TTL),
+            enabled=cache.get("enabled", True),
+        )
+
+        # Content hash of the entities the broker has, unchanged entities are not upserted again
+        self.hashes = ContentHashes(
+            max_entries=change_detection.get("max_entries", DEFAULT_MAX_HASHES),
+            ttl=change_detection.get("ttl", DEFAULT_HASH_TTL),
+            volatile=DATASET_VOLATILE_PROPERTIES,
+            enabled=change_detection.get("enabled", True),
+        )
 
         # self.ngsild_api.set_link_header(
         #     "<"
@@ -140,6 +275,34 @@ class NgsildBrokerDataInjector(object):
     def get_ngsild_api(self):
         return self.ngsild_api
 
+    def upsert(self, entities: list, catalog: Entity = None, members: list = ()):
+        # catalog: only given when datasets (members: their ids) have to be appended to it
+        # Entities whose content the broker already has are left out
+        hashes = self.hashes.changed(entities)
+        entities = [entity for entity in entities if entity.id in hashes]
+        if self.batcher is not None:
+            result = self.batcher.upsert(entities, catalog, members)
+        else:
+            result = self.ngsild_api.upsert(*entities) if entities else None
+            # Same as a batch: an entity not written fails the submission before its datasets are appended
+            errors = getattr(result, "errors", [])
+            if errors:
+                raise BatchUpsertError(errors)
+            if catalog is not None:
+                self.append_catalog_datasets(catalog, members)
+        self.hashes.remember(hashes)
+        return result
+
+    def append_attrs(self, entity_id: str, attrs: dict) -> None:
+        # NGSI-LD partial update: Append Entity Attributes (POST /entities/{entityId}/attrs)
+        payload = dict(attrs)
+        payload["@context"] = self.context
+        r = self.ngsild_api.session.post(
+            "{}/{}/attrs".format(self.ngsild_api.entities.url, entity_id),
+            data=json.dumps(payload),
+        )
+        self.ngsild_api.raise_for_status(r)
+
     # def update_context(self, jsonld):
     #     jsonld.update({"@context": [DEFAULT_CONTEXT]})
     #     return jsonld
@@ -160,55 +323,33 @@ class NgsildBrokerDataInjector(object):
     
 
     # Smart Data Model https://github.com/smart-data-models/dataModel.DCAT-AP/blob/master/Distribution/doc/spec.md
+    def compile_distribution_template(self, resource_type: dict) -> EntityTemplate:
+        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["title"], DCTERMS["description"], NGSILD["format"]
+        return EntityTemplate(str(SDMDCAT["Distribution"]), "Distribution", self.context, {
+            # name
+            # "name": "{} realtime data in {} format".format(dataset["title"].value, resource_type["name"])
+            "title": prop("Realtime data in {}".format(resource_type["name"])),
+            "description": None,
+            "format": prop(resource_type["name"]),
+            str(SDMDCAT["mediaType"]): prop(resource_type["mimetype"]),
+            # hash: unable to get hash as it's realtime data
+            # license --> inherited from dataset when imported to CKAN
+            str(SDMDCAT["rights"]): None,
+            str(SDM["dateCreated"]): None,
+            str(SDM["dateModified"]): None,
+            str(SDMDCAT["downloadURL"]): None,
+            str(SDMDCAT["accessUrl"]): None,
+            str(SDMDCAT["availability"]): prop(DEFAULT_DISTRIBUTION["availability"]),
+        })
+
     def create_new_distribution(self, catalog: Entity, dataset: Entity, resource_type: dict) -> Entity:      
         dataset_name, dataset_type = entity_name_type_from_id(dataset.id)
         id = dataset_name + ":" + resource_type["ext"]
 
-        # resource = Entity(str(SDMDCAT["Distribution"]), id, ctx=self.context)
-        # resource['id'] = create_id("Distribution", id)
-
-        resource = Entity("Distribution", id, ctx=self.context)
-        resource["type"] = str(SDMDCAT["Distribution"])
-        
-        # name
-        # resource.prop("name", "{} realtime data in {} format".format(dataset["title"].value, resource_type["name"]))
-
-        # title
-         # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["title"]
-        resource.prop("title", "Realtime data in {}".format(resource_type["name"])) # resource.prop(str(DCTERMS["title"]), "Realtime data in {}".format(resource_type["name"]))
-
-        # description
-        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["description"]
-        resource.prop("description", ["{} realtime data represented in {} format".format(dataset["title"].value, resource_type["name"])]) # resource.prop(str(DCTERMS["description"]), ["{} realtime data represented in {} format".format(dataset["title"].value, resource_type["name"])])
-        
-        # format
-        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment NGSILD["format"]
-        resource.prop("format", resource_type["name"]) # resource.prop(str(NGSILD["format"]), resource_type["name"])
-        
-        # mediaType
-        resource.prop(str(SDMDCAT["mediaType"]), resource_type["mimetype"])
-
-
-        # hash
-        # resource.prop("hash", "")  # Unable to get hash as it's realtime data
-
-        # license --> inherited from dataset when imported to CKAN
-        # resource.prop("license", catalog["license"].value)
-
-        # rights
-        resource.prop(str(SDMDCAT["rights"]), dataset[str(SDMDCAT["accessRights"])].value.split("/")[-1])
-
-        # dateCreated
-        resource.prop(str(SDM["dateCreated"]), dataset[str(SDM["dateCreated"])].value)
-
-        # dateModified
-        resource.prop(str(SDM["dateModified"]), dataset[str(SDM["dateCreated"])].value)
-
         # --- URLs ---
         # realtime #    /retriever/realtime/__https://smartdatamodels.org/dataModel.DCAT-AP/DistributionDCAT-AP__.json
         # encoded url :/retriever/realtime/__https%3A%2F%2Fsmartdatamodels.org%2FdataModel.Environment%2FAirQualityObserved__.json
         resource_url = multi_urljoin(DEFAULT_DISTRIBUTION["base_url"], "retriever", "realtime", "__" + dataset[str(SDMDCAT["Type"])].value + "__") + "." + resource_type["ext"] 
-        
 
         # temporal
         # Default:/retriever/realtime/__https%3A%2F%2Fsmartdatamodels.org%2FdataModel.DCAT-AP%2FDistributionDCAT-AP__.jsonld
@@ -217,198 +358,190 @@ class NgsildBrokerDataInjector(object):
         #         unit = ['years', 'months', 'weeks', 'days', 'hours']
         # resource_url = multi_urljoin(DEFAULT_DISTRIBUTION["base_url"], "temporal", "__" + dataset["Type"].value + "__") + "." + resource_type["ext"] 
 
-        # downloadURL
-        resource.prop(str(SDMDCAT["downloadURL"]), resource_url)
-
-        # accessUrl
-        resource.prop(str(SDMDCAT["accessUrl"]), resource_url)
-
-        # availability
-        resource.prop(str(SDMDCAT["availability"]), DEFAULT_DISTRIBUTION["availability"])
+        template = self.distribution_templates.get(resource_type["name"], None) or self.compile_distribution_template(resource_type)
+        date_created = dataset[str(SDM["dateCreated"])].value
+        return template.fill(id, {
+            "description": prop(["{} realtime data represented in {} format".format(dataset["title"].value, resource_type["name"])]),
+            str(SDMDCAT["rights"]): prop(dataset[str(SDMDCAT["accessRights"])].value.split("/")[-1]),
+            str(SDM["dateCreated"]): prop(date_created),
+            str(SDM["dateModified"]): prop(date_created),
+            str(SDMDCAT["downloadURL"]): prop(resource_url),
+            str(SDMDCAT["accessUrl"]): prop(resource_url),
+        })
+
+    def get_dataset(self, dataset_id: str, cached: bool = True) -> Entity:
+        id = "urn:ngsi-ld:Dataset:" + dataset_id
+        dataset = self.cache.get(id) if cached else None
+        if dataset is not None:
+            return dataset
 
-        # resource.set_context(DEFAULT_CONTEXT)
-
-        return resource
-
-    def get_dataset(self, dataset_id: str) -> Entity:
         # Check if dataset exists
         try:
-            id = "urn:ngsi-ld:Dataset:" + dataset_id
             dataset = self.ngsild_api.get(id, ctx=self.context)
         except NgsiResourceNotFoundError as err:
             return None
+        self.cache.put(id, dataset)
+        self.hashes.put([dataset])
         return dataset
 
     # Smart Data Model  https://github.com/smart-data-models/dataModel.DCAT-AP/blob/master/Dataset/doc/spec.md
-    def create_new_dataset(self, catalog: Entity, dataset_form: dict) -> Entity:
+    def dataset_name(self, catalog: Entity, dataset_form: dict) -> str:
         catalog_name, catalog_type = entity_name_type_from_id(catalog.id)
-        id = catalog_name + ":" + dataset_form["type"]
-
-        # dataset = Entity(str(SDMDCAT["Dataset"]), id, ctx=self.context)
-        # dataset['id'] = create_id("Dataset", id)
-        dataset = Entity("Dataset", id, ctx=self.context)
-        dataset["type"] = str(SDMDCAT["Dataset"])
+        return catalog_name + ":" + dataset_form["type"]
 
+    def create_new_dataset(self, catalog: Entity, dataset_form: dict) -> tuple:
         # Check if dataset entity already exists --> append new values (form) to properties
-        current_dataset = self.get_dataset(id)
+        # --> dataset, distributions, delta (None for new datasets)
+        with phase("get_dataset"):
+            current_dataset = self.get_dataset(self.dataset_name(catalog, dataset_form))
+        with phase("merge_dataset"):
+            dataset, distributions = self.merge_dataset(catalog, dataset_form, current_dataset)
+            delta = self.dataset_delta(current_dataset, dataset) if current_dataset else None
+        if delta == {}:
+            # Nothing new, the dataset stays as the broker has it
+            dataset = current_dataset
+        return dataset, distributions, delta
+
+    def dataset_delta(self, current_dataset: Entity, dataset: Entity) -> dict:
+        # Attributes of the merged dataset that differ from the current one, {} when nothing changes
+        current = current_dataset.to_dict()
+        merged = dataset.to_dict()
+        delta = {}
+        for name in list(DATASET_MERGED_PROPERTIES) + [str(SDMDCAT["accessRights"])] + DATASET_DERIVED_PROPERTIES:
+            if name not in current or as_list(current[name]["value"]) != as_list(merged[name]["value"]):
+                delta[name] = merged[name]
+        if delta:
+            for name in DATASET_VOLATILE_PROPERTIES:
+                delta[name] = merged[name]
+        return delta
+
+    def update_dataset(self, dataset: Entity, distributions: list, delta: dict, catalog: Entity = None) -> None:
+        # Existing dataset: partial update of the attributes in the delta, nothing else is rewritten
+        # catalog: only given when its datasets have to be appended
+        if delta:
+            if any(name in delta for name in DISTRIBUTION_SOURCE_PROPERTIES):
+                # The distributions follow the rights, type and title of the dataset
+                self.upsert(distributions)
+            self.append_attrs(dataset.id, delta)
+            # The broker now has the merged dataset
+            self.hashes.put([dataset])
+        if catalog is not None:
+            self.append_catalog_datasets(catalog, [dataset.id])
+
+    def compile_dataset_template(self, merged: bool) -> EntityTemplate:
+        # Attribute order differs between new and merged datasets
+        if merged:
+            attrs = list(DATASET_MERGED_PROPERTIES)
+        else:
+            attrs = ["description", str(SDMDCAT["creator"]), str(SDM["dataProvider"]), str(SDMDCAT["theme"]), str(SDMDCAT["language"]), str(SDMDCAT["keyword"]), str(SDMDCAT["spatial"])]
+        attrs = dict.fromkeys(attrs + [
+            str(SDMDCAT["accessRights"]),
+            str(SDMDCAT["Type"]),
+            "title",
+            str(SDMDCAT["publisher"]),
+        ])
+        attrs[str(SDMDCAT["versionInfo"])] = prop("1.0")
+        attrs.update(dict.fromkeys([
+            str(SDM["dateCreated"]),
+            str(SDM["dateModified"]),
+            str(SDMDCAT["license"]),
+            str(SDMDCAT["temporal"]),
+        ]))
+        attrs[str(SDMDCAT["landingPage"])] = prop("https://salted-project.eu/")
+        attrs[str(SDMDCAT["distribution"])] = None
+        return EntityTemplate(str(SDMDCAT["Dataset"]), "Dataset", self.context, attrs)
+
+    def merge_dataset(self, catalog: Entity, dataset_form: dict, current_dataset: Entity) -> Entity:
+        # current_dataset: None for new datasets
+        id = self.dataset_name(catalog, dataset_form)
+        values = {}
+
+        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["description"], DCTERMS["title"]
         if current_dataset:
-            # description
-            # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["description"]
-            dataset.prop("description", create_list(current_dataset["description"].value, dataset_form["description"])) # dataset.prop(str(DCTERMS["description"]), create_list(current_dataset[str(DCTERMS["description"])].value, dataset_form["description"]))
-
-            # creator
-            dataset.prop(str(SDMDCAT["creator"]), create_list(current_dataset[str(SDMDCAT["creator"])].value, dataset_form["creator"]))
-            
-            # dataProvider
-            dataset.prop(str(SDM["dataProvider"]), create_list(current_dataset[str(SDM["dataProvider"])].value, dataset_form["dataProvider"]))
-            
-            # language
-            dataset.prop(str(SDMDCAT["language"]), create_list(current_dataset[str(SDMDCAT["language"])].value, dataset_form["language"]))
-
-            # keyword
-            dataset.prop(str(SDMDCAT["keyword"]), create_list(current_dataset[str(SDMDCAT["keyword"])].value, dataset_form["keyword"]))
-            
-            # theme 
-            dataset.prop(str(SDMDCAT["theme"]), create_list(current_dataset[str(SDMDCAT["theme"])].value, dataset_form["theme"])) # [theme1, theme2, ...]
+            template = self.merged_dataset_template
+            current = current_dataset.to_dict()
+            # theme: [theme1, theme2, ...], spatial: [location1, location2, ...]
             # theme_url = [multi_urljoin("http://publications.europa.eu/resource/authority/data-theme/", theme) for theme in dataset_form["theme"]]
-            # dataset.prop("theme", create_list(current_dataset["theme"].value, theme_url)) # [url/theme1, url/theme2, ...]
-
-            # spatial
-            dataset.prop(str(SDMDCAT["spatial"]), create_list(current_dataset[str(SDMDCAT["spatial"])].value, dataset_form["spatial"])) # [location1, location2, ...]
             # spatial_url = [(
             #     multi_urljoin("http://publications.europa.eu/resource/authority/country/",location)
             #     if location != "EUROPE"
             #     else multi_urljoin("http://publications.europa.eu/resource/authority/continent/",location)
             #     ) 
             #     for location in dataset_form["spatial"]]
-            # dataset.prop("spatial", create_list(current_dataset["spatial"].value, spatial_url)) [url/location1, url/location2, ...]
+            for name, key in DATASET_MERGED_PROPERTIES.items():
+                values[name] = prop(merge_list(current[name]["value"] if name in current else [], dataset_form[key]))
 
             # Access_Rights: less restrictive 
             if ACCESS_RIGHTS.index(dataset_form["accessRights"]) <  ACCESS_RIGHTS.index(current_dataset[str(SDMDCAT["accessRights"])].value): 
-                dataset.prop(str(SDMDCAT["accessRights"]), dataset_form["accessRights"]) # "accessRights"
+                values[str(SDMDCAT["accessRights"])] = prop(dataset_form["accessRights"]) # "accessRights"
             else:
-                dataset.prop(str(SDMDCAT["accessRights"]), current_dataset[str(SDMDCAT["accessRights"])].value) # "accessRights"
-            # if ACCESS_RIGHTS.index(dataset_form["accessRights"]) <  ACCESS_RIGHTS.index(current_dataset["accessRights"].value.split("/")[-1]): 
-            #     access_right_url = multi_urljoin("http://publications.europa.eu/resource/authority/access-right/", dataset_form["accessRights"])
-            #     dataset.prop("accessRights", access_right_url)  # "url/accessRights"
-            # else:
-            #     dataset.prop("accessRights", current_dataset["accessRights"].value) # "url/accessRights"
+                values[str(SDMDCAT["accessRights"])] = prop(current_dataset[str(SDMDCAT["accessRights"])].value) # "accessRights"
+            # access_right_url = multi_urljoin("http://publications.europa.eu/resource/authority/access-right/", dataset_form["accessRights"]) --> "url/accessRights"
                         
         else:
-            # description
-            # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["description"]
-            dataset.prop("description", dataset_form["description"]) # dataset.prop(DCTERMS["description"], dataset_form["description"])
-
-            # creator
-            dataset.prop(
-                str(SDMDCAT["creator"]),
+            template = self.new_dataset_template
+            values["description"] = prop(dataset_form["description"])
+            values[str(SDMDCAT["creator"])] = prop(
                 dataset_form["creator"]
                 if "creator" in dataset_form
                 else catalog[str(SDMDCAT["publisher"])].value,
-            ) 
-
-            # dataProvider
-            dataset.prop(
-                str(SDM["dataProvider"]),
+            )
+            values[str(SDM["dataProvider"])] = prop(
                 dataset_form["dataProvider"]
                 if "dataProvider" in dataset_form
                 else catalog[str(SDMDCAT["publisher"])].value, 
             )
+            values[str(SDMDCAT["theme"])] = prop(dataset_form["theme"]) # [theme1, theme2, ...]
+            values[str(SDMDCAT["language"])] = prop(dataset_form["language"])
+            values[str(SDMDCAT["keyword"])] = prop(dataset_form["keyword"])
+            values[str(SDMDCAT["spatial"])] = prop(dataset_form["spatial"]) # [location1, location2, ...]
+            values[str(SDMDCAT["accessRights"])] = prop(dataset_form["accessRights"]) # "accessRights"
 
-            # theme
-            dataset.prop(str(SDMDCAT["theme"]), dataset_form["theme"]) # [theme1, theme2, ...]
-            # theme_url = [multi_urljoin("http://publications.europa.eu/resource/authority/data-theme/", theme) for theme in dataset_form["theme"]]
-            # dataset.prop("theme", theme_url) # [url/theme1, url/theme2, ...]
-            
-            # language
-            dataset.prop(str(SDMDCAT["language"]), dataset_form["language"])
-
-            # keyword
-            dataset.prop(str(SDMDCAT["keyword"]), dataset_form["keyword"])
-            
-            # spatial
-            dataset.prop(str(SDMDCAT["spatial"]), dataset_form["spatial"]) # [location1, location2, ...]
-            # spatial_url = [(
-            #     multi_urljoin("",location)
-            #     if location != "EUROPE"
-            #     else multi_urljoin("http://publications.europa.eu/resource/authority/continent/",location)
-            #     ) 
-            #     for location in dataset_form["spatial"]]
-            # dataset.prop("spatial", spatial_url) # [url/location1, url/location2, ...]
-            
-            # accessRigths
-            dataset.prop(str(SDMDCAT["accessRights"]), dataset_form["accessRights"]) # "accessRights"
-            # access_right_url = multi_urljoin("http://publications.europa.eu/resource/authority/access-right/", dataset_form["accessRights"])
-            # dataset.prop("accessRights", access_right_url) # "url/accessRights"
-
-
-        # Type
-        dataset.prop(str(SDMDCAT["Type"]), dataset_form["Type"]) # original type --> long name (https://smartdatamodels.org....)
+        # Type: original type --> long name (https://smartdatamodels.org....)
+        values[str(SDMDCAT["Type"])] = prop(dataset_form["Type"])
 
         # title
-        # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["title"]
-        dataset.prop("title", dataset_form["type"]) # dataset.prop(DCTERMS["title"], dataset_form["type"])
+        values["title"] = prop(dataset_form["type"])
         
         # name
-        # dataset.prop("name", to_ckan_valid_name(dataset_form["title"]))           
-        
-        # publisher
-        dataset.prop(str(SDMDCAT["publisher"]), catalog[str(SDMDCAT["publisher"])].value)
+        # "name": to_ckan_valid_name(dataset_form["title"])
         
-        # versionInfo
-        dataset.prop(str(SDMDCAT["versionInfo"]), "1.0")
+        values[str(SDMDCAT["publisher"])] = prop(catalog[str(SDMDCAT["publisher"])].value)
 
-        # TODO: Check if dataset already exists
-        dataset.prop(
-            str(SDM["dateCreated"]),
-            # CKAN doesn't support timezone
-            datetime.now(timezone.utc).isoformat().split("+")[0]
-            # datetime.now().isoformat() 
-            # datetime.now(pytz.timezone("Europe/Madrid")).isoformat(),
-        ).prop(
-            str(SDM["dateModified"]),
-            # CKAN doesn't support timezone
-            datetime.now(timezone.utc).isoformat().split("+")[0]
-            # datetime.now().isoformat(),
-            # datetime.now(pytz.timezone("Europe/Madrid")).isoformat(),
-        )
+        # CKAN doesn't support timezone
+        if current_dataset and str(SDM["dateCreated"]) in current_dataset.to_dict():
+            values[str(SDM["dateCreated"])] = prop(current_dataset[str(SDM["dateCreated"])].value)
+        else:
+            values[str(SDM["dateCreated"])] = prop(datetime.now(timezone.utc).isoformat().split("+")[0])
+        values[str(SDM["dateModified"])] = prop(datetime.now(timezone.utc).isoformat().split("+")[0])
 
-        # license
-        dataset.prop(str(SDMDCAT["license"]), catalog[str(SDMDCAT["license"])].value)
+        values[str(SDMDCAT["license"])] = prop(catalog[str(SDMDCAT["license"])].value)
 
         # TODO: Analyse if it has to be retrieved from the broker itself
-        # temporal
-        dataset.prop(str(SDMDCAT["temporal"]), dataset_form["temporal"])
-
-        # landingPage
-        dataset.prop(str(SDMDCAT["landingPage"]), "https://salted-project.eu/")
+        values[str(SDMDCAT["temporal"])] = prop(dataset_form["temporal"])
 
         # distributions
+        distribution_ids = []
+        values[str(SDMDCAT["distribution"])] = rel(distribution_ids)
+        dataset = template.fill(id, values)
+
         distributions = []
-        dataset.rel(str(SDMDCAT["distribution"]), [])
         for resource_type in RESOURCE_TYPES:
             distribution = self.create_new_distribution(catalog, dataset, resource_type)
-            # distribution.pprint()
-
             distributions.append(distribution)
-            dataset[str(SDMDCAT["distribution"])].value.append(distribution.id) 
+            distribution_ids.append(distribution.id)
         
         return dataset, distributions
 
     def form_validate_dataset(self, form: dict):
+        # Raises FormValidationError if the form is malformed
+        form = parse_form(form)
         dataset_form = {}
                 
         # Save the original type --> long name
-        dataset_form["Type"] = form["DatasetType"]
-
-        smartdatamodels_pattern = r'https:\/\/smartdatamodels\.org\/dataModel.(.*)'
-        fiware_pattern = r'https:\/\/uri\.fiware\.org\/ns\/data\-models#(.*)'
-        salted_pattern = r'https:\/\/uri\.salted-project\.eu\/dataModel.(.*)'
-        expression = re.compile(smartdatamodels_pattern + r'|'+ fiware_pattern + r'|'+ salted_pattern)
-        results = expression.findall(form["DatasetType"])
+        dataset_form["Type"] = form["DatasetType"].uri
 
-        type_ = [r for r in results[0] if r][0]
-        if "/" not in type_: type_ = "Fiware" + "/" + type_
+        type_ = form["DatasetType"].name
         
         dataset_form["type"] = type_.replace("/", ":")
         dataset_form["id"] = to_ckan_valid_name(dataset_form["type"])
@@ -416,28 +549,19 @@ class NgsildBrokerDataInjector(object):
         dataset_form["title"] = type_
         dataset_form["description"] = form["DatasetTypeDescription"]
 
-        dataset_form["creator"] = [creator.strip() for creator in form["DatasetCreator"].split(",")]
+        dataset_form["creator"] = form["DatasetCreator"]
         
         dataset_form["dataProvider"] = form["DatasetProvider"]
 
-        themes = form["DatasetTypeTopic"].split("||")
-        dataset_form["theme"] = [
-            get_theme(int(theme.split(" ")[-1][:-3])) for theme in themes
-        ]
-        # t = get_theme(int(theme.split(" ").last()))
+        dataset_form["theme"] = form["DatasetTypeTopic"]
 
-        dataset_form["language"] = get_language(int(form["DatasetLanguage"].split(" ")[-1][:-3])) 
-        dataset_form["accessRights"] = get_access_rights(int(form["DatasetAccessRights"].split(" ")[-1][:-3]))
+        dataset_form["language"] = form["DatasetLanguage"]
+        dataset_form["accessRights"] = form["DatasetAccessRights"]
 
-        dataset_form["keyword"] = [
-            keyword.strip() for keyword in form["DatasetKeywords"].split(",")
-        ]
+        dataset_form["keyword"] = form["DatasetKeywords"]
 
         dataset_form["temporal"] = datetime.now(timezone.utc).isoformat().split("+")[0]
-        locations = form["DatasetLocation"].split("||")
-        dataset_form["spatial"] = [
-            get_location(int(location.split(" ")[-1][:-3])) for location in locations
-        ]
+        dataset_form["spatial"] = form["DatasetLocation"]
 
         # TODO: add extra attribute "context_url" or something like that in order to save the type context 
         #   context_link = (
@@ -448,70 +572,141 @@ class NgsildBrokerDataInjector(object):
 
         return dataset_form
 
-    def inject_dataset(self, catalog: Entity, form: dict) -> None:
+    def inject_dataset(self, catalog: Entity, form: dict) -> tuple:
         dataset_form = self.form_validate_dataset(form)
-        dataset, distributions = self.create_new_dataset(catalog, dataset_form)
 
-        if str(SDMDCAT["dataset"]) not in catalog.to_dict():
-            catalog.rel(str(SDMDCAT["dataset"]), [dataset.id])
-        else:
-            if not isinstance(catalog[str(SDMDCAT["dataset"])].value, list):
-                # https://github.com/jlanza/python-ngsild-client/blob/8e55ab2103a98b97826bb3b8a9fb8c26bc85682a/src/ngsildclient/model/entity.py#L190-L191
-                #     >>> # Update a value using the dot notation
-                #     >>> e["NO2.accuracy.value"] = 0.96
-                catalog[str(SDMDCAT["dataset"])]["object"] = [ catalog[str(SDMDCAT["dataset"])].value ]
-            
-            if dataset.id not in catalog[str(SDMDCAT["dataset"])].value: # Append just new datasets
-                catalog[str(SDMDCAT["dataset"])]["object"].append(dataset.id)
-        
-        self.ngsild_api.upsert(*distributions, dataset, catalog)
+        # The read-merge-write of a dataset is serialised, different datasets run in parallel
+        with self.locks.hold("urn:ngsi-ld:Dataset:" + self.dataset_name(catalog, dataset_form)):
+            dataset, distributions, delta = self.create_new_dataset(catalog, dataset_form)
+
+            # The catalogue is only written when the dataset is new to it
+            new_member = self.add_catalog_dataset(catalog, dataset.id)
+
+            try:
+                with phase("upsert"):
+                    if delta is None:
+                        self.upsert(distributions + [dataset], catalog if new_member else None, [dataset.id])
+                    else:
+                        self.update_dataset(dataset, distributions, delta, catalog if new_member else None)
+            except Exception:
+                # Retry the append on the next submission of the dataset
+                if new_member:
+                    self.remove_catalog_dataset(catalog, dataset.id)
+                raise
+            # Without changes the cached dataset is still the broker one
+            if delta is None or delta:
+                self.cache.put(dataset.id, dataset)
 
-    def create_new_catalog(self, id) -> Entity:
+        return dataset, distributions
+
+    def get_catalog_datasets(self, catalog: Entity) -> set:
+        datasets = self.catalog_index.get(catalog.id, None)
+        if datasets is None:
+            # Members appended one by one, and the single list of the catalogues written before
+            datasets = set(relationship_objects(catalog.to_dict().get(str(SDMDCAT["dataset"]), None)))
+            self.catalog_index[catalog.id] = datasets
+        return datasets
+
+    # Catalogue membership is only modified while holding the catalogue lock
+
+    def add_catalog_dataset(self, catalog: Entity, dataset_id: str) -> bool:
+        with self.locks.hold(catalog.id):
+            datasets = self.get_catalog_datasets(catalog)
+            if dataset_id in datasets:
+                return False
+            datasets.add(dataset_id)
+            return True
+
+    def remove_catalog_dataset(self, catalog: Entity, dataset_id: str) -> None:
+        with self.locks.hold(catalog.id):
+            self.get_catalog_datasets(catalog).discard(dataset_id)
+
+    def append_catalog_datasets(self, catalog: Entity, dataset_ids: list) -> None:
+        # Only the new members are sent, each as its own instance of the dataset relationship
+        self.append_attrs(catalog.id, {
+            str(SDMDCAT["dataset"]): [catalog_member(dataset_id) for dataset_id in dataset_ids],
+        })
+        # Membership is kept by catalog_index, a copy of the whole catalogue is not cached on every append
+        self.cache.invalidate(catalog.id)
+
+    def delete_catalog_datasets(self, catalog: Entity, dataset_ids: list) -> None:
+        # NGSI-LD Delete Entity Attribute (DELETE /entities/{entityId}/attrs/{attrId}?datasetId=), one per member
+        for dataset_id in dataset_ids:
+            r = self.ngsild_api.session.delete(
+                "{}/{}/attrs/{}".format(self.ngsild_api.entities.url, catalog.id, quote_plus(str(SDMDCAT["dataset"]))),
+                params={"datasetId": dataset_id},
+            )
+            self.ngsild_api.raise_for_status(r)
+        self.cache.invalidate(catalog.id)
+
+    def append_catalog_catalogs(self, parent: Entity, catalog_ids: list) -> None:
+        # Catalogues listed by a parent catalogue (shards), appended like its datasets
+        self.append_attrs(parent.id, {
+            str(SDMDCAT["catalog"]): [catalog_member(catalog_id) for catalog_id in catalog_ids],
+        })
+        self.cache.invalidate(parent.id)
+
+    def catalog_description_changed(self, current: Entity, catalog: Entity) -> bool:
+        current_dict = current.to_dict()
+        catalog_dict = catalog.to_dict()
+        for key in CATALOG_DESCRIPTIVE_PROPERTIES:
+            current_value = current_dict[key].get("value", None) if key in current_dict else None
+            if current_value != catalog_dict[key]["value"]:
+                return True
+        return False
+
+    def compile_catalog_template(self) -> EntityTemplate:
         # ngsi-ld-core-context-v1.7.jsonld is stored in the context broker --> if not, uncomment DCTERMS["title"], DCTERMS["description"]
-        catalog = Entity("Catalogue", id, ctx=self.context)
-        catalog["type"] = str(SDMDCAT["Catalogue"])
-        
-        # .prop("name", DEFAULT_CATALOG["name"])
-        catalog.prop(
-            "title", DEFAULT_CATALOG["title"] # DCTERMS["title"], DEFAULT_CATALOG["title"]
-        ).prop(
-            "description", DEFAULT_CATALOG["description"], # DCTERMS["description"], DEFAULT_CATALOG["description"]
-        ).prop(
-            str(SDMDCAT["publisher"]), DEFAULT_CATALOG["publisher"]
-        ).prop(
-            str(SDMDCAT["homepage"]), DEFAULT_CATALOG["homepage"]
-        ).prop(
-            str(SDMDCAT["rights"]), DEFAULT_CATALOG["rights"]
-        ).prop(
-            str(SDMDCAT["license"]), DEFAULT_CATALOG["license"]
-        ) 
-        # .set_context(self.context)
-        
-        # catalog['id'] = create_id("Catalogue", id)
+        return EntityTemplate(str(SDMDCAT["Catalogue"]), "Catalogue", self.context, {
+            # "name": DEFAULT_CATALOG["name"]
+            "title": prop(DEFAULT_CATALOG["title"]),
+            "description": prop(DEFAULT_CATALOG["description"]),
+            str(SDMDCAT["publisher"]): prop(DEFAULT_CATALOG["publisher"]),
+            str(SDMDCAT["homepage"]): prop(DEFAULT_CATALOG["homepage"]),
+            str(SDMDCAT["rights"]): prop(DEFAULT_CATALOG["rights"]),
+            str(SDMDCAT["license"]): prop(DEFAULT_CATALOG["license"]),
+        })
 
-        return catalog
+    def create_new_catalog(self, id) -> Entity:
+        return self.catalog_template.fill(id, {})
+
+    def get_catalog(self, catalog_id: str, cached: bool = True) -> Entity:
+        id = "urn:ngsi-ld:Catalogue:" + catalog_id
+        catalog = self.cache.get(id) if cached else None
+        if catalog is not None:
+            return catalog
 
-    def get_catalog(self, catalog_id: str) -> Entity:
         # Check if catalog exists
         try:
-            id = "urn:ngsi-ld:Catalogue:" + catalog_id
             catalog = self.ngsild_api.get(id, ctx=self.context)
         except NgsiResourceNotFoundError as err:
             return None
-
+        self.cache.put(id, catalog)
         return catalog
 
     def inject_catalog(self, catalog_id: str) -> Entity:
-        # Check if catalog exists
-        catalog = self.get_catalog(catalog_id)
-        if catalog != None:
+        # Check if catalog exists (always asking the broker)
+        current = self.get_catalog(catalog_id, cached=False)
+        if current != None:
+            catalog = self.create_new_catalog(catalog_id)
+            if not self.catalog_description_changed(current, catalog):
+                return current
+
+            # Rewrite the whole catalogue only because its description has changed
+            log.info("Catalog %s description has changed", current.id)
+            # Its datasets and shards are kept
+            for name in (str(SDMDCAT["dataset"]), str(SDMDCAT["catalog"])):
+                if name in current.to_dict():
+                    catalog.to_dict()[name] = current.to_dict()[name]
+            self.ngsild_api.upsert(catalog)
+            self.cache.put(catalog.id, catalog)
             return catalog
 
         # Create organization as new catalog
         catalog = self.create_new_catalog(catalog_id)
         self.ngsild_api.create(catalog)
 
-        catalog = self.get_catalog(catalog_id)
+        catalog = self.get_catalog(catalog_id, cached=False)
         # Return reference to catalog
         return catalog
 
@@ -525,6 +720,8 @@ class NgsildBrokerDataInjector(object):
         return csource
 
     def form_validate_csource(self, form):
+        # Raises FormValidationError if the form is malformed
+        form = parse_form(form)
         id = "urn:ngsi-ld:ContextSourceRegistration:" + form[
             "DatasetProvider" 
         ].replace(" ", "-") 
@@ -532,13 +729,11 @@ class NgsildBrokerDataInjector(object):
         # What if two different Brokers want to be federated and inject to the same organization?
         # DatasetCreator/DatasetProvider cannot be the organization name or some common name.
 
+        # Already checked to be a valid URL
         endpoint = form["ScorpioSatelliteURL"] 
-        if not is_valid_url(endpoint):
-            raise Exception("Satellite URL is not a valid URL.")
-            # (400, description="Satellite URL is not a valid URL.")
 
         # TODO: check against valid NGSI-LD Smart Data Models
-        entity_type = form["DatasetType"]
+        entity_type = form["DatasetType"].uri
         entity_pattern = form["DatasetIDPattern"]
         if not entity_pattern.startswith("urn:ngsi-ld:"):
             entity_pattern = "urn:ngsi-ld:" + entity_pattern
@@ -549,68 +744,105 @@ class NgsildBrokerDataInjector(object):
             "entity": {"type": entity_type, "idPattern": entity_pattern},
         }
 
-    def get_csource(self, csource_id: str) -> CSourceRegistration:
-        # Check if catalog exists
+    def get_csource(self, csource_id: str, cached: bool = True) -> CSourceRegistration:
+        csource = self.cache.get(csource_id) if cached else None
+        if csource is not None:
+            return CSourceRegistration.from_dict(csource)
+
+        # Check if csource exists
         try:
             csource = self.ngsild_api.csourceregs.get(csource_id)
         except NgsiResourceNotFoundError as err:
             return None
+        self.cache.put(csource_id, csource)
         return CSourceRegistration.from_dict(csource)
 
-    def inject_csource(self, form) -> CSourceRegistration:
-        # Retrieve the necessary data from the form
-        csource_form = self.form_validate_csource(form)
+    def register_csource(self, csource_id: str, endpoint: str, entities: list) -> dict:
+        # entities: list of RegistrationInfo.EntityInfo
+        csource = (
+            CSourceRegistrationBuilder(
+                endpoint = endpoint,
+                information = RegistrationInfo(entities),
+                context = [self.context],
+            )
+            .id(csource_id)
+            .build()
+        )
+        self.ngsild_api.csourceregs.register(csource)
 
-        # Check if csource exists
-        csource = self.get_csource(csource_form["id"])
+        # Keep the registration as it has been sent
+        csource = self.create_new_csource(csource_id, [entity_info_to_dict(e) for e in entities], endpoint)
+        self.cache.put(csource_id, csource)
+        return csource
 
-        if csource is None:
-            entity_info = RegistrationInfo.EntityInfo(
-                type = csource_form["entity"]["type"],
-                id_pattern = csource_form["entity"]["idPattern"],
-            )
-            csource = (
-                CSourceRegistrationBuilder(
-                    endpoint = csource_form["endpoint"],
-                    information = RegistrationInfo([entity_info]),
-                    context = [self.context],
-                )
-                .id(csource_form["id"])
-                .build()
-            )
+    def patch_csource(self, csource_id: str, endpoint: str, entities: list) -> dict:
+        # NGSI-LD Update Context Source Registration (PATCH /csourceRegistrations/{registrationId})
+        # The fragment replaces the information and endpoint of the registration in place
+        entities = [entity_info_to_dict(e) for e in entities]
+        payload = {
+            "information": [{"entities": entities}],
+            "endpoint": endpoint,
+            "@context": [self.context],
+        }
+        r = self.ngsild_api.session.patch(
+            "{}/{}/{}".format(self.ngsild_api.url, ENDPOINT_CSOURCEREGS, csource_id),
+            data=json.dumps(payload),
+        )
+        self.ngsild_api.raise_for_status(r)
 
-            csource_id = self.ngsild_api.csourceregs.register(csource)
+        csource = self.create_new_csource(csource_id, entities, endpoint)
+        self.cache.put(csource_id, csource)
+        return csource
 
-        else:
-            # is it the type federated/registered too?
-            if not any(csource_form["entity"]["type"] == e.type for e in csource.information[0].entities):
-                # TODO: implement patch for cSourceRegistrations
-                # Right now: DELETE and REGISTER the new and updated cSourceRegistarion
+    def update_csource(self, csource_id: str, endpoint: str, entities: list) -> dict:
+        try:
+            return self.patch_csource(csource_id, endpoint, entities)
+        except HTTPError as err:
+            if err.response is None or err.response.status_code not in (405, 501):
+                raise
+        # Broker without PATCH support: DELETE and REGISTER the updated cSourceRegistration
+        log.warning("Context broker does not support cSourceRegistration PATCH")
+        self.delete_csource(csource_id)
+        return self.register_csource(csource_id, endpoint, entities)
+
+    def delete_csource(self, csource_id: str) -> None:
+        self.cache.invalidate(csource_id)
+        self.ngsild_api.csourceregs.delete(csource_id)
 
-                # DELETE
-                deleted = self.ngsild_api.csourceregs.delete(csource_form["id"])
-                
-                # CREATE and REGISTER new cSourceRegistration
-                entity_info = csource.information[0].entities # Previous entity_info
-                
-                entity_info.append(RegistrationInfo.EntityInfo(
+    def inject_csource(self, form) -> CSourceRegistration:
+        # Retrieve the necessary data from the form
+        csource_form = self.form_validate_csource(form)
+
+        # Concurrent submissions for the same csource are serialised
+        with self.locks.hold(csource_form["id"]):
+            # Check if csource exists
+            with phase("get_csource"):
+                csource = self.get_csource(csource_form["id"])
+
+            if csource is None:
+                entity_info = RegistrationInfo.EntityInfo(
                     type = csource_form["entity"]["type"],
                     id_pattern = csource_form["entity"]["idPattern"],
-                )) # New entity_info
-                
-                csource = (
-                    CSourceRegistrationBuilder(
-                        endpoint = csource_form["endpoint"],
-                        information = RegistrationInfo(entity_info),
-                        context = [self.context],
-                    )
-                    .id(csource_form["id"])
-                    .build()
                 )
-                
-                csource_id = self.ngsild_api.csourceregs.register(csource)
+                # The registration sent is the final state, no need to get it back from the broker
+                with phase("register_csource"):
+                    csource = CSourceRegistration.from_dict(
+                        self.register_csource(csource_form["id"], csource_form["endpoint"], [entity_info])
+                    )
 
-        # Get the last updated version
-        csource = self.get_csource(csource_form["id"])
+            else:
+                # is it the type federated/registered too?
+                if not any(csource_form["entity"]["type"] == e.type for e in csource.information[0].entities):
+                    entity_info = csource.information[0].entities # Previous entity_info
+                
+                    entity_info.append(RegistrationInfo.EntityInfo(
+                        type = csource_form["entity"]["type"],
+                        id_pattern = csource_form["entity"]["idPattern"],
+                    )) # New entity_info
+                
+                    with phase("update_csource"):
+                        csource = CSourceRegistration.from_dict(
+                            self.update_csource(csource_form["id"], csource_form["endpoint"], entity_info)
+                        )
 
         return csource
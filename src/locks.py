@@ -0,0 +1,61 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+
+class KeyedLocks(object):
+    """One lock per key (e.g. an entity id), created on demand and dropped once nobody holds or waits for it.
+
+    Different keys never block each other, whereas the same key is held by one thread at a time.
+    """
+
+    def __init__(self) -> None:
+        # key --> [lock, number of threads holding or waiting for it]
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key: str):
+        with self._lock:
+            entry = self._locks.get(key, None)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class AsyncKeyedLocks(object):
+    """asyncio counterpart of KeyedLocks, for coroutines running in the same event loop."""
+
+    def __init__(self) -> None:
+        # key --> [lock, number of tasks holding or waiting for it]
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._locks.get(key, None)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
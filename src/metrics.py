@@ -0,0 +1,187 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Seconds, from a cached lookup to a slow broker round trip
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labelnames: tuple, labels: tuple) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames=()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        # (suffix, labels, value)
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield "", labels, value
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, format_labels(self.labelnames, labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    @contextmanager
+    def track(self, *labels):
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # [count per bucket (not cumulative), +Inf count, sum]
+            entry = self._values.get(labels, None)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, (list(entry[0]), entry[1], entry[2])) for labels, entry in self._values.items()]
+        for labels, (counts, count, total) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", labels + (format_value(float(bound)),), cumulative
+            yield "_bucket", labels + ("+Inf",), count
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        bucket_labelnames = self.labelnames + ("le",)
+        for suffix, labels, value in self.samples():
+            labelnames = bucket_labelnames if suffix == "_bucket" else self.labelnames
+            lines.append("{}{}{} {}".format(self.name, suffix, format_labels(labelnames, labels), format_value(value)))
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Metric whose values are read when rendered, from counters kept elsewhere (cache, pool...)."""
+
+    def __init__(self, name: str, help: str, type: str, function, labelnames=()) -> None:
+        # function() --> value, or {labels tuple: value} when there are labelnames
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.function = function
+
+    def samples(self):
+        values = self.function()
+        if values is None:
+            return
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            if value is not None:
+                yield "", labels, value
+
+
+class Registry(object):
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "registry_requests_total", "HTTP requests handled, by endpoint and status code", ("endpoint", "status"),
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "registry_request_duration_seconds", "HTTP request latency, by endpoint", ("endpoint",),
+))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "registry_requests_in_flight", "HTTP requests being handled",
+))
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    "registry_phase_duration_seconds", "Latency of each phase of a form submission", ("phase",),
+))
+BROKER_REQUESTS = REGISTRY.register(Counter(
+    "registry_broker_requests_total", "Requests sent to the context broker, by operation and status code", ("operation", "status"),
+))
+BROKER_SECONDS = REGISTRY.register(Histogram(
+    "registry_broker_request_duration_seconds", "Context broker round trip latency, by operation", ("operation",),
+))
+BROKER_IN_FLIGHT = REGISTRY.register(Gauge(
+    "registry_broker_requests_in_flight", "Requests waiting for the context broker",
+))
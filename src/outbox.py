@@ -0,0 +1,218 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ingestion_queue import now, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_WORKERS = 4
+DEFAULT_INITIAL_DELAY = 1
+DEFAULT_MAX_DELAY = 60
+# Failed replays of an entry before it is given up, not counting transient errors
+DEFAULT_MAX_ATTEMPTS = 10
+# Seconds replayed entries are kept, so that their status can be queried
+DEFAULT_RETENTION = 7 * 24 * 3600
+# Entries not yet replayed, further submissions are refused
+DEFAULT_MAX_PENDING = 10000
+# Seconds between checks of the log when idle
+POLL_INTERVAL = 5
+
+FIELDS = ("id", "status", "attempts", "entities", "error", "created", "started", "finished")
+
+
+class OutboxFullError(Exception):
+    pass
+
+
+class Outbox(object):
+    """Durable append-only log of the validated submissions, replayed to the context broker.
+
+    Submissions are committed to a SQLite file in WAL mode before they are acknowledged. A
+    background thread takes them oldest first, up to `batch_size` at a time, and replays each one
+    with `handler` on `workers` threads. An entry that fails is retried on its own with exponential
+    backoff, without holding back the others, and is marked as failed after `max_attempts`; errors of
+    the `transient` types (broker unreachable) are retried without counting an attempt. Entries not
+    yet replayed when the process stops are replayed after the restart. At most `max_pending` entries
+    wait to be replayed, append() refuses the next ones.
+    """
+
+    def __init__(self, path: str, handler, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS,
+                 initial_delay=DEFAULT_INITIAL_DELAY, max_delay=DEFAULT_MAX_DELAY, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retention=DEFAULT_RETENTION, synchronous="FULL", transient=(), max_pending=DEFAULT_MAX_PENDING) -> None:
+        # handler(form: dict) --> ids of the entities written, raises if the entry has to be retried
+        self.path = path
+        self.handler = handler
+        self.batch_size = batch_size
+        self.workers = workers
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.transient = transient
+        self.max_pending = max_pending
+        self.replayed = 0
+        self.last_error = None
+        self._delay = initial_delay
+        self._started = False
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # FULL: acknowledged submissions also survive a power loss, NORMAL: only a process crash
+        self._db.execute("PRAGMA synchronous={}".format(synchronous))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE, form TEXT, "
+            "status TEXT, attempts INTEGER DEFAULT 0, entities TEXT, error TEXT, retry_at REAL DEFAULT 0, "
+            "created TEXT, started TEXT, finished TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, seq)")
+        # Interrupted by a restart
+        self._db.execute("UPDATE outbox SET status = ? WHERE status = ?", (JOB_QUEUED, JOB_RUNNING))
+        self._db.commit()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="outbox-replay", daemon=True).start()
+
+    def append(self, form: dict) -> dict:
+        id = uuid.uuid4().hex
+        with self._lock:
+            if self._pending() >= self.max_pending:
+                raise OutboxFullError("Outbox is full")
+            self._db.execute(
+                "INSERT INTO outbox (id, form, status, created) VALUES (?, ?, ?, ?)",
+                (id, json.dumps(form), JOB_QUEUED, now()),
+            )
+            self._db.commit()
+        self._wakeup.set()
+        return self.get(id)
+
+    def get(self, id: str) -> dict:
+        # Same fields as the jobs of the ingestion queue
+        with self._lock:
+            row = self._db.execute("SELECT " + ", ".join(FIELDS) + " FROM outbox WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(FIELDS, row))
+        entry["entities"] = json.loads(entry["entities"]) if entry["entities"] else []
+        return entry
+
+    def _next_batch(self) -> list:
+        # Entries due, marked as running
+        with self._lock:
+            batch = self._db.execute(
+                "SELECT seq, form, attempts FROM outbox WHERE status = ? AND retry_at <= ? ORDER BY seq LIMIT ?",
+                (JOB_QUEUED, time.time(), self.batch_size),
+            ).fetchall()
+            started = now()
+            self._db.executemany(
+                "UPDATE outbox SET status = ?, started = ? WHERE seq = ?",
+                [(JOB_RUNNING, started, seq) for seq, form, attempts in batch],
+            )
+            self._db.commit()
+        return batch
+
+    def _next_retry(self) -> float:
+        # Seconds until the next entry is due, None when there is none
+        with self._lock:
+            retry_at = self._db.execute(
+                "SELECT MIN(retry_at) FROM outbox WHERE status = ?", (JOB_QUEUED,)
+            ).fetchone()[0]
+        return None if retry_at is None else max(retry_at - time.time(), 0)
+
+    def _replay(self, entry: tuple) -> bool:
+        # --> False on a transient error
+        seq, form, attempts = entry
+        try:
+            entities = self.handler(json.loads(form))
+        except Exception as err:
+            self.last_error = repr(err)
+            transient = isinstance(err, self.transient)
+            if transient:
+                delay = self._delay
+            else:
+                attempts += 1
+                delay = min(self.initial_delay * 2 ** (attempts - 1), self.max_delay)
+            if not transient and attempts >= self.max_attempts:
+                log.error("Outbox entry %d failed %d times, giving up: %r", seq, attempts, err)
+                self._mark(seq, JOB_FAILED, attempts, error=self.last_error, finished=now())
+            else:
+                # Jitter, so that restarted replicas do not retry in lockstep
+                wait = random.uniform(delay / 2, delay)
+                log.warning("Outbox replay of entry %d failed (%r), retrying in %.1fs", seq, err, wait)
+                self._mark(seq, JOB_QUEUED, attempts, error=self.last_error, retry_at=time.time() + wait)
+            return not transient
+
+        self._mark(seq, JOB_DONE, attempts + 1, entities=json.dumps(entities or []), finished=now())
+        self.replayed += 1
+        return True
+
+    def _mark(self, seq: int, status: str, attempts: int, entities: str = None, error: str = None,
+              retry_at: float = 0, finished: str = None) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, entities = ?, error = ?, retry_at = ?, finished = ? "
+                "WHERE seq = ?",
+                (status, attempts, entities, error, retry_at, finished, seq),
+            )
+            self._db.commit()
+
+    def _prune(self) -> None:
+        cutoff = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() - self.retention))
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM outbox WHERE status IN (?, ?) AND finished < ?", (JOB_DONE, JOB_FAILED, cutoff),
+            )
+            self._db.commit()
+
+    def _run(self) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox-worker") as executor:
+            while True:
+                self._wakeup.clear()
+                batch = self._next_batch()
+                if not batch:
+                    self._prune()
+                    retry = self._next_retry()
+                    self._wakeup.wait(POLL_INTERVAL if retry is None else min(retry, POLL_INTERVAL))
+                    continue
+
+                # While the broker is unreachable, the wait doubles on every batch
+                if all(list(executor.map(self._replay, batch))):
+                    self._delay = self.initial_delay
+                else:
+                    self._delay = min(self._delay * 2, self.max_delay)
+
+    def count(self, status: str) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (status,)).fetchone()[0]
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._pending()
+
+    def _pending(self) -> int:
+        # Caller holds the lock
+        return self._db.execute(
+            "SELECT COUNT(*) FROM outbox WHERE status IN (?, ?)", (JOB_QUEUED, JOB_RUNNING),
+        ).fetchone()[0]
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "max_pending": self.max_pending,
+            "failed": self.count(JOB_FAILED),
+            "replayed": self.replayed,
+            "last_error": self.last_error,
+        }
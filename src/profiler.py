@@ -0,0 +1,58 @@
+import sys
+import threading
+import time
+from collections import Counter
+
+
+DEFAULT_INTERVAL = 0.01
+DEFAULT_MAX_SECONDS = 60
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all the threads at a fixed interval.
+
+    The result is in the collapsed stack format ("outer;...;inner count" per line) read by
+    flamegraph.pl and speedscope. Only one profile runs at a time.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, max_seconds=DEFAULT_MAX_SECONDS) -> None:
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    def profile(self, seconds: float) -> str:
+        seconds = min(seconds, self.max_seconds)
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("A profile is already running")
+        try:
+            stacks = self.sample(seconds)
+        finally:
+            self._lock.release()
+        return "".join("{} {}\n".format(stack, count) for stack, count in stacks.most_common())
+
+    def sample(self, seconds: float) -> Counter:
+        stacks = Counter()
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return stacks
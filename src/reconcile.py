@@ -0,0 +1,378 @@
+"""Reconciliation of the registry with the context broker.
+
+The catalogues of the registry are checked one at a time: their datasets are streamed from the
+broker a page at a time, the distributions they reference are looked up in a batch per page and the
+context source registration of each provider once per run. Only the ids of the datasets of the
+catalogue being checked (as many as the catalogue lists itself) and the entity types of each provider
+are kept, never the entities themselves nor the ids of the whole broker. The drift found is reported
+and, with --repair, fixed with batched writes:
+
+- dangling_distributions: distributions referenced by a dataset that do not exist (removed from it)
+- dangling_members: datasets listed by a catalogue that do not exist (removed from it)
+- missing_members: datasets of a catalogue that it does not list (appended to it)
+- missing_catalogs: catalogues of the registry that do not exist (injected again)
+- stale_index: datasets of the local index that do not exist (removed from it)
+- missing_csources, unregistered_types: providers of the datasets without a context source
+  registration, or whose registration lacks their entity types (only reported, the endpoint and id
+  pattern are only known from the submissions)
+
+    python reconcile.py [--repair] [--page-size 100]
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from ngsildclient import Entity
+
+from config import load_config, create_broker, create_catalogs
+from injector_ngsildclient import SDM, SDMDCAT, relationship_objects, entity_name_type_from_id
+from registry_index import attr_values
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_PAGE_SIZE = 100
+# Seconds between scheduled runs, 0: not scheduled
+DEFAULT_INTERVAL = 0
+# Drift entries listed in a report, all of them are counted
+MAX_REPORTED = 100
+
+DRIFT = (
+    "dangling_distributions",
+    "dangling_members",
+    "missing_members",
+    "missing_catalogs",
+    "stale_index",
+    "missing_csources",
+    "unregistered_types",
+)
+
+DATASET_PREFIX = "urn:ngsi-ld:Dataset:"
+CSOURCE_PREFIX = "urn:ngsi-ld:ContextSourceRegistration:"
+ENDPOINT_ENTITIES = "ngsi-ld/v1/entities"
+
+
+class ReconciliationBusyError(Exception):
+    pass
+
+
+def entity_pages(client, entity_type: str, context: str = None, page_size: int = DEFAULT_PAGE_SIZE, **params):
+    # Pages of the entities of a type (GET /entities?type=&offset=&limit=), a single page in memory at a time
+    # params: other filters, e.g. idPattern or id
+    headers = {"Accept": "application/ld+json", "Content-Type": None}
+    if context:
+        headers["Link"] = '<{}>; rel="http://www.w3.org/ns/json-ld#context"; type="application/ld+json"'.format(context)
+    offset = 0
+    while True:
+        r = client.session.get(
+            "{}/{}".format(client.url, ENDPOINT_ENTITIES), headers=headers,
+            params=dict(params, type=entity_type, offset=offset, limit=page_size),
+        )
+        client.raise_for_status(r)
+        page = [Entity.from_dict(payload) for payload in r.json()]
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def id_prefix_pattern(prefix: str) -> str:
+    # idPattern of the ids starting with prefix, only the regex metacharacters are escaped
+    return "^" + re.sub(r"([.^$*+?()\[\]{}|\\])", r"\\\1", prefix)
+
+
+def dataset_catalog_name(dataset_id: str) -> str:
+    # Dataset ids are urn:ngsi-ld:Dataset:<catalogue name>:<type>
+    return dataset_id[len(DATASET_PREFIX):].split(":", 1)[0] if dataset_id.startswith(DATASET_PREFIX) else None
+
+
+class Reconciler(object):
+    """Compares the entities of the context broker with what the registry expects (see the module).
+
+    A run scans the catalogues of the registry one after the other, one run at a time; entities written
+    meanwhile may look like drift, so every dangling member is checked again before it is repaired. The report of the last run is kept
+    for /stats and /metrics.
+    """
+
+    def __init__(self, broker, catalogs, index=None, page_size=DEFAULT_PAGE_SIZE) -> None:
+        # catalogs: CatalogShards, index: RegistryIndex of the service (None from the command line)
+        self.broker = broker
+        self.catalogs = catalogs
+        self.index = index
+        self.page_size = page_size
+        self.runs = 0
+        self.last_report = None
+        self._lock = threading.Lock()
+
+    def run(self, repair: bool = False) -> dict:
+        if not self._lock.acquire(blocking=False):
+            raise ReconciliationBusyError()
+        try:
+            report = self._run(repair)
+        finally:
+            self._lock.release()
+        self.runs += 1
+        self.last_report = report
+        return report
+
+    def _drift(self, report: dict, kind: str, item) -> None:
+        drift = report["drift"][kind]
+        drift["count"] += 1
+        if len(drift["items"]) < MAX_REPORTED:
+            drift["items"].append(item)
+
+    def _exists(self, entity_id: str) -> bool:
+        return self.broker.ngsild_api.exists(entity_id)
+
+    def _run(self, repair: bool) -> dict:
+        start = time.monotonic()
+        report = {
+            "repair": repair,
+            "drift": {kind: {"count": 0, "items": []} for kind in DRIFT},
+            "repaired": {kind: 0 for kind in DRIFT},
+            "scanned": {"catalogs": 0, "datasets": 0, "distributions": 0, "csources": 0},
+            "pages": 0,
+        }
+
+        # Catalogues of the registry, others sharing the broker are ignored
+        # csource id --> entity types it registers (None when it does not exist), looked up once per provider
+        csources = {}
+        names = set()
+        for catalog in self.catalogs.all():
+            names.add(entity_name_type_from_id(catalog.id)[0])
+            self._reconcile_catalog(report, catalog, csources, repair)
+
+        if self.index is not None:
+            # Datasets of the index whose catalogue is no longer part of the registry
+            self._check_index(report, [
+                dataset_id for dataset_id in self.index.dataset_ids() if dataset_catalog_name(dataset_id) not in names
+            ], (), repair)
+
+        report["seconds"] = round(time.monotonic() - start, 3)
+        scanned = sum(report["scanned"].values())
+        report["entities_per_second"] = round(scanned / report["seconds"], 1) if report["seconds"] else None
+        log.info(
+            "Reconciliation scanned %d entities in %d pages (%.3fs): %s", scanned, report["pages"], report["seconds"],
+            {kind: drift["count"] for kind, drift in report["drift"].items() if drift["count"]} or "no drift",
+        )
+        return report
+
+    def _reconcile_catalog(self, report: dict, catalog: Entity, csources: dict, repair: bool) -> None:
+        name, type_ = entity_name_type_from_id(catalog.id)
+        current = self.broker.get_catalog(name, cached=False)
+        if current is not None:
+            report["scanned"]["catalogs"] += 1
+        else:
+            self._drift(report, "missing_catalogs", catalog.id)
+            if repair:
+                self.broker.inject_catalog(name)
+                report["repaired"]["missing_catalogs"] += 1
+
+        # Ids of the datasets of the catalogue in the broker
+        seen = set()
+        pattern = id_prefix_pattern(DATASET_PREFIX + name + ":")
+        for page in entity_pages(
+            self.broker.ngsild_api, str(SDMDCAT["Dataset"]), self.broker.context or None, self.page_size, idPattern=pattern,
+        ):
+            report["pages"] += 1
+            report["scanned"]["datasets"] += len(page)
+            self._check_datasets(report, page, repair)
+            self._check_providers(report, page, csources)
+            seen.update(dataset.id for dataset in page)
+
+        if self.index is not None:
+            self._check_index(report, [
+                dataset_id for dataset_id in self.index.dataset_ids() if dataset_catalog_name(dataset_id) == name
+            ], seen, repair)
+        # A missing catalogue injected again lists every dataset again
+        if current is not None or repair:
+            self._check_catalog(report, catalog, current, seen, repair)
+
+    def _existing(self, report: dict, entity_type: str, entity_ids: set) -> set:
+        # Ids of those entities the broker has, asked page_size ids at a time (GET /entities?id=a,b,...)
+        entity_ids = sorted(entity_ids)
+        existing = set()
+        for offset in range(0, len(entity_ids), self.page_size):
+            ids = entity_ids[offset:offset + self.page_size]
+            # A single page holds them all
+            pages = entity_pages(self.broker.ngsild_api, entity_type, self.broker.context or None, len(ids), id=",".join(ids))
+            report["pages"] += 1
+            existing.update(entity.id for entity in next(pages, []))
+        return existing
+
+    def _check_datasets(self, report: dict, page: list, repair: bool) -> None:
+        # Distributions referenced by the datasets of a page, looked up and repaired with a batch each
+        references = OrderedDict(
+            (dataset.id, attr_values(dataset.to_dict(), str(SDMDCAT["distribution"]))) for dataset in page
+        )
+        referenced = {distribution_id for distribution_ids in references.values() for distribution_id in distribution_ids}
+        report["scanned"]["distributions"] += len(referenced)
+        existing = self._existing(report, str(SDMDCAT["Distribution"]), referenced)
+
+        dangling = {}
+        for dataset in page:
+            missing = [distribution_id for distribution_id in references[dataset.id] if distribution_id not in existing]
+            for distribution_id in missing:
+                self._drift(report, "dangling_distributions", {"dataset": dataset.id, "distribution": distribution_id})
+            if missing:
+                dangling[dataset.id] = (dataset, missing)
+        if not repair or not dangling:
+            return
+
+        # Serialised with the submissions of the same datasets, locks taken in id order
+        with ExitStack() as stack:
+            for dataset_id in sorted(dangling):
+                stack.enter_context(self.broker.locks.hold(dataset_id))
+            fixes = []
+            for dataset, missing in dangling.values():
+                kept = [distribution_id for distribution_id in references[dataset.id] if distribution_id not in missing]
+                fixes.append(Entity.from_dict({
+                    "id": dataset.id,
+                    "type": dataset.type,
+                    str(SDMDCAT["distribution"]): {"type": "Relationship", "object": kept},
+                    "@context": self.broker.context,
+                }))
+            self.broker.ngsild_api.upsert(*fixes, update=True)
+            for dataset, missing in dangling.values():
+                self.broker.cache.invalidate(dataset.id)
+                # Written again by the next submission of the dataset
+                self.broker.hashes.forget([dataset.id] + missing)
+                report["repaired"]["dangling_distributions"] += len(missing)
+
+    def _check_providers(self, report: dict, page: list, csources: dict) -> None:
+        # Context source registration of the providers of a page, each one read once per run
+        for dataset in page:
+            payload = dataset.to_dict()
+            types = set(attr_values(payload, str(SDMDCAT["Type"])))
+            for provider in attr_values(payload, str(SDM["dataProvider"])):
+                csource_id = CSOURCE_PREFIX + str(provider).replace(" ", "-")
+                if csource_id not in csources:
+                    csource = self.broker.get_csource(csource_id, cached=False)
+                    if csource is None:
+                        self._drift(report, "missing_csources", csource_id)
+                        csources[csource_id] = None
+                    else:
+                        report["scanned"]["csources"] += 1
+                        csources[csource_id] = {
+                            entity.type for information in csource.information for entity in information.entities
+                        }
+                registered = csources[csource_id]
+                if registered is None:
+                    continue
+                for type_ in sorted(types - registered):
+                    self._drift(report, "unregistered_types", {"csource": csource_id, "type": type_})
+                    # Reported once per run
+                    registered.add(type_)
+
+    def _check_index(self, report: dict, dataset_ids: list, seen: set, repair: bool) -> None:
+        # Datasets served by the read endpoints that are no longer in the broker
+        for dataset_id in sorted(dataset_ids):
+            if dataset_id in seen or self._exists(dataset_id):
+                continue
+            self._drift(report, "stale_index", dataset_id)
+            if repair:
+                self.index.remove_dataset(dataset_id)
+                report["repaired"]["stale_index"] += 1
+
+    def _check_catalog(self, report: dict, catalog: Entity, current: Entity, expected: set, repair: bool) -> None:
+        # current: the catalogue in the broker, None when it has just been injected again
+        # expected: ids of the datasets of the catalogue in the broker
+        instances = current.to_dict().get(str(SDMDCAT["dataset"]), []) if current is not None else []
+        instances = instances if isinstance(instances, list) else [instances]
+        members = set(relationship_objects(instances))
+
+        dangling = sorted(
+            dataset_id for dataset_id in members - expected if not self._exists(dataset_id)
+        )
+        missing = sorted(expected - members)
+        for dataset_id in dangling:
+            self._drift(report, "dangling_members", {"catalog": catalog.id, "dataset": dataset_id})
+        for dataset_id in missing:
+            self._drift(report, "missing_members", {"catalog": catalog.id, "dataset": dataset_id})
+        if not repair or not (dangling or missing):
+            return
+
+        with self.broker.locks.hold(catalog.id):
+            if dangling:
+                # One instance per member, and the single list of the catalogues written before them
+                self.broker.delete_catalog_datasets(catalog, [
+                    instance["datasetId"] for instance in instances
+                    if instance.get("datasetId", None) in dangling
+                ])
+                for instance in instances:
+                    if "datasetId" not in instance and set(relationship_objects(instance)) & set(dangling):
+                        kept = [dataset_id for dataset_id in relationship_objects(instance) if dataset_id not in dangling]
+                        self.broker.ngsild_api.upsert(Entity.from_dict({
+                            "id": catalog.id,
+                            "type": catalog.type,
+                            str(SDMDCAT["dataset"]): {"type": "Relationship", "object": kept},
+                            "@context": self.broker.context,
+                        }), update=True)
+                self.broker.get_catalog_datasets(catalog).difference_update(dangling)
+                report["repaired"]["dangling_members"] += len(dangling)
+            if missing:
+                self.broker.append_catalog_datasets(catalog, missing)
+                self.broker.get_catalog_datasets(catalog).update(missing)
+                report["repaired"]["missing_members"] += len(missing)
+
+    def stats(self) -> dict:
+        report = self.last_report
+        return {
+            "runs": self.runs,
+            "running": self._lock.locked(),
+            "last_run": {
+                "repair": report["repair"],
+                "drift": {kind: drift["count"] for kind, drift in report["drift"].items()},
+                "repaired": report["repaired"],
+                "scanned": report["scanned"],
+                "seconds": report["seconds"],
+                "entities_per_second": report["entities_per_second"],
+            } if report is not None else None,
+        }
+
+    def schedule(self, interval: float, repair: bool = False) -> None:
+        # Background runs every `interval` seconds
+        def run_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.run(repair)
+                except ReconciliationBusyError:
+                    pass
+                except Exception as err:
+                    log.warning("Scheduled reconciliation failed: %r", err)
+        threading.Thread(target=run_forever, name="reconciliation", daemon=True).start()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Reconciliation of the registry with the context broker.")
+    parser.add_argument("--config", default="config.json", help="configuration file (default: config.json)")
+    parser.add_argument("--repair", action="store_true", help="fix the drift found, otherwise it is only reported")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="entities per broker request")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    conf, dcat_entities = load_config(args.config)
+    broker = create_broker(conf, dcat_entities)
+    catalog = broker.inject_catalog(dcat_entities["catalog"]["name"])
+    catalogs = create_catalogs(conf, broker, catalog)
+    # Shards written by the service
+    for name in catalogs.linked():
+        catalogs.get(name)
+
+    report = Reconciler(broker, catalogs, page_size=args.page_size).run(args.repair)
+    print(json.dumps(report))
+    drift = sum(drift["count"] for drift in report["drift"].values())
+    return 1 if drift and not args.repair else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+import json
+import threading
+import uuid
+
+from ngsildclient import Entity
+
+from injector_ngsildclient import SDMDCAT
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Search parameter --> indexed dataset property
+FACETS = {
+    "theme": str(SDMDCAT["theme"]),
+    "language": str(SDMDCAT["language"]),
+    "spatial": str(SDMDCAT["spatial"]),
+    "keyword": str(SDMDCAT["keyword"]),
+    "accessRights": str(SDMDCAT["accessRights"]),
+    "publisher": str(SDMDCAT["publisher"]),
+}
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 1000
+
+
+def to_payload(entity) -> dict:
+    # Plain JSON payload, a snapshot not shared with the entity
+    return json.loads(entity.to_json()) if isinstance(entity, Entity) else entity
+
+
+def attr_values(payload: dict, name: str) -> list:
+    attr = payload.get(name, None)
+    if attr is None:
+        return []
+    value = attr.get("value", attr.get("object", None))
+    return value if isinstance(value, list) else [value]
+
+
+class RegistryIndex(object):
+    """Local materialised view of the Catalogue, Dataset and Distribution entities written by this
+    service, with inverted indexes on the FACETS properties of the datasets.
+
+    Reads (listing, filtered and faceted search, lookups) never reach the context broker.
+    """
+
+    def __init__(self) -> None:
+        # id --> NGSI-LD payload
+        self.catalogs = {}
+        self.datasets = {}
+        self.distributions = {}
+        # Catalogue id --> dataset ids, dataset id --> catalogue id
+        self.members = {}
+        self.dataset_catalog = {}
+        # Parent catalogue id --> ids of its shards
+        self.shards = {}
+        # Facet --> value --> dataset ids
+        self.postings = {facet: {} for facet in FACETS}
+        # Sorted dataset ids, rebuilt after a change
+        self._sorted = None
+        self.loaded = False
+        # Incremented on every change, the epoch tells versions of different processes apart
+        self.version = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+
+    def put_catalog(self, catalog: Entity, parent_id: str = None) -> None:
+        # parent_id: catalogue listing this one as a shard
+        payload = to_payload(catalog)
+        # Membership and shards are kept by the index
+        payload.pop(str(SDMDCAT["dataset"]), None)
+        payload.pop(str(SDMDCAT["catalog"]), None)
+        with self._lock:
+            self.catalogs[payload["id"]] = payload
+            self.members.setdefault(payload["id"], set())
+            if parent_id is not None and parent_id != payload["id"]:
+                self.shards.setdefault(parent_id, set()).add(payload["id"])
+            self.version += 1
+
+    def put_dataset(self, catalog_id: str, dataset: Entity, distributions: list, replace: bool = True) -> None:
+        # replace=False: do not overwrite what this process has already written (e.g. while loading)
+        payload = to_payload(dataset)
+        distributions = [to_payload(distribution) for distribution in distributions]
+        with self._lock:
+            if payload["id"] in self.datasets:
+                if not replace:
+                    return
+                self._unindex(payload["id"])
+            self.datasets[payload["id"]] = payload
+            for distribution in distributions:
+                self.distributions[distribution["id"]] = distribution
+            self.members.setdefault(catalog_id, set()).add(payload["id"])
+            self.dataset_catalog[payload["id"]] = catalog_id
+            for facet, name in FACETS.items():
+                for value in attr_values(payload, name):
+                    self.postings[facet].setdefault(value, set()).add(payload["id"])
+            self._sorted = None
+            self.version += 1
+
+    def remove_dataset(self, dataset_id: str) -> None:
+        with self._lock:
+            if dataset_id in self.datasets:
+                self._unindex(dataset_id)
+                payload = self.datasets.pop(dataset_id)
+                for distribution_id in attr_values(payload, str(SDMDCAT["distribution"])):
+                    self.distributions.pop(distribution_id, None)
+                self._sorted = None
+                self.version += 1
+
+    def _unindex(self, dataset_id: str) -> None:
+        payload = self.datasets[dataset_id]
+        for facet, name in FACETS.items():
+            postings = self.postings[facet]
+            for value in attr_values(payload, name):
+                ids = postings.get(value, None)
+                if ids is not None:
+                    ids.discard(dataset_id)
+                    if not ids:
+                        del postings[value]
+        catalog_id = self.dataset_catalog.pop(dataset_id, None)
+        if catalog_id is not None:
+            self.members[catalog_id].discard(dataset_id)
+
+    def load(self, client, members: dict, context: str = None, hashes=None) -> None:
+        # Datasets (and their distributions) of the catalogues written before this process started
+        # members: catalogue id --> dataset ids, hashes: ContentHashes of the entities the broker has
+        dataset_catalog = {
+            dataset_id: catalog_id for catalog_id, dataset_ids in members.items() for dataset_id in dataset_ids
+        }
+        distributions = {
+            distribution.id: distribution
+            for distribution in client.query_generator(type=str(SDMDCAT["Distribution"]), ctx=context)
+        }
+        count = 0
+        for dataset in client.query_generator(type=str(SDMDCAT["Dataset"]), ctx=context):
+            if dataset.id not in dataset_catalog:
+                continue
+            dataset_distributions = [
+                distributions[distribution_id]
+                for distribution_id in attr_values(dataset.to_dict(), str(SDMDCAT["distribution"]))
+                if distribution_id in distributions
+            ]
+            self.put_dataset(dataset_catalog[dataset.id], dataset, dataset_distributions, replace=False)
+            if hashes is not None:
+                hashes.put([dataset] + dataset_distributions)
+            count += 1
+        self.loaded = True
+        log.info("Registry index loaded %d datasets of %d catalogues", count, len(members))
+
+    def catalog(self, catalog_id: str) -> dict:
+        with self._lock:
+            return self._catalog(catalog_id)
+
+    def _catalog(self, catalog_id: str) -> dict:
+        payload = self.catalogs.get(catalog_id, None)
+        if payload is None:
+            return None
+        payload = dict(payload)
+        payload[str(SDMDCAT["dataset"])] = {"type": "Relationship", "object": sorted(self.members[catalog_id])}
+        if catalog_id in self.shards:
+            payload[str(SDMDCAT["catalog"])] = {"type": "Relationship", "object": sorted(self.shards[catalog_id])}
+        return payload
+
+    def snapshot(self, catalog_id: str) -> tuple:
+        # A catalogue, its shards and their datasets at a version, for serialisation outside the lock:
+        # --> (version, [catalogue payload, ...], [(dataset payload, [distribution payload, ...]), ...])
+        # Stored payloads are replaced, never modified, so only references are copied
+        with self._lock:
+            payload = self._catalog(catalog_id)
+            if payload is None:
+                return self.version, [], []
+            catalogs = [payload] + [self._catalog(shard_id) for shard_id in sorted(self.shards.get(catalog_id, ()))]
+            datasets = []
+            for catalog in catalogs:
+                for dataset_id in catalog[str(SDMDCAT["dataset"])]["object"]:
+                    dataset = self.datasets.get(dataset_id, None)
+                    if dataset is not None:
+                        datasets.append((dataset, [
+                            self.distributions[distribution_id]
+                            for distribution_id in attr_values(dataset, str(SDMDCAT["distribution"]))
+                            if distribution_id in self.distributions
+                        ]))
+            return self.version, catalogs, datasets
+
+    def list_catalogs(self) -> list:
+        # [{"id", "datasets": count, "shards": ids}, ...]
+        with self._lock:
+            return [
+                {
+                    "id": catalog_id,
+                    "datasets": len(self.members[catalog_id]),
+                    "shards": sorted(self.shards.get(catalog_id, ())),
+                }
+                for catalog_id in sorted(self.catalogs)
+            ]
+
+    def dataset_ids(self) -> list:
+        with self._lock:
+            return list(self.datasets)
+
+    def dataset(self, dataset_id: str) -> dict:
+        # --> {"dataset": payload, "distributions": [payload, ...]}, None when unknown
+        with self._lock:
+            payload = self.datasets.get(dataset_id, None)
+            if payload is None:
+                return None
+            distributions = [
+                self.distributions[distribution_id]
+                for distribution_id in attr_values(payload, str(SDMDCAT["distribution"]))
+                if distribution_id in self.distributions
+            ]
+        return {"dataset": payload, "distributions": distributions}
+
+    def search(self, filters: dict = {}, catalog_id: str = None, offset: int = 0, limit: int = DEFAULT_LIMIT) -> dict:
+        # filters: facet --> values; values of a facet are OR'ed, facets are AND'ed
+        with self._lock:
+            matches = None
+            if catalog_id is not None:
+                matches = set(self.members.get(catalog_id, ()))
+            for facet, values in filters.items():
+                postings = self.postings[facet]
+                ids = set()
+                for value in values:
+                    ids |= postings.get(value, set())
+                matches = ids if matches is None else matches & ids
+
+            if matches is None:
+                if self._sorted is None:
+                    self._sorted = sorted(self.datasets)
+                ids = self._sorted
+                facets = {
+                    facet: {value: len(ids) for value, ids in postings.items()}
+                    for facet, postings in self.postings.items()
+                }
+            else:
+                ids = sorted(matches)
+                facets = {facet: {} for facet in FACETS}
+                for dataset_id in ids:
+                    payload = self.datasets[dataset_id]
+                    for facet, name in FACETS.items():
+                        counts = facets[facet]
+                        for value in attr_values(payload, name):
+                            counts[value] = counts.get(value, 0) + 1
+
+            return {
+                "total": len(ids),
+                "offset": offset,
+                "limit": limit,
+                "datasets": [self.datasets[dataset_id] for dataset_id in ids[offset:offset + limit]],
+                "facets": facets,
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "catalogs": len(self.catalogs),
+                "datasets": len(self.datasets),
+                "distributions": len(self.distributions),
+                "version": self.version,
+            }
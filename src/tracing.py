@@ -0,0 +1,141 @@
+import random
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from contextlib import contextmanager
+from functools import wraps
+
+from metrics import PHASE_SECONDS
+
+
+DEFAULT_SAMPLE_RATE = 0.0
+DEFAULT_MAX_TRACES = 100
+
+
+class Trace(object):
+    def __init__(self, name: str, attrs: dict) -> None:
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        # [name, start offset, duration, depth, attrs], in start order
+        self.spans = []
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "attrs": self.attrs,
+            "started": self.started,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "error": self.error,
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round(start * 1000, 3),
+                    "duration_ms": round(duration * 1000, 3) if duration is not None else None,
+                    "depth": depth,
+                    "attrs": attrs,
+                }
+                for name, start, duration, depth, attrs in self.spans
+            ],
+        }
+
+
+class Tracer(object):
+    """Sampled request tracing, the last traces are kept in a bounded ring buffer.
+
+    A trace is bound to the thread or asyncio task that started it (and to the tasks it creates);
+    spans opened in other threads (e.g. the upsert batcher) are not recorded. With a sample rate
+    of 0 spans cost one context variable lookup.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, max_traces=DEFAULT_MAX_TRACES) -> None:
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=max_traces)
+        # (trace, depth of the next span)
+        self._current = ContextVar("trace", default=None)
+
+    def current(self) -> Trace:
+        current = self._current.get()
+        return current[0] if current is not None else None
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        # Nested in an active trace it is just a span
+        if self.current() is not None:
+            with self.span(name, **attrs):
+                yield
+            return
+
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            yield
+            return
+
+        trace = Trace(name, attrs)
+        token = self._current.set((trace, 0))
+        try:
+            yield
+        except BaseException as err:
+            trace.error = repr(err)
+            raise
+        finally:
+            trace.duration = time.perf_counter() - trace.start
+            self._current.reset(token)
+            self.traces.append(trace)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        current = self._current.get()
+        if current is None:
+            yield
+            return
+
+        trace, depth = current
+        span = [name, time.perf_counter() - trace.start, None, depth, attrs]
+        trace.spans.append(span)
+        token = self._current.set((trace, depth + 1))
+        try:
+            yield
+        except BaseException as err:
+            attrs["error"] = repr(err)
+            raise
+        finally:
+            self._current.reset(token)
+            span[2] = time.perf_counter() - trace.start - span[1]
+
+    def traced(self, name: str):
+        # Decorator, e.g. for Flask views
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.trace(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def recent(self, limit: int = None) -> list:
+        # Most recent first
+        traces = list(self.traces)[::-1]
+        return [trace.to_dict() for trace in traces[:limit]]
+
+    def get(self, trace_id: str) -> dict:
+        for trace in list(self.traces):
+            if trace.id == trace_id:
+                return trace.to_dict()
+        return None
+
+
+# Shared by the webhook, the injector and the HTTP pool, configured at start up
+TRACER = Tracer()
+
+
+@contextmanager
+def phase(name: str):
+    # Phase of a submission: latency histogram and, when sampled, trace span
+    with PHASE_SECONDS.time(name), TRACER.span(name):
+        yield
@@ -0,0 +1,137 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from ngsildclient import Entity
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_WINDOW_MS = 50
+DEFAULT_MAX_ENTITIES = 100
+
+
+class BatchUpsertError(Exception):
+    def __init__(self, errors: list) -> None:
+        super().__init__("Error while upserting entities: {}".format(errors))
+        self.errors = errors
+
+
+class PendingUpsert(object):
+    def __init__(self, entities: list, catalog: Entity, members: list) -> None:
+        self.entities = entities
+        self.catalog = catalog
+        self.members = members
+        self.future = Future()
+
+    def size(self) -> int:
+        # Entities sent, the catalogue counts when datasets are appended to it
+        return len(self.entities) + (1 if self.catalog is not None else 0)
+
+    def ids(self) -> set:
+        ids = {entity.id for entity in self.entities}
+        if self.catalog is not None:
+            ids.add(self.catalog.id)
+        return ids
+
+
+class UpsertBatcher(object):
+    """Coalesces the upserts of concurrent submissions into a single batch upsert.
+
+    A batch is flushed when `window_ms` have elapsed since its first submission or when it holds
+    `max_entities` entities. Entities sharing an id are merged (last submission wins) and the new
+    datasets of each catalogue are appended once per batch through `catalog_writer(catalog, dataset_ids)`.
+    Every caller gets back its own result or error.
+    """
+
+    def __init__(self, client, catalog_writer, window_ms=DEFAULT_WINDOW_MS, max_entities=DEFAULT_MAX_ENTITIES) -> None:
+        self.client = client
+        self.catalog_writer = catalog_writer
+        self.window = window_ms / 1000
+        self.max_entities = max_entities
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._work, name="upsert-batcher", daemon=True)
+        self._thread.start()
+
+    def upsert(self, entities: list, catalog: Entity = None, members: list = ()):
+        pending = PendingUpsert(list(entities), catalog, list(members))
+        self._queue.put(pending)
+        # Block the calling request until its batch has been flushed
+        return pending.future.result()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        size = batch[0].size()
+        deadline = time.monotonic() + self.window
+        while size < self.max_entities:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(pending)
+            size += pending.size()
+        return batch
+
+    def _merge(self, batch: list) -> list:
+        entities = OrderedDict()
+        for pending in batch:
+            for entity in pending.entities:
+                # Keep the position of the first occurrence but the content of the last one
+                entities[entity.id] = entity
+        return list(entities.values())
+
+    def _catalogs(self, batch: list) -> list:
+        # --> [(catalog, dataset ids to append), ...] of the submissions written
+        catalogs = OrderedDict()
+        for pending in batch:
+            if pending.catalog is not None:
+                catalog, members = catalogs.setdefault(pending.catalog.id, (pending.catalog, []))
+                members.extend(pending.members)
+        return list(catalogs.values())
+
+    def _work(self) -> None:
+        while True:
+            batch = self._collect()
+            entities = self._merge(batch)
+            log.debug("Flushing %d submissions as a batch of %d entities", len(batch), len(entities))
+
+            try:
+                # Submissions without changed entities may only append datasets to their catalogue
+                result = self.client.upsert(entities) if entities else None
+            except Exception as err:
+                for pending in batch:
+                    pending.future.set_exception(err)
+                continue
+
+            # A submission with an entity not written fails, and its datasets are not appended
+            errors = getattr(result, "errors", [])
+            written = []
+            for pending in batch:
+                ids = pending.ids()
+                own_errors = [error for error in errors if error.get("entityId") in ids]
+                if own_errors:
+                    pending.future.set_exception(BatchUpsertError(own_errors))
+                else:
+                    written.append(pending)
+
+            catalog_errors = {}
+            for catalog, members in self._catalogs(written):
+                try:
+                    self.catalog_writer(catalog, members)
+                except Exception as err:
+                    catalog_errors[catalog.id] = err
+
+            for pending in written:
+                if pending.catalog is not None and pending.catalog.id in catalog_errors:
+                    pending.future.set_exception(catalog_errors[pending.catalog.id])
+                else:
+                    pending.future.set_result(result)
@@ -1,4 +1,5 @@
 import ipaddress
+import re
 from urllib.parse import urlparse
 
 
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+
+import pytest
+
+import admission as admission_module
+from admission import AdmissionControl, RateLimitedError, SaturatedError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_a_provider_is_limited_to_its_burst_then_its_rate(clock):
+    admission = AdmissionControl(rate=2, burst=3)
+    for _ in range(3):
+        admission.admit("Provider A")
+    with pytest.raises(RateLimitedError) as err:
+        admission.admit("Provider A")
+    assert err.value.retry_after == 1
+
+    # Other providers have their own bucket
+    admission.admit("Provider B")
+
+    clock[0] += 0.5
+    admission.admit("Provider A")
+    stats = admission.stats()
+    assert stats["admitted"] == 5 and stats["rate_limited"] == 1
+    assert stats["providers"]["Provider A"] == {"tokens": 0, "rate": 2, "burst": 3, "admitted": 4, "limited": 1}
+
+
+def test_providers_override_the_default_limits(clock):
+    admission = AdmissionControl(rate=1, burst=1, providers={"Slow": {"rate": 0.1}})
+    admission.admit("Slow")
+    with pytest.raises(RateLimitedError) as err:
+        admission.admit("Slow")
+    # Rounded up to whole seconds
+    assert err.value.retry_after == 10
+
+    with pytest.raises(ValueError):
+        AdmissionControl(providers={"Broken": {"rate": 0}})
+
+
+def test_submissions_over_max_in_flight_are_refused():
+    admission = AdmissionControl(max_in_flight=2, retry_after=3)
+    with admission.slot(), admission.slot():
+        with pytest.raises(SaturatedError) as err:
+            with admission.slot():
+                pass
+        assert err.value.retry_after == 3
+        assert admission.stats()["in_flight"] == 2
+    assert admission.stats()["in_flight"] == 0
+    assert admission.stats()["saturated"] == 1
+
+
+def test_the_least_recently_seen_providers_are_forgotten(clock):
+    admission = AdmissionControl(max_providers=2)
+    for provider in ("A", "B", "A", "C"):
+        admission.admit(provider)
+    assert sorted(admission.stats()["providers"]) == ["A", "C"]
+
+
+def test_a_refunded_token_can_be_used_again(clock):
+    admission = AdmissionControl(rate=1, burst=1)
+    admission.admit("A")
+    admission.refund("A")
+    admission.admit("A")
+    assert admission.stats()["admitted"] == 1
+
+
+def test_workers_wait_for_a_slot():
+    admission = AdmissionControl(max_in_flight=1)
+    admission.acquire()
+    entered = threading.Event()
+
+    def work():
+        with admission.slot(wait=True):
+            entered.set()
+
+    worker = threading.Thread(target=work)
+    worker.start()
+    assert not entered.wait(0.1)
+    admission.release()
+    assert entered.wait(1)
+    worker.join()
+    assert admission.stats()["in_flight"] == 0
+    assert admission.stats()["saturated"] == 0
+
+
+def test_coroutines_wait_for_a_slot():
+    admission = AdmissionControl(max_in_flight=1)
+
+    async def run():
+        entered = asyncio.Event()
+
+        async def work():
+            async with admission.async_slot():
+                entered.set()
+
+        admission.acquire()
+        worker = asyncio.ensure_future(work())
+        await asyncio.sleep(0.1)
+        assert not entered.is_set()
+        admission.release()
+        await asyncio.wait_for(worker, 1)
+
+    asyncio.run(run())
+    assert admission.stats()["in_flight"] == 0
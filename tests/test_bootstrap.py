@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+from bootstrap import CatalogBootstrap
+
+
+class FakeBroker(object):
+    def __init__(self, catalogs: list) -> None:
+        # Results of the successive injections
+        self.catalogs = list(catalogs)
+
+    def inject_catalog(self, name: str):
+        return self.catalogs.pop(0)
+
+
+def test_a_catalog_not_injected_is_retried():
+    broker = FakeBroker([None, SimpleNamespace(id="urn:ngsi-ld:Catalogue:Cat")])
+    ready = []
+    bootstrap = CatalogBootstrap(lambda: broker, "Cat", on_ready=lambda b, c: ready.append(c.id), initial_delay=0.01)
+    bootstrap.start()
+
+    assert bootstrap.wait(2)
+    assert ready == ["urn:ngsi-ld:Catalogue:Cat"]
+    assert bootstrap.status()["attempts"] == 2
+    assert bootstrap.status()["last_error"] is None
+
+
+def test_a_failure_once_ready_is_reported_instead_of_being_lost():
+    failures = []
+
+    def on_ready(broker, catalog):
+        raise ValueError("bad sharding")
+
+    bootstrap = CatalogBootstrap(
+        lambda: FakeBroker([SimpleNamespace(id="urn:ngsi-ld:Catalogue:Cat")]), "Cat",
+        on_ready=on_ready, on_failure=failures.append,
+    )
+    bootstrap._run()
+
+    assert not bootstrap.ready
+    assert [str(err) for err in failures] == ["bad sharding"]
+    assert "bad sharding" in bootstrap.status()["last_error"]
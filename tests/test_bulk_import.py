@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+from bulk_import import BulkImporter
+from content_hash import ContentHashes
+
+
+class FakeBroker(object):
+    # Dataset entities are SimpleNamespace(id, values), merged by set union
+    def __init__(self, datasets: dict) -> None:
+        self.datasets = datasets
+        self.hashes = ContentHashes(enabled=False)
+        self.cache = SimpleNamespace(put=lambda key, value: None)
+        self.ngsild_api = SimpleNamespace(upsert=self.upsert)
+        self.upserted = []
+        self.updated = []
+        self.members = []
+
+    def dataset_name(self, catalog, dataset_form: dict) -> str:
+        return "Cat:" + dataset_form["type"]
+
+    def get_dataset(self, dataset_id: str, cached: bool = True):
+        assert not cached
+        return self.datasets.get("urn:ngsi-ld:Dataset:" + dataset_id, None)
+
+    def merge_dataset(self, catalog, dataset_form: dict, current):
+        values = (current.values if current else set()) | {dataset_form["keyword"]}
+        dataset = SimpleNamespace(id="urn:ngsi-ld:Dataset:Cat:" + dataset_form["type"], values=values)
+        return dataset, [SimpleNamespace(id=dataset.id + ":json")]
+
+    def dataset_delta(self, current, dataset) -> dict:
+        return {"keyword": sorted(dataset.values)} if dataset.values != current.values else {}
+
+    def update_dataset(self, dataset, distributions: list, delta: dict, catalog=None) -> None:
+        self.updated.append((dataset.id, delta))
+
+    def upsert(self, entities: list):
+        self.upserted.extend(entity.id for entity in entities)
+
+    def add_catalog_dataset(self, catalog, dataset_id: str) -> bool:
+        return True
+
+    def append_catalog_datasets(self, catalog, dataset_ids: list) -> None:
+        self.members.extend(dataset_ids)
+
+
+def chunk(*forms) -> list:
+    datasets = {}
+    for form in forms:
+        datasets.setdefault("urn:ngsi-ld:Dataset:Cat:" + form["type"], (SimpleNamespace(id="Cat"), []))[1].append(form)
+    return list(datasets.items())
+
+
+def test_existing_datasets_only_get_their_changed_attributes():
+    broker = FakeBroker({
+        "urn:ngsi-ld:Dataset:Cat:Old": SimpleNamespace(id="urn:ngsi-ld:Dataset:Cat:Old", values={"a"}),
+        "urn:ngsi-ld:Dataset:Cat:Same": SimpleNamespace(id="urn:ngsi-ld:Dataset:Cat:Same", values={"a"}),
+    })
+    importer = BulkImporter(broker, None)
+
+    written = importer.upsert_chunk(chunk(
+        {"type": "New", "keyword": "a"},
+        {"type": "Old", "keyword": "b"},
+        {"type": "Old", "keyword": "c"},
+        {"type": "Same", "keyword": "a"},
+    ))
+
+    # Only the new dataset is replaced by the batch upsert
+    assert broker.upserted == ["urn:ngsi-ld:Dataset:Cat:New:json", "urn:ngsi-ld:Dataset:Cat:New"]
+    assert broker.updated == [("urn:ngsi-ld:Dataset:Cat:Old", {"keyword": ["a", "b", "c"]})]
+    assert written == ["urn:ngsi-ld:Dataset:Cat:New", "urn:ngsi-ld:Dataset:Cat:Old", "urn:ngsi-ld:Dataset:Cat:Same"]
+    assert importer.stats["unchanged"] == 2
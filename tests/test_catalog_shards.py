@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from ngsildclient import Entity
+
+from catalog_shards import CatalogShards, shard_name
+from config import load_config
+from injector_ngsildclient import SDMDCAT, catalog_member
+from registry_index import RegistryIndex
+
+
+PARENT = "urn:ngsi-ld:Catalogue:Cat"
+
+
+class FakeBroker(object):
+    # Catalogue injection and parent links, counted
+    def __init__(self) -> None:
+        self.injected = []
+        self.links = []
+
+    def inject_catalog(self, name: str) -> Entity:
+        time.sleep(0.01)
+        self.injected.append(name)
+        return Entity("Catalogue", name)
+
+    def append_catalog_catalogs(self, parent: Entity, catalog_ids: list) -> None:
+        self.links.extend(catalog_ids)
+
+
+def parent(shards=()) -> Entity:
+    catalog = Entity("Catalogue", "Cat")
+    if shards:
+        catalog.to_dict()[str(SDMDCAT["catalog"])] = [catalog_member(shard) for shard in shards]
+    return catalog
+
+
+def test_submissions_are_routed_by_the_configured_field():
+    broker = FakeBroker()
+    shards = CatalogShards(broker, parent(), route="DatasetProvider", catalogs={"Provider A": "partner-a"}, dedicated=True)
+
+    assert shards.route_form({"DatasetProvider": "Provider A"}).id == "urn:ngsi-ld:Catalogue:partner-a"
+    assert shards.route_form({"DatasetProvider": "Provider B"}).id == "urn:ngsi-ld:Catalogue:Provider-B"
+    assert shards.route_form({}).id == PARENT
+    assert broker.links == ["urn:ngsi-ld:Catalogue:partner-a", "urn:ngsi-ld:Catalogue:Provider-B"]
+
+
+def test_other_values_go_to_the_parent_unless_dedicated():
+    shards = CatalogShards(FakeBroker(), parent(), route="DatasetProvider")
+
+    assert shards.route_form({"DatasetProvider": "Provider B"}).id == PARENT
+    assert shards.route_form({"DatasetProvider": "Provider B"}, create=False).id == PARENT
+
+
+def test_a_new_catalogue_is_injected_once_by_concurrent_submissions():
+    broker = FakeBroker()
+    created = []
+    shards = CatalogShards(broker, parent(), route="DatasetProvider", on_created=created.append, dedicated=True)
+    routed = []
+
+    threads = [
+        threading.Thread(target=lambda: routed.append(shards.route_form({"DatasetProvider": "P"}).id))
+        for i in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert broker.injected == ["P"]
+    assert broker.links == ["urn:ngsi-ld:Catalogue:P"]
+    assert [catalog.id for catalog in created] == ["urn:ngsi-ld:Catalogue:P"]
+    assert set(routed) == {"urn:ngsi-ld:Catalogue:P"}
+
+
+def test_shards_listed_by_the_parent_are_not_linked_again():
+    broker = FakeBroker()
+    shards = CatalogShards(broker, parent(["urn:ngsi-ld:Catalogue:P"]), route="DatasetProvider", dedicated=True)
+
+    assert shards.linked() == ["P"]
+    shards.get("P")
+    assert broker.links == []
+
+
+def test_the_index_loads_and_lists_every_catalogue():
+    index = RegistryIndex()
+    index.put_catalog(parent())
+    index.put_catalog(Entity("Catalogue", "P"), PARENT)
+    client = SimpleNamespace(query_generator=lambda type, ctx: iter(
+        [Entity("Dataset", "Cat:a"), Entity("Dataset", "P:b")] if type == str(SDMDCAT["Dataset"]) else []
+    ))
+
+    index.load(client, {
+        PARENT: {"urn:ngsi-ld:Dataset:Cat:a"},
+        "urn:ngsi-ld:Catalogue:P": {"urn:ngsi-ld:Dataset:P:b"},
+    })
+
+    assert index.list_catalogs() == [
+        {"id": PARENT, "datasets": 1, "shards": ["urn:ngsi-ld:Catalogue:P"]},
+        {"id": "urn:ngsi-ld:Catalogue:P", "datasets": 1, "shards": []},
+    ]
+    assert index.catalog(PARENT)[str(SDMDCAT["catalog"])]["object"] == ["urn:ngsi-ld:Catalogue:P"]
+    assert index.search(catalog_id="urn:ngsi-ld:Catalogue:P")["total"] == 1
+
+
+def test_values_are_reduced_to_safe_catalogue_names():
+    assert shard_name(" Provider A/B ") == "Provider-A-B"
+    assert shard_name("a?b#c%d:e") == "a-b-c-d-e"
+    assert shard_name("Ñ") is None
+
+    shards = CatalogShards(FakeBroker(), parent(), route="DatasetProvider", dedicated=True)
+    assert shards.route_form({"DatasetProvider": "urn:x?y"}).id == "urn:ngsi-ld:Catalogue:urn-x-y"
+    assert shards.route_form({"DatasetProvider": "???"}).id == PARENT
+    with pytest.raises(ValueError):
+        CatalogShards(FakeBroker(), parent(), route="DatasetProvider", catalogs={"A": "a:b"})
+
+
+def test_dedicated_catalogues_are_limited():
+    broker = FakeBroker()
+    shards = CatalogShards(broker, parent(), route="DatasetProvider", dedicated=True, max_catalogs=2)
+
+    assert shards.route_form({"DatasetProvider": "A"}).id == "urn:ngsi-ld:Catalogue:A"
+    assert shards.route_form({"DatasetProvider": "B"}).id == PARENT
+    assert shards.route_form({"DatasetProvider": "A"}).id == "urn:ngsi-ld:Catalogue:A"
+    assert broker.injected == ["A"]
+
+
+def test_a_bad_sharding_section_fails_when_the_config_is_loaded(tmp_path):
+    conf = {
+        "context_broker": {"url": "http://broker:1026"},
+        "catalog": dict.fromkeys(["name", "title", "description", "publisher", "homepage", "rights", "license"], "x"),
+        "distribution": {"base_url": "https://x.org", "availability": "x"},
+        "sharding": {"enabled": True, "route": "DatasetProvider", "catalogs": {"Provider A": "partner:a"}},
+    }
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(conf))
+    with pytest.raises(ValueError):
+        load_config(str(path))
+
+    conf["sharding"]["catalogs"] = {"Provider A": "partner-a"}
+    path.write_text(json.dumps(conf))
+    assert load_config(str(path))[0]["sharding"]["catalogs"] == {"Provider A": "partner-a"}
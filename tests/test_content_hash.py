@@ -0,0 +1,71 @@
+import requests
+from ngsildclient import Entity
+
+from content_hash import ContentHashes, content_hash
+from injector_ngsildclient import NgsildBrokerDataInjector, DATASET_VOLATILE_PROPERTIES, SDM, SDMDCAT
+
+
+def distribution(title: str, modified: str) -> Entity:
+    return Entity.from_dict({
+        "id": "urn:ngsi-ld:Distribution:Cat:a:json",
+        "type": str(SDMDCAT["Distribution"]),
+        "title": {"type": "Property", "value": title},
+        str(SDM["dateModified"]): {"type": "Property", "value": modified},
+    })
+
+
+class FakeClient(object):
+    def __init__(self) -> None:
+        self.session = requests.Session()
+        self.upserts = []
+
+    def upsert(self, *entities, update=False):
+        self.upserts.append([entity.id for entity in entities])
+        return True
+
+
+def test_the_hash_ignores_key_order_and_volatile_attributes():
+    a = {"id": "x", "title": {"value": "t", "type": "Property"}, str(SDM["dateModified"]): {"value": "1"}}
+    b = {str(SDM["dateModified"]): {"value": "2"}, "title": {"type": "Property", "value": "t"}, "id": "x"}
+
+    assert content_hash(a, DATASET_VOLATILE_PROPERTIES) == content_hash(b, DATASET_VOLATILE_PROPERTIES)
+    assert content_hash(a) != content_hash(b)
+
+
+def test_only_changed_entities_are_reported():
+    hashes = ContentHashes(volatile=DATASET_VOLATILE_PROPERTIES)
+    hashes.remember(hashes.changed([distribution("JSON", "2024-01-01")]))
+
+    assert hashes.changed([distribution("JSON", "2024-02-01")]) == {}
+    assert list(hashes.changed([distribution("JSON-LD", "2024-02-01")])) == ["urn:ngsi-ld:Distribution:Cat:a:json"]
+    assert hashes.stats()["skipped"] == 1
+
+    # Written again once forgotten, or once the hash is no longer trusted
+    hashes.forget(["urn:ngsi-ld:Distribution:Cat:a:json"])
+    assert hashes.changed([distribution("JSON", "2024-02-01")])
+    expired = ContentHashes(ttl=-1)
+    expired.put([distribution("JSON", "2024-01-01")])
+    assert expired.changed([distribution("JSON", "2024-01-01")])
+
+
+def test_unchanged_entities_are_not_upserted():
+    client = FakeClient()
+    broker = NgsildBrokerDataInjector("http://broker:1026", client=client)
+
+    broker.upsert([distribution("JSON", "2024-01-01")])
+    broker.upsert([distribution("JSON", "2024-02-01")])
+    broker.upsert([distribution("JSON-LD", "2024-03-01")])
+
+    assert client.upserts == [["urn:ngsi-ld:Distribution:Cat:a:json"], ["urn:ngsi-ld:Distribution:Cat:a:json"]]
+    assert broker.hashes.stats()["skipped"] == 1
+
+
+def test_disabled_change_detection_writes_everything():
+    client = FakeClient()
+    broker = NgsildBrokerDataInjector("http://broker:1026", client=client, change_detection={"enabled": False})
+
+    broker.upsert([distribution("JSON", "2024-01-01")])
+    broker.upsert([distribution("JSON", "2024-01-01")])
+
+    assert len(client.upserts) == 2
+    assert broker.hashes.stats()["entries"] == 0
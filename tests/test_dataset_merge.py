@@ -0,0 +1,109 @@
+import json
+from types import SimpleNamespace
+
+import requests
+from ngsildclient import Entity
+
+from injector_ngsildclient import (
+    NgsildBrokerDataInjector,
+    merge_list,
+    SDMDCAT,
+    DATASET_MERGED_PROPERTIES,
+    DATASET_DERIVED_PROPERTIES,
+    DATASET_VOLATILE_PROPERTIES,
+)
+
+
+DATASET_ID = "urn:ngsi-ld:Dataset:Cat:Environment:AirQualityObserved"
+
+
+def dataset(**values) -> Entity:
+    # Dataset with every attribute compared by dataset_delta
+    attrs = {name: ["x"] for name in DATASET_MERGED_PROPERTIES}
+    attrs.update({name: "x" for name in DATASET_DERIVED_PROPERTIES + DATASET_VOLATILE_PROPERTIES})
+    attrs[str(SDMDCAT["accessRights"])] = "RESTRICTED"
+    attrs.update({str(SDMDCAT[name]) if name != "title" else name: value for name, value in values.items()})
+    payload = {"id": DATASET_ID, "type": str(SDMDCAT["Dataset"])}
+    payload.update({name: {"type": "Property", "value": value} for name, value in attrs.items()})
+    return Entity.from_dict(payload)
+
+
+def distribution(ext: str) -> Entity:
+    return Entity.from_dict({"id": "urn:ngsi-ld:Distribution:Cat:Environment:AirQualityObserved:" + ext, "type": str(SDMDCAT["Distribution"])})
+
+
+class RecordingSession(requests.Session):
+    # Partial updates, recorded instead of sent
+    def __init__(self) -> None:
+        super().__init__()
+        self.posts = []
+
+    def post(self, url, data=None, **kwargs):
+        self.posts.append((url, json.loads(data)))
+        return requests.Response()
+
+
+class FakeClient(object):
+    # Entity ids of every upsert, the partial updates go through the session
+    def __init__(self) -> None:
+        self.session = RecordingSession()
+        self.entities = SimpleNamespace(url="http://broker:1026/ngsi-ld/v1/entities")
+        self.upserts = []
+
+    def raise_for_status(self, r) -> None:
+        pass
+
+    def upsert(self, *entities, update=False):
+        self.upserts.append([entity.id for entity in entities])
+        return True
+
+
+def injector() -> tuple:
+    client = FakeClient()
+    return client, NgsildBrokerDataInjector("http://broker:1026", client=client, cache={"enabled": False})
+
+
+def test_merged_lists_keep_the_first_occurrence_order():
+    assert merge_list(["b", "a"], ["c", "a", "d", "c"]) == ["b", "a", "c", "d"]
+    assert merge_list("a", "b") == ["a", "b"]
+    assert merge_list([], ["a"]) == ["a"]
+
+
+def test_an_empty_delta_is_not_written():
+    client, broker = injector()
+    current = dataset()
+    merged = dataset(temporal="y")
+
+    assert broker.dataset_delta(current, merged) == {}
+    broker.update_dataset(merged, [distribution("json")], {})
+    assert client.session.posts == client.upserts == []
+
+
+def test_only_the_changed_attributes_are_appended():
+    client, broker = injector()
+    merged = dataset(keyword=["x", "pollution"], temporal="y")
+    delta = broker.dataset_delta(dataset(), merged)
+
+    broker.update_dataset(merged, [distribution("json")], delta)
+
+    assert client.upserts == []
+    [(url, attrs)] = client.session.posts
+    assert url == "http://broker:1026/ngsi-ld/v1/entities/" + DATASET_ID + "/attrs"
+    assert attrs[str(SDMDCAT["keyword"])]["value"] == ["x", "pollution"]
+    assert str(SDMDCAT["theme"]) not in attrs
+    # Only sent along with an actual change
+    assert attrs[str(SDMDCAT["temporal"])]["value"] == "y"
+
+
+def test_distributions_are_only_written_when_their_source_properties_change():
+    client, broker = injector()
+    distributions = [distribution("json"), distribution("jsonld")]
+
+    merged = dataset(language=["x", "SPA"])
+    broker.update_dataset(merged, distributions, broker.dataset_delta(dataset(), merged))
+    assert client.upserts == []
+
+    merged = dataset(accessRights="PUBLIC")
+    broker.update_dataset(merged, distributions, broker.dataset_delta(dataset(), merged))
+    assert client.upserts == [[entity.id for entity in distributions]]
+    assert str(SDMDCAT["accessRights"]) in client.session.posts[-1][1]
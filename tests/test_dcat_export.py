@@ -0,0 +1,95 @@
+import json
+
+from dcat_export import DCAT, DCTERMS, serialise, etag, etag_matches
+from injector_ngsildclient import SDM, SDMDCAT, catalog_member
+from registry_index import RegistryIndex
+
+
+CATALOG = {
+    "id": "urn:ngsi-ld:Catalogue:Cat",
+    "type": str(SDMDCAT["Catalogue"]),
+    "title": {"type": "Property", "value": 'The "Cat" catalogue'},
+    str(SDMDCAT["homepage"]): {"type": "Property", "value": "https://x.org"},
+}
+DATASET = {
+    "id": "urn:ngsi-ld:Dataset:Cat:a",
+    "type": str(SDMDCAT["Dataset"]),
+    "title": {"type": "Property", "value": "a"},
+    str(SDMDCAT["keyword"]): {"type": "Property", "value": ["air\nquality", "NO2"]},
+    str(SDM["dateCreated"]): {"type": "Property", "value": "2024-01-01T00:00:00"},
+    str(SDMDCAT["distribution"]): {"type": "Relationship", "object": ["urn:ngsi-ld:Distribution:Cat:a:json"]},
+}
+DISTRIBUTION = {
+    "id": "urn:ngsi-ld:Distribution:Cat:a:json",
+    "type": str(SDMDCAT["Distribution"]),
+    "format": {"type": "Property", "value": "JSON"},
+}
+
+
+def index() -> RegistryIndex:
+    index = RegistryIndex()
+    index.put_catalog(dict(CATALOG))
+    index.put_dataset(CATALOG["id"], DATASET, [DISTRIBUTION])
+    return index
+
+
+def test_ntriples_lists_one_triple_per_line_with_escaped_literals():
+    version, catalogs, datasets = index().snapshot(CATALOG["id"])
+    chunks = list(serialise("nt", catalogs, datasets))
+    lines = "".join(chunks).splitlines()
+
+    # A chunk per catalogue and per dataset with its distributions
+    assert len(chunks) == 2
+    assert all(line.endswith(" .") for line in lines)
+    assert '<urn:ngsi-ld:Catalogue:Cat> <{}> "The \\"Cat\\" catalogue" .'.format(DCTERMS["title"]) in lines
+    assert "<urn:ngsi-ld:Catalogue:Cat> <{}> <urn:ngsi-ld:Dataset:Cat:a> .".format(DCAT["dataset"]) in lines
+    assert '<urn:ngsi-ld:Dataset:Cat:a> <{}> "air\\nquality" .'.format(DCAT["keyword"]) in lines
+    assert '<urn:ngsi-ld:Dataset:Cat:a> <{}> "2024-01-01T00:00:00"^^<http://www.w3.org/2001/XMLSchema#dateTime> .'.format(
+        DCTERMS["issued"]) in lines
+    assert "<urn:ngsi-ld:Distribution:Cat:a:json> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <{}> .".format(
+        DCAT["Distribution"]) in lines
+
+
+def test_turtle_groups_the_objects_of_a_subject():
+    version, catalogs, datasets = index().snapshot(CATALOG["id"])
+    document = "".join(serialise("ttl", catalogs, datasets))
+
+    assert document.startswith("@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .\n")
+    assert "<urn:ngsi-ld:Catalogue:Cat>\n    a dcat:Catalog ;\n" in document
+    assert "    foaf:homepage <https://x.org> ;\n" in document
+    assert '    dcat:keyword "air\\nquality", "NO2" ;\n' in document
+
+
+def test_jsonld_is_a_valid_expanded_document():
+    version, catalogs, datasets = index().snapshot(CATALOG["id"])
+    nodes = json.loads("".join(serialise("jsonld", catalogs, datasets)))
+
+    assert [node["@id"] for node in nodes] == [CATALOG["id"], DATASET["id"], DISTRIBUTION["id"]]
+    assert nodes[1][DCAT["distribution"]] == [{"@id": DISTRIBUTION["id"]}]
+    assert json.loads("".join(serialise("jsonld", [], []))) == []
+
+
+def test_the_etag_changes_with_the_catalogue():
+    registry = index()
+    before = etag(registry.epoch, registry.version)
+    assert etag_matches(before, before)
+    assert etag_matches('W/{}, "other"'.format(before), before)
+    assert etag_matches("*", before)
+    assert not etag_matches(None, before)
+
+    registry.put_dataset(CATALOG["id"], dict(DATASET, id="urn:ngsi-ld:Dataset:Cat:b"), [])
+    assert not etag_matches(before, etag(registry.epoch, registry.version))
+
+
+def test_a_snapshot_includes_the_shards_of_a_catalogue():
+    registry = index()
+    shard = dict(CATALOG, id="urn:ngsi-ld:Catalogue:P")
+    shard[str(SDMDCAT["dataset"])] = [catalog_member("urn:ngsi-ld:Dataset:P:x")]
+    registry.put_catalog(shard, CATALOG["id"])
+    registry.put_dataset(shard["id"], dict(DATASET, id="urn:ngsi-ld:Dataset:P:x"), [])
+
+    version, catalogs, datasets = registry.snapshot(CATALOG["id"])
+
+    assert [catalog["id"] for catalog in catalogs] == [CATALOG["id"], "urn:ngsi-ld:Catalogue:P"]
+    assert [dataset["id"] for dataset, distributions in datasets] == [DATASET["id"], "urn:ngsi-ld:Dataset:P:x"]
+    assert catalogs[0][str(SDMDCAT["catalog"])]["object"] == ["urn:ngsi-ld:Catalogue:P"]
@@ -0,0 +1,70 @@
+import threading
+import time
+
+from dedup import DeliveryDeduplicator
+
+
+RESPONSE = ("", 201, {})
+
+
+def test_duplicate_in_flight_waits_for_the_original_response():
+    deduplicator = DeliveryDeduplicator(wait=5)
+    key = deduplicator.key("body")
+    assert deduplicator.begin(key) is None
+
+    responses = []
+    duplicate = threading.Thread(target=lambda: responses.append(deduplicator.begin(key)))
+    duplicate.start()
+    time.sleep(0.1)
+    assert responses == []
+
+    deduplicator.end(key, RESPONSE)
+    duplicate.join(1)
+    assert responses == [RESPONSE]
+    assert deduplicator.stats()["duplicates"] == 1
+
+
+def test_duplicate_in_flight_is_refused_when_the_wait_expires():
+    deduplicator = DeliveryDeduplicator(wait=0.1)
+    key = deduplicator.key("body")
+    assert deduplicator.begin(key) is None
+
+    body, status, headers = deduplicator.begin(key)
+    assert status == 503
+    assert headers["Retry-After"] == "1"
+    assert deduplicator.stats()["busy"] == 1
+
+    # Still claimed by the original delivery, whose response is then given to the retries
+    deduplicator.end(key, RESPONSE)
+    assert deduplicator.begin(key) == RESPONSE
+
+
+def test_cancelled_delivery_is_processed_again():
+    deduplicator = DeliveryDeduplicator()
+    key = deduplicator.key("body")
+    assert deduplicator.begin(key) is None
+    deduplicator.cancel(key)
+    assert deduplicator.begin(key) is None
+
+
+def test_stored_responses_survive_a_restart(tmp_path):
+    store = str(tmp_path / "deliveries.sqlite")
+    deduplicator = DeliveryDeduplicator(store=store)
+    key = deduplicator.key("body")
+    deduplicator.begin(key)
+    deduplicator.end(key, RESPONSE)
+
+    restarted = DeliveryDeduplicator(store=store)
+    assert restarted.begin(key) == RESPONSE
+
+
+def test_stored_responses_expire_after_the_window(tmp_path):
+    store = str(tmp_path / "deliveries.sqlite")
+    deduplicator = DeliveryDeduplicator(store=store, window=0.1)
+    key = deduplicator.key("body")
+    deduplicator.begin(key)
+    deduplicator.end(key, RESPONSE)
+    time.sleep(0.2)
+
+    assert DeliveryDeduplicator(store=store, window=0.1).begin(key) is None
+    assert deduplicator.begin(key) is None
@@ -0,0 +1,105 @@
+import hashlib
+import hmac
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import dataset_registry_module as registry
+from admission import AdmissionControl
+from ingestion_queue import IngestionQueue, JOB_QUEUED
+from outbox import Outbox
+
+FORM_KEY = "form-key"
+
+FORM = {
+    "DatasetType": "https://smartdatamodels.org/dataModel.Environment/AirQualityObserved",
+    "DatasetTypeDescription": "Air quality observations",
+    "DatasetCreator": "University of Cantabria",
+    "DatasetProvider": "Provider",
+    "DatasetTypeTopic": "Environment 2abc",
+    "DatasetLanguage": "English 0abc",
+    "DatasetAccessRights": "Public 1abc",
+    "DatasetKeywords": "air quality",
+    "DatasetLocation": "Spain 25abc",
+    "ScorpioSatelliteURL": "https://satellite.example.org:9090",
+    "DatasetIDPattern": "AirQualityObserved:.*",
+}
+
+
+def post(client, form: dict):
+    body = json.dumps(form)
+    timestamp = str(int(time.time()))
+    signature = hmac.new(FORM_KEY.encode("utf-8"), (timestamp + "." + body).encode("utf-8"), hashlib.sha256).hexdigest()
+    return client.post("/injector", data=body, headers={
+        "Content-Type": "application/json",
+        "x-wpforms-webhook-signature": "t={},v={}".format(timestamp, signature),
+    })
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Workers not started, jobs stay queued
+    queue = IngestionQueue(lambda form: [])
+    monkeypatch.setattr(registry, "form_key", FORM_KEY)
+    monkeypatch.setattr(registry, "catalog", SimpleNamespace(id="urn:ngsi-ld:Catalogue:Cat"))
+    monkeypatch.setattr(registry, "ingestion_queue", queue)
+    monkeypatch.setattr(registry, "deduplicator", None)
+    return registry.app.test_client()
+
+
+def test_valid_form_is_queued(client):
+    response = post(client, FORM)
+    assert response.status_code == 202
+    job = registry.ingestion_queue.get(response.get_json()["id"])
+    assert job.status == JOB_QUEUED
+    assert job.form["DatasetProvider"] == "Provider"
+
+
+def test_invalid_form_is_rejected_before_it_is_queued(client):
+    form = dict(FORM, ScorpioSatelliteURL="not a url")
+    del form["DatasetTypeTopic"]
+
+    response = post(client, form)
+    assert response.status_code == 400
+    assert response.get_json()["errors"]
+    assert registry.ingestion_queue._queue.qsize() == 0
+
+
+def test_a_provider_over_its_rate_gets_429_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(registry, "admission", AdmissionControl(rate=0.5, burst=1))
+    assert post(client, FORM).status_code == 202
+
+    response = post(client, FORM)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert registry.ingestion_queue._queue.qsize() == 1
+    assert post(client, dict(FORM, DatasetProvider="Other")).status_code == 202
+
+
+def test_submissions_over_max_in_flight_get_503_with_retry_after(client, monkeypatch):
+    admission = AdmissionControl(max_in_flight=1, retry_after=4)
+    monkeypatch.setattr(registry, "admission", admission)
+    monkeypatch.setattr(registry, "ingestion_queue", None)
+    monkeypatch.setattr(registry, "inject_form", lambda form: [])
+
+    with admission.slot():
+        response = post(client, FORM)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "4"
+    # The refused submission did not use up the provider's budget
+    assert admission.stats()["providers"]["Provider"]["admitted"] == 0
+    assert admission.stats()["providers"]["Provider"]["tokens"] == 10
+    assert post(client, FORM).status_code == 201
+
+
+def test_a_full_outbox_answers_503_with_retry_after(client, monkeypatch, tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), lambda form: [], max_pending=1)
+    monkeypatch.setattr(registry, "outbox", outbox)
+
+    assert post(client, FORM).status_code == 202
+    response = post(client, FORM)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert outbox.pending() == 1
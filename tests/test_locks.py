@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import requests
+
+from injector_ngsildclient import NgsildBrokerDataInjector
+from locks import KeyedLocks, AsyncKeyedLocks
+
+
+def test_concurrent_appends_to_the_same_key_are_serialised():
+    locks = KeyedLocks()
+    members = []
+
+    def append(value):
+        # Read-modify-write, a lost update shows up as a missing value
+        with locks.hold("urn:ngsi-ld:Catalogue:Cat"):
+            current = list(members)
+            time.sleep(0.001)
+            members[:] = current + [value]
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(members) == list(range(20))
+    assert len(locks) == 0
+
+
+def test_writes_of_a_key_keep_the_order_in_which_it_was_acquired():
+    locks = KeyedLocks()
+    order = []
+    first_holds = threading.Event()
+
+    def first():
+        with locks.hold("key"):
+            first_holds.set()
+            time.sleep(0.1)
+            order.append("first")
+
+    def second():
+        first_holds.wait()
+        with locks.hold("key"):
+            order.append("second")
+
+    threads = [threading.Thread(target=second), threading.Thread(target=first)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert order == ["first", "second"]
+
+
+def test_different_keys_do_not_block_each_other():
+    locks = KeyedLocks()
+    entered = threading.Event()
+
+    with locks.hold("urn:ngsi-ld:Dataset:A"):
+        def hold_other():
+            with locks.hold("urn:ngsi-ld:Dataset:B"):
+                entered.set()
+
+        thread = threading.Thread(target=hold_other)
+        thread.start()
+        assert entered.wait(1)
+        thread.join()
+    assert len(locks) == 0
+
+
+def test_lock_is_released_when_the_holder_raises():
+    locks = KeyedLocks()
+    try:
+        with locks.hold("key"):
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    with locks.hold("key"):
+        pass
+    assert len(locks) == 0
+
+
+def test_async_appends_to_the_same_key_are_serialised():
+    locks = AsyncKeyedLocks()
+    members = []
+
+    async def append(value):
+        async with locks.hold("urn:ngsi-ld:Catalogue:Cat"):
+            current = list(members)
+            await asyncio.sleep(0.001)
+            members[:] = current + [value]
+
+    async def main():
+        await asyncio.gather(*(append(i) for i in range(20)))
+
+    asyncio.run(main())
+    assert sorted(members) == list(range(20))
+    assert len(locks) == 0
+
+
+def test_concurrent_new_members_are_each_added_once():
+    broker = NgsildBrokerDataInjector("http://localhost:1026", client=SimpleNamespace(session=requests.Session()))
+    catalog = SimpleNamespace(id="urn:ngsi-ld:Catalogue:Cat", to_dict=lambda: {})
+    dataset_ids = ["urn:ngsi-ld:Dataset:Cat:{}".format(i % 10) for i in range(50)]
+    added = []
+
+    def add(dataset_id):
+        if broker.add_catalog_dataset(catalog, dataset_id):
+            added.append(dataset_id)
+
+    threads = [threading.Thread(target=add, args=(dataset_id,)) for dataset_id in dataset_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(added) == sorted(set(dataset_ids))
+    assert broker.get_catalog_datasets(catalog) == set(dataset_ids)
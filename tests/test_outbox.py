@@ -0,0 +1,85 @@
+import time
+
+from ingestion_queue import JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+from outbox import Outbox
+
+
+class Unreachable(Exception):
+    pass
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_submissions_are_replayed_after_a_restart(tmp_path):
+    path = str(tmp_path / "outbox.sqlite")
+    outbox = Outbox(path, handler=None)
+    entry = outbox.append({"DatasetProvider": "a"})
+    # Taken by a worker when the process stopped
+    outbox._next_batch()
+    assert outbox.get(entry["id"])["status"] == JOB_RUNNING
+
+    replayed = []
+    restarted = Outbox(path, lambda form: replayed.append(form) or ["urn:ngsi-ld:Dataset:Cat:a"])
+    assert restarted.get(entry["id"])["status"] == JOB_QUEUED
+    restarted.start()
+
+    assert wait_for(lambda: restarted.get(entry["id"])["status"] == JOB_DONE)
+    assert replayed == [{"DatasetProvider": "a"}]
+    assert restarted.get(entry["id"])["entities"] == ["urn:ngsi-ld:Dataset:Cat:a"]
+    assert restarted.pending() == 0
+
+
+def test_an_entry_is_given_up_after_max_attempts(tmp_path):
+    def handler(form):
+        raise ValueError("invalid")
+
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), handler, max_attempts=2, initial_delay=0)
+    entry = outbox.append({})
+
+    assert outbox._replay(outbox._next_batch()[0])
+    assert outbox.get(entry["id"])["status"] == JOB_QUEUED
+    assert outbox._replay(outbox._next_batch()[0])
+
+    failed = outbox.get(entry["id"])
+    assert (failed["status"], failed["attempts"]) == (JOB_FAILED, 2)
+    assert "invalid" in failed["error"]
+    assert outbox.stats()["failed"] == 1
+
+
+def test_transient_errors_are_retried_without_counting_an_attempt(tmp_path):
+    calls = []
+
+    def handler(form):
+        calls.append(form)
+        if len(calls) < 3:
+            raise Unreachable()
+        return []
+
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), handler, max_attempts=1, initial_delay=0, transient=(Unreachable,))
+    entry = outbox.append({})
+
+    # Reported as transient, so that the replay thread backs off
+    assert not outbox._replay(outbox._next_batch()[0])
+    assert not outbox._replay(outbox._next_batch()[0])
+    assert outbox.get(entry["id"])["attempts"] == 0
+    assert outbox._replay(outbox._next_batch()[0])
+    assert outbox.get(entry["id"])["status"] == JOB_DONE
+
+
+def test_finished_entries_are_pruned_after_the_retention(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite"), lambda form: [], retention=-10)
+    done = outbox.append({})
+    outbox._replay(outbox._next_batch()[0])
+    pending = outbox.append({})
+
+    outbox._prune()
+
+    assert outbox.get(done["id"]) is None
+    assert outbox.get(pending["id"])["status"] == JOB_QUEUED
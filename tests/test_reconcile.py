@@ -0,0 +1,187 @@
+import re
+from types import SimpleNamespace
+
+from ngsildclient import Entity
+
+from content_hash import ContentHashes
+from entity_cache import EntityCache
+from injector_ngsildclient import SDM, SDMDCAT, catalog_member, relationship_objects
+from locks import KeyedLocks
+from reconcile import Reconciler
+
+
+CATALOG = "urn:ngsi-ld:Catalogue:Cat"
+
+
+def entity(type_name: str, id: str, attrs: dict = {}) -> Entity:
+    payload = {"id": "urn:ngsi-ld:{}:{}".format(type_name, id), "type": str(SDMDCAT[type_name])}
+    payload.update(attrs)
+    return Entity.from_dict(payload)
+
+
+def dataset(id: str, distributions: list) -> Entity:
+    return entity("Dataset", id, {
+        str(SDMDCAT["distribution"]): {"type": "Relationship", "object": distributions},
+        str(SDM["dataProvider"]): {"type": "Property", "value": "Provider A"},
+        str(SDMDCAT["Type"]): {"type": "Property", "value": "https://x.org/Type"},
+    })
+
+
+class FakeClient(object):
+    # Entities by id, queried in pages, and the writes of the repairs
+    def __init__(self, entities: list, csources: list = ()) -> None:
+        self.entities = {e.id: e for e in entities}
+        self.csources = {csource["id"]: csource for csource in csources}
+        self.upserts = []
+        self.pages = 0
+        self.url = "http://broker"
+        self.session = SimpleNamespace(get=self.get_entities)
+
+    def get_entities(self, url, headers, params):
+        assert url == "http://broker/ngsi-ld/v1/entities"
+        ids = params["id"].split(",") if "id" in params else None
+        pattern = re.compile(params.get("idPattern", ""))
+        matches = [
+            e.to_dict() for e in self.entities.values()
+            if e.type == params["type"] and (ids is None or e.id in ids) and pattern.match(e.id)
+        ]
+        self.pages += 1
+        page = matches[params["offset"]:params["offset"] + params["limit"]]
+        return SimpleNamespace(json=lambda: page)
+
+    def raise_for_status(self, r) -> None:
+        pass
+
+    def exists(self, entity_id: str) -> bool:
+        return entity_id in self.entities
+
+    def upsert(self, *entities, update=False):
+        self.upserts.extend(entities)
+
+
+class FakeBroker(object):
+    def __init__(self, client: FakeClient) -> None:
+        self.ngsild_api = client
+        self.context = None
+        self.locks = KeyedLocks()
+        self.cache = EntityCache()
+        self.hashes = ContentHashes()
+        self.catalog_index = {}
+        self.appended = []
+        self.deleted = []
+
+    def get_catalog(self, name: str, cached: bool = True) -> Entity:
+        return self.ngsild_api.entities.get("urn:ngsi-ld:Catalogue:" + name, None)
+
+    def get_csource(self, csource_id: str, cached: bool = True):
+        csource = self.ngsild_api.csources.get(csource_id, None)
+        if csource is None:
+            return None
+        return SimpleNamespace(information=[
+            SimpleNamespace(entities=[SimpleNamespace(**entity) for entity in information["entities"]])
+            for information in csource["information"]
+        ])
+
+    def get_catalog_datasets(self, catalog: Entity) -> set:
+        return self.catalog_index.setdefault(catalog.id, set(relationship_objects(catalog.to_dict().get(str(SDMDCAT["dataset"])))))
+
+    def append_catalog_datasets(self, catalog: Entity, dataset_ids: list) -> None:
+        self.appended.extend(dataset_ids)
+
+    def delete_catalog_datasets(self, catalog: Entity, dataset_ids: list) -> None:
+        self.deleted.extend(dataset_ids)
+
+
+def reconciler(client: FakeClient, page_size: int = 2) -> tuple:
+    broker = FakeBroker(client)
+    catalog = client.entities[CATALOG]
+    catalogs = SimpleNamespace(all=lambda: [catalog])
+    return Reconciler(broker, catalogs, page_size=page_size), broker
+
+
+def registry(members: list, datasets: list) -> FakeClient:
+    catalog = entity("Catalogue", "Cat", {str(SDMDCAT["dataset"]): [catalog_member(id) for id in members]})
+    distributions = [entity("Distribution", "Cat:a:json"), entity("Distribution", "Cat:b:json")]
+    csource = {
+        "id": "urn:ngsi-ld:ContextSourceRegistration:Provider-A",
+        "information": [{"entities": [{"type": "https://x.org/Type"}]}],
+    }
+    return FakeClient([catalog] + distributions + datasets, [csource])
+
+
+def test_no_drift_when_the_broker_matches_the_registry():
+    client = registry(
+        ["urn:ngsi-ld:Dataset:Cat:a", "urn:ngsi-ld:Dataset:Cat:b"],
+        [dataset("Cat:a", ["urn:ngsi-ld:Distribution:Cat:a:json"]), dataset("Cat:b", ["urn:ngsi-ld:Distribution:Cat:b:json"])],
+    )
+    report = reconciler(client)[0].run()
+
+    assert all(drift["count"] == 0 for drift in report["drift"].values())
+    assert report["scanned"] == {"catalogs": 1, "datasets": 2, "distributions": 2, "csources": 1}
+    # A page of two datasets (and an empty one ending the scan), the distributions of the page in a single query
+    assert report["pages"] == 2
+    assert client.pages == 3
+
+
+def test_drift_is_reported_without_writes():
+    client = registry(
+        ["urn:ngsi-ld:Dataset:Cat:a", "urn:ngsi-ld:Dataset:Cat:gone"],
+        [dataset("Cat:a", ["urn:ngsi-ld:Distribution:Cat:a:json", "urn:ngsi-ld:Distribution:Cat:a:csv"]), dataset("Cat:b", [])],
+    )
+    reconcile, broker = reconciler(client)
+    report = reconcile.run()
+
+    counts = {kind: drift["count"] for kind, drift in report["drift"].items() if drift["count"]}
+    assert counts == {"dangling_distributions": 1, "dangling_members": 1, "missing_members": 1}
+    assert report["drift"]["missing_members"]["items"] == [{"catalog": CATALOG, "dataset": "urn:ngsi-ld:Dataset:Cat:b"}]
+    assert client.upserts == broker.appended == broker.deleted == []
+
+
+def test_drift_is_repaired_with_batched_writes():
+    client = registry(
+        ["urn:ngsi-ld:Dataset:Cat:a", "urn:ngsi-ld:Dataset:Cat:gone"],
+        [dataset("Cat:a", ["urn:ngsi-ld:Distribution:Cat:a:json", "urn:ngsi-ld:Distribution:Cat:a:csv"]), dataset("Cat:b", [])],
+    )
+    reconcile, broker = reconciler(client)
+    report = reconcile.run(repair=True)
+
+    assert [fix.to_dict()[str(SDMDCAT["distribution"])]["object"] for fix in client.upserts] == [
+        ["urn:ngsi-ld:Distribution:Cat:a:json"],
+    ]
+    assert broker.deleted == ["urn:ngsi-ld:Dataset:Cat:gone"]
+    assert broker.appended == ["urn:ngsi-ld:Dataset:Cat:b"]
+    assert broker.catalog_index[CATALOG] == {"urn:ngsi-ld:Dataset:Cat:a", "urn:ngsi-ld:Dataset:Cat:b"}
+    assert report["repaired"]["dangling_members"] == report["repaired"]["missing_members"] == 1
+
+
+def test_references_written_during_the_scan_are_not_dangling():
+    client = registry(["urn:ngsi-ld:Dataset:Cat:a"], [dataset("Cat:a", ["urn:ngsi-ld:Distribution:Cat:a:json"])])
+    reconcile, broker = reconciler(client)
+    # Listed by the catalogue after the datasets were scanned
+    client.entities[CATALOG].to_dict()[str(SDMDCAT["dataset"])].append(catalog_member("urn:ngsi-ld:Dataset:Cat:new"))
+    real_get = client.get_entities
+
+    def get_entities(url, headers, params):
+        r = real_get(url, headers, params)
+        if "idPattern" in params:
+            client.entities["urn:ngsi-ld:Dataset:Cat:new"] = dataset("Cat:new", [])
+        return r
+    client.session.get = get_entities
+
+    report = reconcile.run(repair=True)
+
+    assert report["drift"]["dangling_members"]["count"] == 0
+    assert broker.deleted == []
+
+
+def test_only_the_datasets_of_the_registry_catalogues_are_read():
+    client = registry(
+        ["urn:ngsi-ld:Dataset:Cat:a"],
+        [dataset("Cat:a", ["urn:ngsi-ld:Distribution:Cat:a:json"]), dataset("Other:a", ["urn:ngsi-ld:Distribution:Other:a:json"])],
+    )
+    client.csources = {}
+    report = reconciler(client)[0].run()
+
+    assert report["scanned"]["datasets"] == 1
+    assert report["drift"]["dangling_distributions"]["count"] == 0
+    assert report["drift"]["missing_csources"]["items"] == ["urn:ngsi-ld:ContextSourceRegistration:Provider-A"]
@@ -0,0 +1,79 @@
+from injector_ngsildclient import SDMDCAT
+from registry_index import RegistryIndex
+
+CATALOG = "urn:ngsi-ld:Catalogue:Cat"
+
+
+def dataset(name, theme, language="ENG"):
+    id = "urn:ngsi-ld:Dataset:Cat:" + name
+    return {
+        "id": id,
+        "type": str(SDMDCAT["Dataset"]),
+        str(SDMDCAT["theme"]): {"type": "Property", "value": theme},
+        str(SDMDCAT["language"]): {"type": "Property", "value": [language]},
+        str(SDMDCAT["distribution"]): {"type": "Relationship", "object": ["urn:ngsi-ld:Distribution:Cat:" + name + ":json"]},
+    }
+
+
+def distribution(dataset_name):
+    return {"id": "urn:ngsi-ld:Distribution:Cat:" + dataset_name + ":json", "type": str(SDMDCAT["Distribution"])}
+
+
+def ids(result):
+    return [payload["id"] for payload in result["datasets"]]
+
+
+def index_of(*datasets):
+    index = RegistryIndex()
+    index.put_catalog({"id": CATALOG, "type": str(SDMDCAT["Catalogue"])})
+    for payload in datasets:
+        index.put_dataset(CATALOG, payload, [])
+    return index
+
+
+def test_facets_filter_and_count():
+    index = index_of(dataset("A", ["ENVI", "TRAN"]), dataset("B", ["ENVI"], "SPA"), dataset("C", ["TRAN"]))
+
+    result = index.search({"theme": ["ENVI"]})
+    assert ids(result) == ["urn:ngsi-ld:Dataset:Cat:A", "urn:ngsi-ld:Dataset:Cat:B"]
+    assert result["facets"]["theme"] == {"ENVI": 2, "TRAN": 1}
+
+    # Values of a facet are alternatives, facets are combined
+    assert result["total"] == 2
+    assert ids(index.search({"theme": ["ENVI", "TRAN"], "language": ["ENG"]})) == [
+        "urn:ngsi-ld:Dataset:Cat:A", "urn:ngsi-ld:Dataset:Cat:C",
+    ]
+    assert index.search()["facets"]["language"] == {"ENG": 2, "SPA": 1}
+
+
+def test_replaced_dataset_leaves_its_old_facet_values():
+    index = index_of(dataset("A", ["ENVI"]))
+    index.put_dataset(CATALOG, dataset("A", ["TRAN"]), [])
+
+    assert index.search({"theme": ["ENVI"]})["total"] == 0
+    assert ids(index.search({"theme": ["TRAN"]})) == ["urn:ngsi-ld:Dataset:Cat:A"]
+    assert "ENVI" not in index.search()["facets"]["theme"]
+
+
+def test_removed_dataset_leaves_facets_catalogue_and_distributions():
+    index = index_of(dataset("A", ["ENVI"]), dataset("B", ["TRAN"]))
+    index.put_dataset(CATALOG, dataset("A", ["ENVI"]), [distribution("A")])
+    index.remove_dataset("urn:ngsi-ld:Dataset:Cat:A")
+
+    assert index.search()["facets"]["theme"] == {"TRAN": 1}
+    assert index.dataset("urn:ngsi-ld:Dataset:Cat:A") is None
+    assert index.catalog(CATALOG)[str(SDMDCAT["dataset"])]["object"] == ["urn:ngsi-ld:Dataset:Cat:B"]
+    assert index.stats()["distributions"] == 0
+
+
+def test_loading_does_not_overwrite_datasets_written_meanwhile():
+    index = index_of(dataset("A", ["TRAN"]))
+    index.put_dataset(CATALOG, dataset("A", ["ENVI"]), [], replace=False)
+    assert ids(index.search({"theme": ["TRAN"]})) == ["urn:ngsi-ld:Dataset:Cat:A"]
+
+
+def test_pagination():
+    index = index_of(*(dataset(str(i), ["ENVI"]) for i in range(5)))
+    result = index.search({"theme": ["ENVI"]}, offset=3, limit=10)
+    assert result["total"] == 5
+    assert ids(result) == ["urn:ngsi-ld:Dataset:Cat:3", "urn:ngsi-ld:Dataset:Cat:4"]
@@ -0,0 +1,104 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from upsert_batcher import UpsertBatcher, BatchUpsertError
+
+
+def entity(id):
+    return SimpleNamespace(id=id)
+
+
+class FakeClient(object):
+    def __init__(self, failed=()) -> None:
+        self.failed = set(failed)
+        self.batches = []
+
+    def upsert(self, entities):
+        self.batches.append([e.id for e in entities])
+        return SimpleNamespace(errors=[{"entityId": e.id} for e in entities if e.id in self.failed])
+
+
+def run_batch(batcher, submissions):
+    # submissions: [(entities, catalog, members), ...] flushed together --> [result or exception, ...]
+    outcomes = [None] * len(submissions)
+
+    def submit(i, entities, catalog, members):
+        try:
+            outcomes[i] = batcher.upsert(entities, catalog, members)
+        except Exception as err:
+            outcomes[i] = err
+
+    threads = [threading.Thread(target=submit, args=(i,) + submission) for i, submission in enumerate(submissions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+@pytest.fixture
+def catalog():
+    return entity("urn:ngsi-ld:Catalogue:Cat")
+
+
+def test_failed_dataset_is_not_appended_to_the_catalogue(catalog):
+    client = FakeClient(failed=["urn:ngsi-ld:Distribution:B:json"])
+    appended = []
+    batcher = UpsertBatcher(client, lambda c, members: appended.append((c.id, list(members))), window_ms=200)
+    batcher.start()
+
+    outcomes = run_batch(batcher, [
+        ([entity("urn:ngsi-ld:Distribution:A:json"), entity("urn:ngsi-ld:Dataset:A")], catalog, ["urn:ngsi-ld:Dataset:A"]),
+        ([entity("urn:ngsi-ld:Distribution:B:json"), entity("urn:ngsi-ld:Dataset:B")], catalog, ["urn:ngsi-ld:Dataset:B"]),
+    ])
+
+    assert len(client.batches) == 1
+    assert not isinstance(outcomes[0], Exception)
+    assert isinstance(outcomes[1], BatchUpsertError)
+    assert outcomes[1].errors == [{"entityId": "urn:ngsi-ld:Distribution:B:json"}]
+    assert appended == [(catalog.id, ["urn:ngsi-ld:Dataset:A"])]
+
+
+def test_catalogue_not_written_when_every_submission_failed(catalog):
+    client = FakeClient(failed=["urn:ngsi-ld:Dataset:A"])
+    appended = []
+    batcher = UpsertBatcher(client, lambda c, members: appended.append(members))
+    batcher.start()
+
+    outcomes = run_batch(batcher, [([entity("urn:ngsi-ld:Dataset:A")], catalog, ["urn:ngsi-ld:Dataset:A"])])
+
+    assert isinstance(outcomes[0], BatchUpsertError)
+    assert appended == []
+
+
+def test_catalogue_error_fails_only_its_submissions(catalog):
+    client = FakeClient()
+
+    def catalog_writer(c, members):
+        raise RuntimeError("append failed")
+
+    batcher = UpsertBatcher(client, catalog_writer, window_ms=200)
+    batcher.start()
+
+    outcomes = run_batch(batcher, [
+        ([entity("urn:ngsi-ld:Dataset:A")], catalog, ["urn:ngsi-ld:Dataset:A"]),
+        ([entity("urn:ngsi-ld:Dataset:B")], None, []),
+    ])
+
+    assert isinstance(outcomes[0], RuntimeError)
+    assert not isinstance(outcomes[1], Exception)
+
+
+def test_batch_size_counts_the_catalogue_only_when_appending(catalog):
+    client = FakeClient()
+    batcher = UpsertBatcher(client, lambda c, members: None, window_ms=500, max_entities=2)
+    batcher.start()
+
+    # Two single entity upserts without catalogue fill a batch of 2
+    run_batch(batcher, [
+        ([entity("urn:ngsi-ld:Dataset:A")], None, []),
+        ([entity("urn:ngsi-ld:Dataset:B")], None, []),
+    ])
+    assert len(client.batches) == 1